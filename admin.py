@@ -0,0 +1,106 @@
+"""
+Admin HTTP endpoints of the sockjs server.
+
+Requests are authenticated like client messages: the body is a compact
+bitjws message, which must be signed by one of ADMIN_PUBHASHES, be
+recent, and not have been seen before.
+
+POST /admin/profile with {"method": "PROFILE", "seconds": N} samples the
+IOLoop thread for N seconds and returns collapsed stacks, e.g.
+
+    curl --data-binary @signed-profile-request \\
+        http://localhost:8123/admin/profile | flamegraph.pl > profile.svg
+"""
+import math
+import threading
+
+import bitjws
+from tornado import gen, web
+
+from precheck import precheck, MalformedToken, MissingField
+from profiler import SamplingProfiler
+from replay import replay_key
+
+
+class AdminHandler(web.RequestHandler):
+    """
+    Base class of the admin handlers, checking the signed request body.
+
+    :param iterable admins: the pubhashes allowed to use the endpoint
+    :param ReplayCache replay_cache: the cache refusing replayed requests
+    :param tuple iat_window: accepted age of the requests, see precheck
+    """
+
+    def initialize(self, admins, replay_cache, iat_window):
+        self.admins = frozenset(admins)
+        self.replay_cache = replay_cache
+        self.iat_window = iat_window
+
+    def authenticate(self):
+        """
+        Verify the request body and return its data.
+
+        :rtype: dict
+        :raises tornado.web.HTTPError: if the request isn't authenticated
+        """
+        try:
+            msg = self.request.body.decode('ascii')
+            unverified = precheck(msg, iat_window=self.iat_window)[1]
+        except (UnicodeError, MalformedToken, MissingField):
+            raise web.HTTPError(400)
+        replay = replay_key(msg, unverified)
+        if self.replay_cache.seen(replay, unverified['iat']):
+            raise web.HTTPError(403)
+        try:
+            headers, payload = bitjws.validate_deserialize(msg)
+        except Exception:
+            raise web.HTTPError(403)
+        # validate_deserialize returns (None, None) on a bad signature.
+        if headers is None or headers.get('kid') not in self.admins:
+            raise web.HTTPError(403)
+        self.replay_cache.add(replay, unverified['iat'])
+        return payload['data']
+
+
+class ProfileHandler(AdminHandler):
+    """
+    Sample the IOLoop thread for the requested number of seconds, at most
+    max_seconds, and return collapsed stacks. One profile runs at a time.
+
+    :param float interval: seconds between samples
+    :param float max_seconds: longest profile allowed
+    """
+    running = False
+
+    def initialize(self, admins, replay_cache, iat_window, interval=0.005,
+                   max_seconds=60):
+        super(ProfileHandler, self).initialize(admins, replay_cache,
+                                               iat_window)
+        self.interval = interval
+        self.max_seconds = max_seconds
+
+    async def post(self):
+        data = self.authenticate()
+        if data.get('method') != 'PROFILE':
+            raise web.HTTPError(400)
+        try:
+            seconds = float(data.get('seconds', 10))
+        except (TypeError, ValueError):
+            raise web.HTTPError(400)
+        if not math.isfinite(seconds):
+            raise web.HTTPError(400)
+        seconds = min(max(seconds, 0), self.max_seconds)
+        if ProfileHandler.running:
+            raise web.HTTPError(409)
+
+        ProfileHandler.running = True
+        # Handlers run on the IOLoop thread, the one to profile.
+        profiler = SamplingProfiler(threading.get_ident(), self.interval)
+        profiler.start()
+        try:
+            await gen.sleep(seconds)
+        finally:
+            profiler.stop()
+            ProfileHandler.running = False
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.write(profiler.collapsed())
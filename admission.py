@@ -0,0 +1,276 @@
+"""
+Token bucket admission control for inbound client frames.
+
+Every frame a client sends is charged against up to three buckets: one
+for the session, one for the client IP and, once the session has
+authenticated, one for its pubhash. The check only touches connection
+state, so abusive clients are turned away before any decoding or
+signature verification takes place.
+
+New sessions are paced as well: only so many are set up per IOLoop
+iteration and per second, the others wait their turn, and clients are
+told how long to back off before reconnecting so that a reconnect wave
+is spread over time.
+"""
+import time
+import random
+from collections import deque, OrderedDict
+
+from tornado import ioloop
+
+import metrics
+
+
+class TokenBucket(object):
+    """
+    A token bucket refilled at a constant rate.
+
+    :param float rate: tokens added per second
+    :param int burst: maximum number of tokens held
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic() if now is None else now
+
+    def consume(self, now=None, tokens=1):
+        """
+        Take tokens from the bucket.
+
+        :rtype: bool
+        :returns: False if the bucket doesn't hold enough tokens
+        """
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def is_full(self, now):
+        """Return True if the bucket would be full at the given time."""
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class KeyedRateLimiter(object):
+    """
+    A set of token buckets, one per key.
+
+    At most max_keys buckets are kept. When a new key comes in past that
+    bound the least recently used bucket is dropped, so memory stays
+    bounded however many clients churn through, and the key it belonged
+    to starts over with a full bucket.
+
+    :param float rate: tokens added per second to each bucket
+    :param int burst: maximum number of tokens held by each bucket
+    :param int max_keys: number of buckets kept
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, key, now=None):
+        """
+        Charge one token to the bucket for key.
+
+        :rtype: bool
+        """
+        if now is None:
+            now = time.monotonic()
+        buckets = self._buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.max_keys:
+                buckets.popitem(last=False)
+                metrics.incr('admission.buckets_evicted')
+            bucket = buckets[key] = TokenBucket(self.rate, self.burst, now)
+        else:
+            buckets.move_to_end(key)
+        return bucket.consume(now)
+
+
+class AdmissionControl(object):
+    """
+    Rate limits per session, per IP and per pubhash.
+
+    The limits are read from the config module:
+
+        RATE_LIMIT_SESSION, RATE_LIMIT_IP, RATE_LIMIT_PUBHASH
+            (tokens per second, burst) tuples, or None to disable
+        RATE_LIMIT_MAX_KEYS
+            number of IP and pubhash buckets kept in memory
+
+    :param config: the config module, e.g. pikaconfig
+    """
+
+    def __init__(self, config):
+        max_keys = getattr(config, 'RATE_LIMIT_MAX_KEYS', 100000)
+        self.session_limit = getattr(config, 'RATE_LIMIT_SESSION', None)
+        ip_limit = getattr(config, 'RATE_LIMIT_IP', None)
+        pubhash_limit = getattr(config, 'RATE_LIMIT_PUBHASH', None)
+        self.ip = self.pubhash = None
+        if ip_limit:
+            self.ip = KeyedRateLimiter(*ip_limit, max_keys=max_keys)
+        if pubhash_limit:
+            self.pubhash = KeyedRateLimiter(*pubhash_limit, max_keys=max_keys)
+
+    def session_bucket(self):
+        """
+        Return a new bucket to be kept by a session, or None if sessions
+        are not rate limited.
+
+        :rtype: TokenBucket|None
+        """
+        if self.session_limit:
+            return TokenBucket(*self.session_limit)
+
+    def check(self, bucket, ip, pubhash=None):
+        """
+        Charge one frame to each applicable bucket.
+
+        Rejections are counted under 'admission.rejected.<scope>'.
+
+        :param TokenBucket bucket: the session bucket, or None
+        :param str ip: the client IP
+        :param str pubhash: the authenticated pubhash, if any
+        :rtype: str|None
+        :returns: the scope that rejected the frame, or None if admitted
+        """
+        now = time.monotonic()
+        if bucket is not None and not bucket.consume(now):
+            scope = 'session'
+        elif self.ip is not None and not self.ip.allow(ip, now):
+            scope = 'ip'
+        elif (pubhash and self.pubhash is not None and
+                not self.pubhash.allow(pubhash, now)):
+            scope = 'pubhash'
+        else:
+            metrics.incr('admission.accepted')
+            return None
+        metrics.incr('admission.rejected.%s' % scope)
+        return scope
+
+
+class SessionPacer(object):
+    """
+    Pace the setup of new sessions.
+
+    A session is set up right away if fewer than per_tick sessions were
+    set up in the current IOLoop iteration and the per second bucket
+    holds a token. Otherwise it waits in line, and it is rejected if
+    max_pending sessions are already waiting.
+
+    Sessions passed to admit() must implement start(), called when the
+    session may be set up, reject(retry_after), called when it is
+    turned away, and is_closed.
+
+    :param tuple rate: (sessions per second, burst), or None to disable
+        pacing
+    :param int per_tick: sessions set up per IOLoop iteration
+    :param int max_pending: sessions waiting before new ones are rejected
+    :param float min_backoff: minimum reconnect backoff advised, in seconds
+    """
+
+    def __init__(self, rate=None, per_tick=50, max_pending=10000,
+                 min_backoff=1, io_loop=None):
+        self.bucket = TokenBucket(*rate) if rate else None
+        self.rate = float(rate[0]) if rate else None
+        self.per_tick = per_tick
+        self.max_pending = max_pending
+        self.min_backoff = min_backoff
+        self.sessions = 0
+        self._io_loop = io_loop
+        self._pending = deque()
+        self._tick_count = 0
+        self._scheduled = False
+
+    @property
+    def io_loop(self):
+        if self._io_loop is None:
+            self._io_loop = ioloop.IOLoop.current()
+        return self._io_loop
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _take(self):
+        if self.bucket is None:
+            return True
+        if self._tick_count >= self.per_tick:
+            return False
+        if not self._tick_count:
+            self.io_loop.add_callback(self._new_tick)
+        if not self.bucket.consume():
+            return False
+        self._tick_count += 1
+        return True
+
+    def _new_tick(self):
+        self._tick_count = 0
+
+    def admit(self, session):
+        """Set up session now, later, or reject it."""
+        if not self._pending and self._take():
+            self._start(session)
+            return
+        if len(self._pending) >= self.max_pending:
+            metrics.incr('admission.sessions.rejected')
+            session.reject(self.backoff())
+            return
+        metrics.incr('admission.sessions.deferred')
+        self._pending.append(session)
+        self._schedule()
+
+    def release(self):
+        """Tell the pacer that a session set up earlier went away."""
+        self.sessions -= 1
+
+    def backoff(self):
+        """
+        Return a randomized reconnect delay to advise a client, in
+        seconds.
+
+        Delays are spread over the time needed to set up every current
+        and waiting session again at the configured rate, so the clients
+        of a restarting node come back over that period rather than all
+        at once.
+        """
+        window = self.min_backoff
+        if self.rate:
+            window = max(window, (self.sessions + len(self._pending)) / self.rate)
+        return round(random.uniform(self.min_backoff, window), 1)
+
+    def _start(self, session):
+        self.sessions += 1
+        session.start()
+
+    def _schedule(self):
+        if self._scheduled:
+            return
+        self._scheduled = True
+        if self.bucket is not None and self.bucket.tokens < 1:
+            delay = (1 - self.bucket.tokens) / self.rate
+            self.io_loop.call_later(delay, self._run)
+        else:
+            self.io_loop.add_callback(self._run)
+
+    def _run(self):
+        self._scheduled = False
+        while self._pending and self._take():
+            session = self._pending.popleft()
+            if not session.is_closed:
+                self._start(session)
+        if self._pending:
+            self._schedule()
@@ -0,0 +1,206 @@
+"""
+Per-item authorization of subscriptions and client publishes.
+
+listener_allowed checks that the schema route of a subscription allows
+GET and that the message is signed by a key. Whether that key may read
+the item itself is up to a policy, asked once per (pubhash, model, id):
+
+    HTTPPolicy      POSTs {"pubhash", "model", "id"} to AUTHZ_POLICY_URL,
+                    e.g. a route of the flask-bitjws HTTP tier, and reads
+                    {"allowed": true|false} from the response.
+    CallablePolicy  calls AUTHZ_POLICY, the dotted path of a function
+                    taking (pubhash, model, id) and returning a bool or
+                    an awaitable, as a local stand-in.
+
+Decisions are cached, allowed ones for AUTHZ_CACHE_TTL seconds and denied
+ones for AUTHZ_NEGATIVE_TTL seconds. Concurrent lookups of the same key
+share one policy call, and at most AUTHZ_MAX_CONCURRENT calls are made at
+a time, so that a burst of subscriptions doesn't flood the policy source.
+A failed policy call denies the subscription and isn't cached.
+
+Client publishes are authorized the same way by a write policy of their
+own, PUBLISH_POLICY_URL or PUBLISH_POLICY, asked about the topic
+published to; the other settings are shared.
+
+Lookups are counted in 'authz.cache_hits', 'authz.lookups' (policy
+calls), 'authz.coalesced', 'authz.denied' and 'authz.errors'.
+"""
+import json
+import time
+import asyncio
+import inspect
+from collections import OrderedDict
+
+from tornado import httpclient, locks
+
+import metrics
+from util import import_object
+
+
+class CallablePolicy(object):
+    """
+    A policy answered by a local function.
+
+    :param callable func: called with (pubhash, model, item_id), returns
+        a bool or an awaitable of a bool
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    async def check(self, pubhash, model, item_id):
+        allowed = self.func(pubhash, model, item_id)
+        if inspect.isawaitable(allowed):
+            allowed = await allowed
+        return bool(allowed)
+
+
+class HTTPPolicy(object):
+    """
+    A policy answered by an HTTP endpoint.
+
+    :param str url: the URL decisions are POSTed to
+    :param float timeout: seconds before a request fails
+    :param dict headers: extra request headers, e.g. for authentication
+    """
+
+    def __init__(self, url, timeout=2, headers=None):
+        self.url = url
+        self.timeout = timeout
+        self.headers = {'Content-Type': 'application/json'}
+        self.headers.update(headers or {})
+
+    async def check(self, pubhash, model, item_id):
+        body = json.dumps({'pubhash': pubhash, 'model': model, 'id': item_id})
+        try:
+            response = await httpclient.AsyncHTTPClient().fetch(
+                self.url, method='POST', body=body, headers=self.headers,
+                request_timeout=self.timeout)
+        except httpclient.HTTPClientError as e:
+            if e.code in (401, 403, 404):
+                return False
+            raise
+        return json.loads(response.body.decode('utf-8')).get('allowed') is True
+
+
+class Authorizer(object):
+    """
+    Cache and coalesce the decisions of a policy.
+
+    :param policy: an object with an async check(pubhash, model, item_id)
+    :param float ttl: seconds an allowed decision is cached
+    :param float negative_ttl: seconds a denied decision is cached
+    :param int max_entries: most decisions kept, the oldest are dropped
+    :param int max_concurrent: most policy calls made at a time
+    """
+
+    def __init__(self, policy, ttl=60, negative_ttl=10, max_entries=100000,
+                 max_concurrent=32):
+        self.policy = policy
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._semaphore = locks.Semaphore(max_concurrent)
+        self._cache = OrderedDict()
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._cache)
+
+    def cached(self, pubhash, model, item_id, now=None):
+        """
+        Return the cached decision of a key, or None if there is none.
+
+        :rtype: bool|None
+        """
+        key = (pubhash, model, item_id)
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        allowed, expires = entry
+        if (time.monotonic() if now is None else now) >= expires:
+            del self._cache[key]
+            return None
+        metrics.incr('authz.cache_hits')
+        return allowed
+
+    def lookup(self, pubhash, model, item_id):
+        """
+        Ask the policy for a decision, unless the same one is already
+        being asked for, and return a future resolving to it. The future
+        never fails: errors deny.
+
+        :rtype: asyncio.Future
+        """
+        key = (pubhash, model, item_id)
+        future = self._inflight.get(key)
+        if future is not None:
+            metrics.incr('authz.coalesced')
+            return future
+        future = self._inflight[key] = asyncio.ensure_future(self._fetch(key))
+        return future
+
+    async def authorize(self, pubhash, model, item_id):
+        """
+        Return the decision of a key, from the cache or the policy.
+
+        :rtype: bool
+        """
+        allowed = self.cached(pubhash, model, item_id)
+        if allowed is None:
+            allowed = await self.lookup(pubhash, model, item_id)
+        return allowed
+
+    async def _fetch(self, key):
+        try:
+            async with self._semaphore:
+                metrics.incr('authz.lookups')
+                allowed = await self.policy.check(*key)
+        except Exception:
+            metrics.incr('authz.errors')
+            allowed = None
+        finally:
+            del self._inflight[key]
+        if allowed is None:
+            allowed = False
+        else:
+            self._store(key, allowed)
+        if not allowed:
+            metrics.incr('authz.denied')
+        return allowed
+
+    def _store(self, key, allowed):
+        ttl = self.ttl if allowed else self.negative_ttl
+        if not ttl:
+            return
+        self._cache.pop(key, None)
+        self._cache[key] = (allowed, time.monotonic() + ttl)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+
+def from_config(config, prefix='AUTHZ'):
+    """
+    Return the Authorizer configured by AUTHZ_POLICY_URL or AUTHZ_POLICY,
+    or None if per-item authorization is disabled.
+
+    :param config: the config module, e.g. pikaconfig
+    :param str prefix: the prefix of the policy settings, 'PUBLISH' for
+        the write policy
+    :rtype: Authorizer|None
+    """
+    url = getattr(config, prefix + '_POLICY_URL', None)
+    func = getattr(config, prefix + '_POLICY', None)
+    if url:
+        policy = HTTPPolicy(url, getattr(config, 'AUTHZ_TIMEOUT', 2),
+                            getattr(config, 'AUTHZ_HEADERS', None))
+    elif func:
+        policy = CallablePolicy(import_object(func) if isinstance(func, str)
+                                else func)
+    else:
+        return None
+    return Authorizer(policy,
+                      getattr(config, 'AUTHZ_CACHE_TTL', 60),
+                      getattr(config, 'AUTHZ_NEGATIVE_TTL', 10),
+                      getattr(config, 'AUTHZ_CACHE_MAX', 100000),
+                      getattr(config, 'AUTHZ_MAX_CONCURRENT', 32))
@@ -0,0 +1,108 @@
+"""
+Throughput benchmark for the consumer dispatch path.
+
+Signed messages are scheduled on the event loop and fed to
+AsyncConsumer.on_message, which verifies them and fans them out to a
+set of dummy listeners. The number of messages delivered per second is
+reported together with the interpreter and event loop in use, so runs
+under different interpreters (or before and after a change) can be
+compared directly.
+
+    python bench/bench_dispatch.py -n 5000 -l 100
+    python bench/bench_dispatch.py --loop-policy uvloop.EventLoopPolicy
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import platform
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+import bitjws
+
+import pikaconfig
+from util import install_event_loop_policy
+from sockjs_pika_consumer import AsyncConsumer
+
+
+class DummyListener(object):
+    """Stand-in for a SockJS connection that only counts sends."""
+
+    def __init__(self):
+        self.received = 0
+
+    def send(self, msg, trace=None):
+        self.received += 1
+        if trace is not None:
+            trace.mark_written()
+
+
+def make_messages(count, models=('coin', )):
+    privkey = bitjws.PrivateKey()
+    pubhash = bitjws.pubkey_to_addr(privkey.pubkey.serialize())
+    messages = []
+    for i in range(count):
+        data = {'method': 'RESPONSE', 'model': models[i % len(models)],
+                'id': i, 'pubhash': pubhash, 'headers': {},
+                'permissions': ['authenticate']}
+        messages.append(bitjws.sign_serialize(privkey, data=data,
+                                              iat=time.time()))
+    return messages
+
+
+async def run(consumer, messages):
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    remaining = [len(messages)]
+
+    def deliver(body):
+        consumer.on_message(None, None, None, body)
+        remaining[0] -= 1
+        if not remaining[0]:
+            done.set_result(None)
+
+    start = time.perf_counter()
+    for body in messages:
+        loop.call_soon(deliver, body)
+    await done
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--messages', type=int, default=2000)
+    parser.add_argument('-l', '--listeners', type=int, default=100)
+    parser.add_argument('--loop-policy', default=None,
+                        help="e.g. 'uvloop.EventLoopPolicy'")
+    parser.add_argument('--verbose', action='store_true',
+                        help='keep DEBUG logging of the consumer enabled')
+    args = parser.parse_args()
+
+    policy = install_event_loop_policy(args.loop_policy)
+    consumer = AsyncConsumer(pikaconfig)
+    if not args.verbose:
+        consumer._log.setLevel(logging.WARNING)
+
+    listeners = [DummyListener() for _ in range(args.listeners)]
+    for listener in listeners:
+        consumer.listener_add(listener, ['coin'])
+
+    messages = make_messages(args.messages)
+    elapsed = asyncio.run(run(consumer, messages))
+    delivered = sum(listener.received for listener in listeners)
+
+    print('python %s, loop policy %s' % (
+        platform.python_version(), type(policy).__name__))
+    print('%d messages, %d listeners, %d deliveries in %.3fs' % (
+        args.messages, args.listeners, delivered, elapsed))
+    print('%.1f msg/s, %.1f deliveries/s' % (
+        args.messages / elapsed, delivered / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Memory benchmark for sessions and subscriptions.
+
+Opens a number of idle sessions on the Connection class, then subscribes
+each of them to a number of items drawn from a shared pool of topics,
+and reports the traced memory per idle session and per subscription.
+Use it to size nodes for a given number of concurrent sockets.
+
+    python bench/bench_memory.py -c 100000 -s 5 -t 10000
+"""
+import os
+import sys
+import random
+import logging
+import argparse
+import tracemalloc
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+import pikaconfig
+from sockjs_server import Connection
+from sockjs_pika_consumer import AsyncConsumer, topic_key
+
+
+class DummySession(object):
+    """Stand-in for a sockjs session that discards everything sent."""
+    is_closed = False
+    handler = None
+
+    def send_message(self, msg, stats=True, binary=False):
+        pass
+
+
+class DummyInfo(object):
+    def __init__(self, ip):
+        self.ip = ip
+
+    def get_argument(self, name):
+        return None
+
+
+def traced():
+    return tracemalloc.get_traced_memory()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-c', '--connections', type=int, default=10000)
+    parser.add_argument('-s', '--subscriptions', type=int, default=5,
+                        help='subscriptions per connection')
+    parser.add_argument('-t', '--topics', type=int, default=1000,
+                        help='number of distinct items subscribed to')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('bench')
+    logger.setLevel(logging.WARNING)
+    consumer = AsyncConsumer(pikaconfig)
+    consumer._log.setLevel(logging.WARNING)
+    # Every session is opened at once, without pacing.
+    pikaconfig.SESSION_SETUP_RATE = None
+    Connection.configure(logger, consumer, pikaconfig)
+    session = DummySession()
+    rand = random.Random(0)
+
+    tracemalloc.start()
+    base = traced()
+    connections = []
+    for i in range(args.connections):
+        conn = Connection(session)
+        conn.on_open(DummyInfo('10.%d.%d.%d' % (
+            i >> 16 & 255, i >> 8 & 255, i & 255)))
+        connections.append(conn)
+    opened = traced()
+
+    for conn in connections:
+        topics = [topic_key({'model': 'coin', 'id': rand.randrange(args.topics)})
+                  for _ in range(args.subscriptions)]
+        consumer.listener_add(conn, topics)
+    subscribed = traced()
+    tracemalloc.stop()
+
+    subscriptions = sum(len(topics) for topics in consumer._listener.values())
+    print('%d sessions, %d subscriptions over %d topics' % (
+        args.connections, subscriptions, len(consumer._subscribers)))
+    print('%.1f bytes per idle session' % (
+        float(opened - base) / args.connections))
+    print('%.1f bytes per subscription' % (
+        float(subscribed - opened) / max(subscriptions, 1)))
+
+
+if __name__ == "__main__":
+    main()
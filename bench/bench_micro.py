@@ -0,0 +1,296 @@
+"""
+Microbenchmarks of the consumer and connection hot paths.
+
+Each case runs one function in isolation on synthetic signed messages,
+for a range of connection counts, subscriptions per connection and
+payload sizes, and reports the best time per call:
+
+    consumer.on_message     verify a message and fan it out to the
+                            connections subscribed to its item
+    consumer.listener_allowed
+    consumer.listener_add_delete
+                            subscribe a connection and drop it, next to
+                            the given number of connections
+    connection.on_message   handle a signed GET from a client
+    connection.on_open      set up a session
+
+Results can be saved as a baseline, and a later run compared to it,
+failing when a case got slower by more than --threshold percent. Compare
+runs made on the same machine and interpreter.
+
+    python bench/bench_micro.py --save bench/baseline.json
+    python bench/bench_micro.py --compare bench/baseline.json --threshold 10
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+import bitjws
+
+import pikaconfig
+from sockjs_server import Connection
+from sockjs_pika_consumer import AsyncConsumer, topic_key
+
+
+class DummySession(object):
+    """Stand-in for a sockjs session that discards everything sent."""
+    is_closed = False
+    handler = None
+
+    def send_message(self, msg, stats=True, binary=False):
+        pass
+
+
+class DummyInfo(object):
+    ip = '10.0.0.1'
+
+    def get_argument(self, name):
+        return None
+
+
+class DummyListener(object):
+    """Stand-in for a connection that only counts sends."""
+    __slots__ = ('received', )
+
+    def __init__(self):
+        self.received = 0
+
+    def send(self, msg, trace=None):
+        self.received += 1
+
+
+class Signer(object):
+    """Sign messages, each with a distinct seq so that none is a replay."""
+
+    def __init__(self):
+        self.privkey = bitjws.PrivateKey()
+        self.pubhash = bitjws.pubkey_to_addr(self.privkey.pubkey.serialize())
+        self.seq = 0
+
+    def sign(self, **data):
+        self.seq += 1
+        data['seq'] = self.seq
+        return bitjws.sign_serialize(self.privkey, data=data, iat=time.time())
+
+
+def make_consumer(connections, subscriptions, topics, rand):
+    """
+    Return a consumer with connections dummy listeners, each subscribed
+    to subscriptions items out of topics.
+    """
+    consumer = AsyncConsumer(pikaconfig)
+    consumer._log.setLevel(logging.WARNING)
+    for _ in range(connections):
+        consumer.listener_add(DummyListener(), [
+            topic_key({'model': 'coin', 'id': rand.randrange(topics)})
+            for _ in range(subscriptions)])
+    return consumer
+
+
+def best_time(run, states):
+    """
+    Return the best time per call of run(arg) over the states, each being
+    the list of arguments of one repeat.
+    """
+    best = None
+    for args in states:
+        start = time.perf_counter()
+        for arg in args:
+            run(arg)
+        elapsed = (time.perf_counter() - start) / len(args)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_consumer_on_message(args, signer, connections, payload, rand):
+    # Every connection is subscribed to item 0, the one messages are about.
+    consumer = make_consumer(0, 0, 1, rand)
+    for _ in range(connections):
+        consumer.listener_add(DummyListener(), [('coin', '0')])
+    number = max(10, min(args.number, 100000 // connections))
+    states = [[signer.sign(method='RESPONSE', model='coin', id=0,
+                           pubhash=signer.pubhash, mint='x' * payload)
+               .encode('utf-8') for _ in range(number)]
+              for _ in range(args.repeat)]
+    return best_time(lambda body: consumer.on_message(None, None, None, body),
+                     states)
+
+
+def bench_listener_allowed(args, signer, rand):
+    consumer = make_consumer(0, 0, 1, rand)
+    msg = signer.sign(method='GET', model='coin', id=1)
+    states = [[msg] * args.number for _ in range(args.repeat)]
+    return best_time(lambda msg: consumer.listener_allowed(None, msg), states)
+
+
+def bench_listener_add_delete(args, connections, subscriptions, rand):
+    consumer = make_consumer(connections, subscriptions, args.topics, rand)
+
+    def run(topics):
+        listener = DummyListener()
+        consumer.listener_add(listener, topics)
+        consumer.listener_delete(listener)
+
+    states = [[[topic_key({'model': 'coin',
+                           'id': rand.randrange(args.topics)})
+                for _ in range(subscriptions)]
+               for _ in range(args.number)]
+              for _ in range(args.repeat)]
+    return best_time(run, states)
+
+
+def setup_connections(rand):
+    consumer = make_consumer(0, 0, 1, rand)
+    logger = logging.getLogger('bench')
+    logger.setLevel(logging.WARNING)
+    Connection.configure(logger, consumer, pikaconfig)
+    return consumer
+
+
+def bench_connection_on_message(args, signer, connections, rand):
+    setup_connections(rand)
+    session = DummySession()
+    conns = []
+    for _ in range(connections):
+        conn = Connection(session)
+        conn.on_open(DummyInfo())
+        conns.append(conn)
+    number = min(args.number, 200)
+    states = [[(rand.choice(conns),
+                signer.sign(method='GET', model='coin',
+                            id=rand.randrange(args.topics)))
+               for _ in range(number)]
+              for _ in range(args.repeat)]
+    elapsed = best_time(lambda arg: arg[0].on_message(arg[1]), states)
+    for conn in conns:
+        conn.on_close()
+    return elapsed
+
+
+def bench_connection_on_open(args, rand):
+    setup_connections(rand)
+    session = DummySession()
+    info = DummyInfo()
+    best = None
+    for _ in range(args.repeat):
+        conns = [Connection(session) for _ in range(args.number)]
+        start = time.perf_counter()
+        for conn in conns:
+            conn.on_open(info)
+        elapsed = (time.perf_counter() - start) / args.number
+        if best is None or elapsed < best:
+            best = elapsed
+        for conn in conns:
+            conn.on_close()
+    return best
+
+
+def run_cases(args):
+    """Run the benchmarks and return the seconds per call by case name."""
+    rand = random.Random(0)
+    signer = Signer()
+    results = {}
+
+    def record(name, seconds):
+        results[name] = seconds
+        print('%-64s %12.2f us' % (name, seconds * 1e6))
+        sys.stdout.flush()
+
+    for connections in args.connections:
+        for payload in args.payloads:
+            record('consumer.on_message[connections=%d,payload=%d]' % (
+                connections, payload), bench_consumer_on_message(
+                    args, signer, connections, payload, rand))
+    record('consumer.listener_allowed', bench_listener_allowed(
+        args, signer, rand))
+    for connections in args.connections:
+        for subscriptions in args.subscriptions:
+            record('consumer.listener_add_delete[connections=%d,'
+                   'subscriptions=%d]' % (connections, subscriptions),
+                   bench_listener_add_delete(args, connections,
+                                             subscriptions, rand))
+    for connections in args.connections:
+        record('connection.on_message[connections=%d]' % connections,
+               bench_connection_on_message(args, signer, connections, rand))
+    record('connection.on_open', bench_connection_on_open(args, rand))
+    return results
+
+
+def compare(baseline, results, threshold):
+    """
+    Return the cases slower than in baseline by more than threshold
+    percent, as (name, baseline seconds, seconds, percent change) tuples.
+    """
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        before = baseline.get(name)
+        if not before:
+            continue
+        change = (seconds - before) / before * 100
+        if change > threshold:
+            regressions.append((name, before, seconds, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=1000,
+                        help='calls per repeat')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='repeats, the best one is reported')
+    parser.add_argument('--connections', type=int, nargs='+',
+                        default=[1, 100, 10000, 100000])
+    parser.add_argument('--subscriptions', type=int, nargs='+',
+                        default=[1, 10], help='subscriptions per connection')
+    parser.add_argument('--payloads', type=int, nargs='+',
+                        default=[100, 10000], help='bytes of filler')
+    parser.add_argument('--topics', type=int, default=10000,
+                        help='number of distinct items')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results to a baseline')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='percent slowdown reported as a regression')
+    args = parser.parse_args()
+
+    # Sessions are set up at once, and every message is admitted.
+    pikaconfig.SESSION_SETUP_RATE = None
+    pikaconfig.RATE_LIMIT_SESSION = None
+    pikaconfig.RATE_LIMIT_IP = None
+    pikaconfig.RATE_LIMIT_PUBHASH = None
+    pikaconfig.RESUME_SNAPSHOT = None
+
+    print('python %s %s' % (platform.python_implementation(),
+                            platform.python_version()))
+    results = run_cases(args)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'results': results}, f, indent=2, sort_keys=True)
+        print('baseline written to %s' % args.save)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(baseline, results, args.threshold)
+        for name, before, seconds, change in regressions:
+            print('REGRESSION %s: %.2f us -> %.2f us (%+.1f%%)' % (
+                name, before * 1e6, seconds * 1e6, change))
+        if regressions:
+            sys.exit(1)
+        print('no regression above %.0f%%' % args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Throughput benchmark for the publisher.
+
+Publishes pre-signed messages to the broker configured in pikaconfig,
+first one blocking basic_publish at a time like test/publisherDummy.py,
+then through publisher.Publisher with pipelined confirms and batching,
+and reports the messages confirmed per second for both.
+
+    python bench/bench_publisher.py -n 20000
+"""
+import os
+import sys
+import time
+import argparse
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+import pika
+import bitjws
+
+import pikaconfig
+from publisher import Publisher
+
+
+def make_messages(count, size):
+    privkey = bitjws.PrivateKey()
+    pubhash = bitjws.pubkey_to_addr(privkey.pubkey.serialize())
+    messages = []
+    for i in range(count):
+        data = {'method': 'RESPONSE', 'model': 'coin', 'id': i,
+                'pubhash': pubhash, 'headers': {},
+                'permissions': ['authenticate'], 'mint': 'x' * size}
+        messages.append(bitjws.sign_serialize(privkey, data=data,
+                                              iat=time.time()))
+    return messages
+
+
+def bench_blocking(messages):
+    connection = pika.BlockingConnection(
+        pika.URLParameters(pikaconfig.BROKER_URL))
+    channel = connection.channel()
+    channel.exchange_declare(**pikaconfig.EXCHANGE)
+    channel.confirm_delivery()
+    start = time.perf_counter()
+    for message in messages:
+        channel.basic_publish(exchange=pikaconfig.EXCHANGE['exchange'],
+                              routing_key='', body=message)
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return elapsed
+
+
+def bench_publisher(messages, max_in_flight, batch_size):
+    publisher = Publisher(pikaconfig, max_buffer=len(messages),
+                          max_in_flight=max_in_flight, batch_size=batch_size)
+    publisher.start()
+    start = time.perf_counter()
+    for message in messages:
+        publisher.publish(message)
+    publisher.flush()
+    elapsed = time.perf_counter() - start
+    publisher.stop()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--messages', type=int, default=10000)
+    parser.add_argument('-s', '--size', type=int, default=32,
+                        help='bytes of filler data per message')
+    parser.add_argument('--max-in-flight', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.size)
+    for name, elapsed in (
+            ('blocking, confirmed one by one', bench_blocking(messages)),
+            ('Publisher, pipelined confirms', bench_publisher(
+                messages, args.max_in_flight, args.batch_size))):
+        print('%-32s %8.1f msg/s (%.3fs)' % (
+            name, len(messages) / elapsed, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Soak test of the sockjs server, tracking memory growth per module.
+
+Runs the server in this process and simulated clients in another one,
+so that only the server's allocations are traced. Clients churn: they
+connect over raw or SockJS websockets, subscribe to a few items, stay
+for a random lifetime and disconnect, while a share of them are slow
+readers that never read from their socket. Signed messages about the
+items are fed to the consumer at a steady rate, as if they came from
+RabbitMQ.
+
+After a warmup, tracemalloc snapshots are taken periodically and the
+growth since the warmup is attributed to the modules that allocated it
+(sockjs_server, sockjs_pika_consumer, tornado, sockjs, logging, ...).
+The replay cache, the resume registry and the duplicate filter keep
+entries for IAT_WINDOW, RESUME_TTL and DEDUP_WINDOW seconds, so the
+warmup must be longer than those for their growth to level off.
+The run fails when the traced memory has grown since the warmup by more
+than --max-drift bytes per live session.
+
+    python bench/soak.py --duration 14400 --sessions 2000 --churn 20
+"""
+import os
+import sys
+import time
+import base64
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import collections
+import multiprocessing
+import tracemalloc
+
+BASE_DIR = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+import bitjws
+from tornado import iostream, websocket
+
+import pikaconfig
+import outbound
+
+
+def module_of(filename):
+    """
+    Return the module a traced allocation is attributed to: the module
+    name for files of this repo, the top level package for installed
+    packages and the standard library.
+
+    :param str filename: the file of the allocating frame
+    :rtype: str
+    """
+    path = os.path.abspath(filename)
+    parts = path.split(os.sep)
+    if os.path.dirname(path) == BASE_DIR:
+        name = parts[-1]
+    else:
+        for marker in ('site-packages', 'dist-packages'):
+            if marker in parts[:-1]:
+                name = parts[parts.index(marker) + 1]
+                break
+        else:
+            libs = [i for i, part in enumerate(parts[:-1])
+                    if part.startswith('python3')]
+            if not libs:
+                return '<%s>' % parts[-1]
+            name = parts[libs[-1] + 1]
+    return name[:-3] if name.endswith('.py') else name
+
+
+def growth_by_module(baseline, snapshot):
+    """
+    Return the bytes allocated since baseline, by module.
+
+    :param tracemalloc.Snapshot baseline: the earlier snapshot
+    :param tracemalloc.Snapshot snapshot: the later snapshot
+    :rtype: collections.Counter
+    """
+    growth = collections.Counter()
+    for stat in snapshot.compare_to(baseline, 'filename'):
+        growth[module_of(stat.traceback[0].filename)] += stat.size_diff
+    return growth
+
+
+def sign(privkey, data):
+    return bitjws.sign_serialize(privkey, data=data, iat=time.time())
+
+
+# Clients, run in a separate process.
+
+def masked_frame(text):
+    """Return a masked websocket text frame, as sent by clients."""
+    payload = text.encode('utf-8')
+    header = bytearray(outbound.websocket_header(outbound.OPCODE_TEXT,
+                                                 len(payload)))
+    header[1] |= 0x80
+    mask = os.urandom(4)
+    return bytes(header) + mask + bytes(
+        byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+
+class Clients(object):
+    """
+    Keep a number of sessions open, replacing them as they end.
+
+    :param int port: the port of the server
+    :param args: the parsed command line
+    :param multiprocessing.Value live: the number of open sessions
+    """
+
+    def __init__(self, port, args, live):
+        self.port = port
+        self.args = args
+        self.live = live
+        self.rand = random.Random(args.seed)
+        self.keys = [bitjws.PrivateKey() for _ in range(args.keys)]
+        self.tasks = set()
+
+    def subscriptions(self):
+        key = self.rand.choice(self.keys)
+        return [sign(key, {'method': 'GET', 'model': 'coin',
+                           'id': self.rand.randrange(self.args.topics)})
+                for _ in range(self.args.subscriptions)]
+
+    async def reader(self, lifetime):
+        if self.rand.random() < self.args.sockjs:
+            url = 'ws://127.0.0.1:%d/000/%08x/websocket' % (
+                self.port, self.rand.getrandbits(32))
+            wrap = lambda msg: '["%s"]' % msg
+        else:
+            url = 'ws://127.0.0.1:%d/websocket' % self.port
+            wrap = lambda msg: msg
+        conn = await websocket.websocket_connect(url)
+        try:
+            await conn.read_message()
+            for msg in self.subscriptions():
+                await conn.write_message(wrap(msg))
+            deadline = time.monotonic() + lifetime
+            while time.monotonic() < deadline:
+                try:
+                    msg = await asyncio.wait_for(
+                        conn.read_message(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    break
+                if msg is None:
+                    break
+        finally:
+            conn.close()
+
+    async def slow_reader(self, lifetime):
+        stream = iostream.IOStream(socket.socket())
+        await stream.connect(('127.0.0.1', self.port))
+        try:
+            key = base64.b64encode(os.urandom(16)).decode('ascii')
+            await stream.write((
+                'GET /websocket HTTP/1.1\r\nHost: 127.0.0.1:%d\r\n'
+                'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                'Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n'
+                % (self.port, key)).encode('ascii'))
+            await stream.read_until(b'\r\n\r\n')
+            for msg in self.subscriptions():
+                await stream.write(masked_frame(msg))
+            # Never read anything else, so that the server backs up.
+            await asyncio.sleep(lifetime)
+        finally:
+            stream.close()
+
+    async def session(self):
+        lifetime = self.rand.expovariate(1.0 / self.args.lifetime)
+        with self.live.get_lock():
+            self.live.value += 1
+        try:
+            if self.rand.random() < self.args.slow_readers:
+                await self.slow_reader(lifetime)
+            else:
+                await self.reader(lifetime)
+        except Exception:
+            pass
+        finally:
+            with self.live.get_lock():
+                self.live.value -= 1
+
+    async def run(self):
+        tick = 0.1
+        while True:
+            budget = max(1, int(self.args.churn * tick))
+            while len(self.tasks) < self.args.sessions and budget:
+                task = asyncio.ensure_future(self.session())
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                budget -= 1
+            await asyncio.sleep(tick)
+
+
+def run_clients(port, args, live):
+    asyncio.run(Clients(port, args, live).run())
+
+
+# Server side.
+
+async def publish(consumer, args):
+    """Feed signed messages about random items to the consumer."""
+    privkey = bitjws.PrivateKey()
+    pubhash = bitjws.pubkey_to_addr(privkey.pubkey.serialize())
+    rand = random.Random(args.seed + 1)
+    tick = 0.1
+    while True:
+        for _ in range(max(1, int(args.rate * tick))):
+            body = sign(privkey, {
+                'method': 'RESPONSE', 'model': 'coin',
+                'id': rand.randrange(args.topics), 'pubhash': pubhash,
+                'mint': 'x' * args.payload})
+            consumer.on_message(None, None, None, body.encode('utf-8'))
+        await asyncio.sleep(tick)
+
+
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__), ))
+
+
+def report(elapsed, live, traced, per_session, drift, growth, top):
+    print('[%7.0fs] %d sessions, %.1f MB traced, %.0f bytes/session, '
+          '%+.0f bytes/session since warmup, growth: %s' % (
+              elapsed, live, traced / 1e6, per_session, drift,
+              ', '.join('%s %+.1f KB' % (name, size / 1e3)
+                        for name, size in growth.most_common(top))))
+    sys.stdout.flush()
+
+
+async def soak(args, live):
+    # Imported here so that the client process doesn't set up a server.
+    from sockjs_server import make_app, Connection
+
+    app = make_app()
+    app.listen(args.port, '127.0.0.1')
+    for name in ('api-stream', 'api-stream_consumer'):
+        logging.getLogger(name).setLevel(args.log_level)
+    publisher = asyncio.ensure_future(publish(Connection.consumer, args))
+
+    start = time.monotonic()
+    await asyncio.sleep(args.warmup)
+    baseline = take_snapshot()
+    base_traced = tracemalloc.get_traced_memory()[0]
+    base_per_session = base_traced / max(live.value, 1)
+    print('warmup done: %d sessions, %.1f MB traced, %.0f bytes/session' % (
+        live.value, base_traced / 1e6, base_per_session))
+
+    drift = 0
+    growth = collections.Counter()
+    while time.monotonic() - start < args.duration:
+        await asyncio.sleep(args.interval)
+        snapshot = take_snapshot()
+        traced = tracemalloc.get_traced_memory()[0]
+        sessions = max(live.value, 1)
+        drift = (traced - base_traced) / sessions
+        growth = growth_by_module(baseline, snapshot)
+        report(time.monotonic() - start, live.value, traced,
+               traced / sessions, drift, growth, args.top)
+    publisher.cancel()
+    return drift, growth
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--duration', type=float, default=7200,
+                        help='seconds to run, warmup included')
+    parser.add_argument('--warmup', type=float, default=900,
+                        help='seconds before the baseline snapshot')
+    parser.add_argument('--interval', type=float, default=60,
+                        help='seconds between snapshots')
+    parser.add_argument('--sessions', type=int, default=1000,
+                        help='concurrent sessions')
+    parser.add_argument('--churn', type=float, default=20,
+                        help='new sessions per second at most')
+    parser.add_argument('--lifetime', type=float, default=60,
+                        help='mean session lifetime in seconds')
+    parser.add_argument('--slow-readers', type=float, default=0.05,
+                        help='share of sessions that never read')
+    parser.add_argument('--sockjs', type=float, default=0.5,
+                        help='share of readers using the SockJS transport')
+    parser.add_argument('--subscriptions', type=int, default=3,
+                        help='subscriptions per session')
+    parser.add_argument('--topics', type=int, default=1000,
+                        help='number of distinct items')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='messages published per second')
+    parser.add_argument('--payload', type=int, default=200,
+                        help='bytes of filler per message')
+    parser.add_argument('--keys', type=int, default=100,
+                        help='client keys the subscriptions are signed with')
+    parser.add_argument('--max-drift', type=float, default=1024,
+                        help='bytes per session of growth that fail the run')
+    parser.add_argument('--top', type=int, default=6,
+                        help='modules listed per snapshot')
+    parser.add_argument('--port', type=int, default=8124)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    # All the clients connect from 127.0.0.1 with a few keys.
+    pikaconfig.RATE_LIMIT_IP = None
+    pikaconfig.RATE_LIMIT_PUBHASH = None
+    pikaconfig.RESUME_SNAPSHOT = None
+
+    context = multiprocessing.get_context('spawn')
+    live = context.Value('i', 0)
+    clients = context.Process(
+        target=run_clients, args=(args.port, args, live), daemon=True)
+    tracemalloc.start()
+    clients.start()
+    try:
+        drift, growth = asyncio.run(soak(args, live))
+    finally:
+        clients.terminate()
+
+    print('growth since warmup by module:')
+    for name, size in growth.most_common():
+        print('  %-28s %+12d bytes' % (name, size))
+    if drift > args.max_drift:
+        print('FAIL: memory per session drifted by %.0f bytes (max %.0f)' % (
+            drift, args.max_drift))
+        sys.exit(1)
+    print('OK: memory per session drifted by %.0f bytes (max %.0f)' % (
+        drift, args.max_drift))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Suppression of duplicate messages from several publishers.
+
+With more than one publisher, e.g. in HA setups, the same signed update
+can reach the fanout exchange twice. Consumers drop the copies of any
+message already verified in the last DEDUP_WINDOW to 2 * DEDUP_WINDOW
+seconds, before spending time on their signature.
+
+Messages are keyed like replays (see replay.replay_key): by their jti if
+they have one, otherwise by their signed header and payload.
+
+Keys are kept in two generations, the current one and the previous one,
+each covering DEDUP_WINDOW seconds. A generation remembers its keys in
+an exact set, up to DEDUP_EXACT_MAX of them, and in a Bloom filter sized
+for DEDUP_CAPACITY keys. As long as all the keys of a generation fit in
+its exact set, the set answers; past that, its Bloom filter does, and a
+new message may be taken for a duplicate with a probability of about
+DEDUP_ERROR_RATE. Either way, memory is bounded.
+"""
+import math
+import time
+
+import metrics
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter of 16 byte keys, e.g. replay keys.
+
+    :param int capacity: number of keys expected
+    :param float error_rate: false positive rate at capacity
+    """
+    __slots__ = ('size', 'hashes', 'bits')
+
+    def __init__(self, capacity, error_rate=1e-4):
+        self.size = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # The keys are already hashes: two halves of one make enough
+        # independent positions (Kirsch-Mitzenmacher).
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:16], 'little') | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class _Generation(object):
+    __slots__ = ('started', 'keys', 'complete', 'bloom')
+
+    def __init__(self, started, capacity, error_rate):
+        self.started = started
+        self.keys = set()
+        self.complete = True
+        self.bloom = BloomFilter(capacity, error_rate)
+
+    def __contains__(self, key):
+        if self.complete:
+            return key in self.keys
+        if key in self.keys:
+            return True
+        if key in self.bloom:
+            metrics.incr('dedup.bloom_hits')
+            return True
+        return False
+
+
+class DuplicateFilter(object):
+    """
+    A time windowed set of message keys with bounded memory.
+
+    :param float window: seconds covered by each of the two generations
+    :param int capacity: keys per generation the Bloom filters are sized for
+    :param float error_rate: false positive rate of the Bloom filters
+    :param int exact_max: keys per generation kept in the exact set
+    """
+
+    def __init__(self, window=10, capacity=100000, error_rate=1e-4,
+                 exact_max=10000):
+        self.window = window
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.exact_max = exact_max
+        self._current = None
+        self._previous = None
+
+    def _rotate(self, now):
+        current = self._current
+        if current is not None and now - current.started < self.window:
+            return current
+        if current is not None and now - current.started < 2 * self.window:
+            self._previous = current
+        else:
+            self._previous = None
+        current = self._current = _Generation(now, self.capacity,
+                                              self.error_rate)
+        return current
+
+    def seen(self, key, now=None):
+        """
+        Return True if key was added in the current or previous window.
+
+        :param bytes key: see replay.replay_key
+        :rtype: bool
+        """
+        current = self._rotate(time.monotonic() if now is None else now)
+        if key in current or (self._previous is not None and
+                              key in self._previous):
+            metrics.incr('dedup.duplicates')
+            return True
+        return False
+
+    def add(self, key, now=None):
+        """
+        Remember a key for the current window.
+
+        :param bytes key: see replay.replay_key
+        """
+        current = self._rotate(time.monotonic() if now is None else now)
+        current.bloom.add(key)
+        if current.complete:
+            if len(current.keys) < self.exact_max:
+                current.keys.add(key)
+            else:
+                # The exact set no longer holds every key of the window.
+                current.complete = False
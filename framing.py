@@ -0,0 +1,141 @@
+"""
+Binary framing for raw websocket clients.
+
+SockJS transports carry text, so by default server frames are JSON and
+messages are the compact serialized JWS. Clients of the raw websocket
+endpoint can instead ask for a binary encoding by connecting to
+/websocket?encoding=msgpack (or cbor). Server frames are then encoded
+with that codec, and every message is wrapped in an envelope carrying
+the signed JWS as raw bytes:
+
+    {"jws": <bytes>}
+
+Clients may send their messages the same way or as text.
+
+Codecs are available when their optional dependency, msgpack or cbor2,
+is installed. A client asking for an unavailable codec gets text frames.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class Codec(object):
+    """
+    A binary encoding of frames.
+
+    :param str name: the name clients ask for
+    :param callable dumps: encode an object to bytes
+    :param callable loads: decode bytes to an object
+    :param int map_type: the header byte of an empty map, or'ed with the
+        number of entries for maps of up to 15 entries
+    """
+    __slots__ = ('name', 'dumps', 'loads', 'map_type', '_last_body',
+                 '_last_envelope')
+
+    def __init__(self, name, dumps, loads, map_type):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        self.map_type = map_type
+        self._last_body = None
+        self._last_envelope = None
+
+    def encode_map(self, items, raw=()):
+        """
+        Encode a map from (key, value) items, followed by (key, bytes)
+        items whose values are already encoded.
+
+        :rtype: bytes
+        """
+        size = len(items) + len(raw)
+        if size > 15:
+            raise ValueError('too many entries')
+        dumps = self.dumps
+        parts = [bytes((self.map_type | size, ))]
+        for key, value in items:
+            parts.append(dumps(key))
+            parts.append(dumps(value))
+        for key, encoded in raw:
+            parts.append(dumps(key))
+            parts.append(encoded)
+        return b''.join(parts)
+
+    def envelope(self, body):
+        """
+        Return the envelope of a message.
+
+        A message is sent to all its subscribers in a row, so the last
+        envelope is kept and reused while the same body is sent.
+
+        :param str body: the compact serialized JWS
+        :rtype: bytes
+        """
+        if body is not self._last_body:
+            self._last_envelope = self.dumps({'jws': body.encode('ascii')})
+            self._last_body = body
+        return self._last_envelope
+
+    def open_envelope(self, data):
+        """
+        Return the JWS of an envelope sent by a client.
+
+        :param bytes data: the binary frame
+        :rtype: str
+        :raises ValueError: if data is not a valid envelope
+        """
+        try:
+            jws = self.loads(data)['jws']
+            return jws.decode('ascii')
+        except Exception as e:
+            raise ValueError('invalid envelope: %r' % e)
+
+
+CODECS = {}
+if msgpack is not None:
+    CODECS['msgpack'] = Codec('msgpack', msgpack.packb,
+                              lambda data: msgpack.unpackb(data, raw=False),
+                              0x80)
+if cbor2 is not None:
+    CODECS['cbor'] = Codec('cbor', cbor2.dumps, cbor2.loads, 0xa0)
+
+
+def get_codec(name):
+    """
+    Return the codec called name, or None if it is not available.
+
+    :rtype: Codec|None
+    """
+    return CODECS.get(name)
+
+
+class StaticFrame(object):
+    """
+    A constant server frame, encoded once per codec.
+
+    :param dict frame: the frame
+    """
+    __slots__ = ('frame', '_encoded')
+
+    def __init__(self, frame):
+        self.frame = frame
+        self._encoded = {None: json.dumps(frame)}
+
+    def encode(self, codec=None):
+        """
+        Return the frame encoded with codec, or as JSON text.
+
+        :rtype: str|bytes
+        """
+        encoded = self._encoded.get(codec)
+        if encoded is None:
+            encoded = self._encoded[codec] = codec.dumps(self.frame)
+        return encoded
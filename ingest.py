@@ -0,0 +1,274 @@
+"""
+Per-host ingest process.
+
+When several sockjs_server workers run on the same host, each of them
+would otherwise open its own AMQP connection and exclusive queue, so the
+broker delivers every message once per worker and each copy is verified
+once per worker. Instead a single ingest process consumes and verifies
+messages and forwards the verified ones to the local workers over a Unix
+socket. Broker fan-out and verification then scale with hosts, not with
+workers.
+
+Run it next to the workers, with INGEST_SOCKET set in pikaconfig:
+
+    python ingest.py
+
+Frames on the socket are the message bodies prefixed by their length as
+a 4 byte big endian integer.
+
+With topic sharding (see sharding.py) one ingest process runs per shard:
+
+    python ingest.py --shard N
+"""
+import socket
+import struct
+import asyncio
+import argparse
+
+from tornado import ioloop
+from tornado.iostream import IOStream, StreamClosedError, StreamBufferFullError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+
+import metrics
+import outbound
+import pikaconfig
+from util import install_event_loop_policy
+from precheck import precheck, MalformedToken
+from sockjs_pika_consumer import AsyncConsumer
+from sharding import shard_routing_key, shards_for_subscription
+
+FRAME_HEADER = struct.Struct('!I')
+
+# Seconds between attempts of a worker to reach the ingest socket.
+RECONNECT_DELAY = 1
+
+
+def encode_frame(body):
+    """
+    Frame a message body for the ingest socket.
+
+    :param str|bytes body: the message body
+    :rtype: bytes
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+class IngestConsumer(AsyncConsumer):
+    """
+    A consumer that forwards every verified message to the connected
+    workers instead of sending it to sessions.
+    """
+
+    def __init__(self, config, ioloop_instance=None):
+        super(IngestConsumer, self).__init__(config, ioloop_instance)
+        self._workers = set()
+        # Workers keep the history, the ingest process only forwards.
+        self.history = None
+
+    def add_worker(self, stream):
+        self._log.info('Worker connected, %d in total' % (
+            len(self._workers) + 1))
+        self._workers.add(stream)
+        stream.set_close_callback(lambda: self.remove_worker(stream))
+
+    def remove_worker(self, stream):
+        if stream in self._workers:
+            self._workers.discard(stream)
+            self._log.info('Worker disconnected, %d left' % len(self._workers))
+
+    def has_subscribers(self, key):
+        # Workers filter by topic themselves.
+        return bool(self._workers)
+
+    def dispatch(self, payload_data, body, trace=None):
+        if trace is not None:
+            # The broker and verify latencies are recorded here, the
+            # workers record the write latencies.
+            trace.mark_fanout(payload_data['model'], len(self._workers))
+            self.tracer.finish(trace)
+        # The header and the shared body are written separately, so that
+        # large bodies are not copied once per worker.
+        payload = outbound.message_for(body).utf8
+        header = FRAME_HEADER.pack(len(payload))
+        for stream in list(self._workers):
+            try:
+                stream.write(header)
+                stream.write(payload)
+            except (StreamClosedError, StreamBufferFullError) as e:
+                # A worker too slow to keep up is dropped, it reconnects
+                # and resumes with the next messages.
+                metrics.incr('ingest.worker_dropped')
+                self._log.warning('Dropping worker: %r' % e)
+                self.remove_worker(stream)
+                stream.close()
+        metrics.incr('ingest.forwarded')
+
+
+class ShardConsumer(IngestConsumer):
+    """
+    An ingest consumer reading the messages of a single shard from
+    SHARD_EXCHANGE.
+
+    :param int shard: the shard number
+    """
+    EXCHANGE = pikaconfig.SHARD_EXCHANGE['exchange']
+    EXCHANGE_TYPE = pikaconfig.SHARD_EXCHANGE['exchange_type']
+
+    def __init__(self, config, shard, ioloop_instance=None):
+        super(ShardConsumer, self).__init__(config, ioloop_instance)
+        self.ROUTING_KEY = shard_routing_key(shard)
+
+
+class IngestServer(TCPServer):
+    """
+    Accept worker connections on the ingest socket.
+
+    :param IngestConsumer consumer: the consumer forwarding messages
+    :param int max_buffer_size: bytes buffered per worker before dropping it
+    """
+
+    def __init__(self, consumer, max_buffer_size=64 * 1024 * 1024):
+        super(IngestServer, self).__init__()
+        self.consumer = consumer
+        self.max_buffer_size = max_buffer_size
+
+    def handle_stream(self, stream, address):
+        stream.max_write_buffer_size = self.max_buffer_size
+        self.consumer.add_worker(stream)
+
+
+class IngestClient(object):
+    """
+    Read verified messages from the ingest socket and dispatch them to
+    the sessions of a worker.
+
+    Messages were verified by the ingest process, so only their payload
+    is decoded here to find the listeners.
+
+    :param str path: path of the ingest socket
+    :param AsyncConsumer consumer: the worker consumer
+    """
+
+    def __init__(self, path, consumer):
+        self.path = path
+        self.consumer = consumer
+        self._log = consumer._log
+        self._stream = None
+        self._stopped = False
+
+    def start(self, io_loop=None):
+        """Connect to the ingest socket and keep reading from it."""
+        (io_loop or ioloop.IOLoop.current()).spawn_callback(self.run)
+
+    def stop(self):
+        """Disconnect from the ingest socket."""
+        self._stopped = True
+        if self._stream is not None:
+            self._stream.close()
+
+    async def run(self):
+        while not self._stopped:
+            stream = self._stream = IOStream(
+                socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            try:
+                await stream.connect(self.path)
+                self._log.info('Connected to ingest socket %s' % self.path)
+                while True:
+                    if self.consumer.paused:
+                        # Load shedding, frames wait in the socket.
+                        await self.consumer.wait_resumed()
+                    header = await stream.read_bytes(FRAME_HEADER.size)
+                    body = await stream.read_bytes(FRAME_HEADER.unpack(header)[0])
+                    self.deliver(body)
+            except (StreamClosedError, OSError) as e:
+                if self._stopped:
+                    break
+                self._log.warning('Ingest socket %s unavailable, retrying in '
+                                  '%s seconds: %r' % (self.path,
+                                                      RECONNECT_DELAY, e))
+            finally:
+                stream.close()
+            await asyncio.sleep(RECONNECT_DELAY)
+        self._log.info('Disconnected from ingest socket %s' % self.path)
+
+    def deliver(self, body):
+        tracer = self.consumer.tracer
+        trace = tracer.start() if tracer is not None else None
+        raw, body = body, body.decode('utf-8')
+        outbound.prime(body, raw)
+        try:
+            payload = precheck(body, required=('model', ), iat_window=None)[1]
+        except MalformedToken as e:
+            self._log.info('Dropping malformed ingest frame: %s' % e)
+            return
+        if trace is not None:
+            trace.mark_verified(payload.get('iat'))
+        self.consumer.dispatch(payload['data'], body, trace)
+
+
+class ShardedIngestClient(object):
+    """
+    Read from the shards holding the topics subscribed to by the sessions
+    of a worker, and only from those.
+
+    A connection to a shard is opened when the first topic it holds gets a
+    subscriber and closed when the last one goes away.
+
+    :param str path_template: path of the shard sockets, with a %d for
+        the shard number
+    :param int shard_count: number of shards
+    :param AsyncConsumer consumer: the worker consumer
+    """
+
+    def __init__(self, path_template, shard_count, consumer):
+        self.path_template = path_template
+        self.shard_count = shard_count
+        self.consumer = consumer
+        self._io_loop = None
+        self._topics_per_shard = [0] * shard_count
+        self._clients = {}
+
+    def start(self, io_loop=None):
+        """Follow the subscriptions of the consumer."""
+        self._io_loop = io_loop or ioloop.IOLoop.current()
+        self.consumer.add_on_topic_callback(self.on_topic)
+
+    def on_topic(self, topic, added):
+        for shard in shards_for_subscription(topic, self.shard_count):
+            if added:
+                self._topics_per_shard[shard] += 1
+                if shard not in self._clients:
+                    client = IngestClient(self.path_template % shard,
+                                          self.consumer)
+                    self._clients[shard] = client
+                    client.start(self._io_loop)
+            else:
+                self._topics_per_shard[shard] -= 1
+                if not self._topics_per_shard[shard]:
+                    self._clients.pop(shard).stop()
+
+
+async def main(shard=None):
+    max_buffer = getattr(pikaconfig, 'INGEST_MAX_BUFFER', 64 * 1024 * 1024)
+    if shard is None:
+        consumer = IngestConsumer(pikaconfig, ioloop.IOLoop.current())
+        path = pikaconfig.INGEST_SOCKET
+    else:
+        consumer = ShardConsumer(pikaconfig, shard, ioloop.IOLoop.current())
+        path = pikaconfig.SHARD_SOCKET % shard
+    server = IngestServer(consumer, max_buffer)
+    server.add_socket(bind_unix_socket(path))
+    consumer.setup()
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-host ingest process.')
+    parser.add_argument('--shard', type=int, default=None,
+                        help='consume the given shard of SHARD_EXCHANGE')
+    args = parser.parse_args()
+    install_event_loop_policy(getattr(pikaconfig, 'EVENT_LOOP_POLICY', None))
+    asyncio.run(main(args.shard))
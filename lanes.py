@@ -0,0 +1,91 @@
+"""
+Priority lanes for the outbound messages of a session.
+
+Control frames (open, pong, errors) and data messages are queued in two
+separate lanes. Control frames always go first, and data messages are
+only handed to the transport while it isn't backed up, so a session
+flooded with data still gets its control frames right away instead of
+behind the backlog. The time each message spends in its lane is
+recorded in the 'lanes.control.wait' and 'lanes.data.wait' histograms,
+and the latency trace of a data message, if any, is marked written when
+the message leaves its lane.
+"""
+import time
+from collections import deque
+
+import metrics
+
+
+class PriorityLanes(object):
+    """
+    A control lane and a bounded data lane.
+
+    When the data lane is full the oldest data message is dropped and
+    counted in 'lanes.data.dropped'.
+
+    :param int max_data: maximum number of queued data messages
+    """
+    __slots__ = ('control', 'data', 'max_data')
+
+    def __init__(self, max_data=1000):
+        self.control = deque()
+        self.data = deque()
+        self.max_data = max_data
+
+    def __len__(self):
+        return len(self.control) + len(self.data)
+
+    def push(self, msg, control=False, now=None, trace=None):
+        """
+        Queue a message in the control or the data lane.
+
+        :param MessageTrace trace: the latency trace of a data message
+        :rtype: bool
+        :returns: True if the oldest data message was dropped to make room
+        """
+        if now is None:
+            now = time.monotonic()
+        if control:
+            self.control.append((now, msg))
+            return False
+        dropped = len(self.data) >= self.max_data
+        if dropped:
+            self.data.popleft()
+            metrics.incr('lanes.data.dropped')
+        self.data.append((now, msg, trace))
+        return dropped
+
+    def clear(self):
+        self.control.clear()
+        self.data.clear()
+
+    def drain(self, write, writable, batch=100, now=None, write_data=None):
+        """
+        Write every control frame, then data messages while the transport
+        is writable, at most batch of them.
+
+        :param callable write: write(msg) hands a message to the transport
+        :param callable writable: writable() tells if the transport can
+            take more data
+        :param int batch: maximum number of data messages written
+        :param callable write_data: write_data(msg) hands a data message to
+            the transport, write by default
+        :rtype: bool
+        :returns: True if data messages are left in the lane
+        """
+        if now is None:
+            now = time.monotonic()
+        if write_data is None:
+            write_data = write
+        while self.control:
+            queued_at, msg = self.control.popleft()
+            metrics.observe('lanes.control.wait', now - queued_at)
+            write(msg)
+        while self.data and batch and writable():
+            queued_at, msg, trace = self.data.popleft()
+            metrics.observe('lanes.data.wait', now - queued_at)
+            write_data(msg)
+            if trace is not None:
+                trace.mark_written()
+            batch -= 1
+        return bool(self.data)
@@ -0,0 +1,107 @@
+"""
+IOLoop lag watchdog and graded load shedding.
+
+Everything the sockjs server does runs on a single IOLoop, so when it is
+saturated every callback starts late. The watchdog schedules itself
+every LAG_CHECK_INTERVAL seconds and measures how late it runs, which is
+the time any callback currently waits for its turn. The lag is recorded
+in the 'watchdog.lag' histogram.
+
+The smoothed lag is mapped to a load level. Each level of
+LOAD_SHED_LEVELS has an enter and an exit threshold. The level goes up
+as soon as the lag reaches the enter threshold of a higher level. It
+goes down one level at a time, once the lag has stayed below the exit
+threshold of the current level for LOAD_SHED_HOLD seconds. The gap
+between the thresholds and the hold time keep the level from flapping.
+The sockjs server sheds load progressively from level 1 to 3, see
+SockJSPikaRouter.on_load_level.
+"""
+import time
+
+from tornado import ioloop
+
+import metrics
+
+
+class LagWatchdog(object):
+    """
+    Measure the IOLoop lag and follow the load level.
+
+    :param tuple levels: (enter, exit) lag thresholds in seconds, one per
+        level from 1 up, each exit lower than its enter
+    :param callable callback: called as callback(level, lag) when the
+        level changes
+    :param float interval: seconds between two lag measures
+    :param float hold: seconds the lag must stay below the exit threshold
+        of a level before going down
+    :param float smoothing: weight of the latest measure in the smoothed
+        lag, between 0 and 1
+    """
+
+    def __init__(self, levels, callback, interval=0.1, hold=5,
+                 smoothing=0.3, io_loop=None):
+        self.levels = tuple(levels)
+        self.callback = callback
+        self.interval = interval
+        self.hold = hold
+        self.smoothing = smoothing
+        self.level = 0
+        self.lag = 0.0
+        self._io_loop = io_loop
+        self._expected = None
+        self._calm_since = None
+        self._timeout = None
+
+    def start(self):
+        io_loop = self._io_loop or ioloop.IOLoop.current()
+        self._io_loop = io_loop
+        self._schedule(time.monotonic())
+
+    def stop(self):
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self, now):
+        self._expected = now + self.interval
+        self._timeout = self._io_loop.call_later(self.interval, self._check)
+
+    def _check(self):
+        now = time.monotonic()
+        lag = max(now - self._expected, 0.0)
+        metrics.observe('watchdog.lag', lag)
+        self.update(lag, now)
+        self._schedule(now)
+
+    def update(self, lag, now=None):
+        """
+        Account for a lag measure and change the level if needed.
+
+        :param float lag: the measured lag, in seconds
+        :rtype: int
+        :returns: the load level
+        """
+        if now is None:
+            now = time.monotonic()
+        self.lag += self.smoothing * (lag - self.lag)
+
+        level = self.level
+        while level < len(self.levels) and self.lag >= self.levels[level][0]:
+            level += 1
+        if level > self.level:
+            self._calm_since = None
+            self._set_level(level)
+        elif self.level and self.lag < self.levels[self.level - 1][1]:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.hold:
+                self._calm_since = now
+                self._set_level(self.level - 1)
+        else:
+            self._calm_since = None
+        return self.level
+
+    def _set_level(self, level):
+        self.level = level
+        metrics.incr('watchdog.level.%d' % level)
+        self.callback(level, self.lag)
@@ -0,0 +1,107 @@
+"""
+In-process counters and histograms for the sockjs server and the pika
+consumer.
+
+Counters are plain integers keyed by a dotted name, cheap enough to be
+bumped on every message. Histograms count observed durations in fixed
+buckets. Use snapshot() to export both.
+"""
+import bisect
+from collections import defaultdict
+
+# Upper bounds, in seconds, of the histogram buckets. A last bucket
+# counts everything above the largest bound.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    """Count, sum, maximum and bucketed counts of observed values."""
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+
+    def quantile(self, q):
+        """
+        Return the upper bound of the bucket holding the q quantile, or
+        the maximum if it falls in the last bucket.
+
+        :param float q: the quantile, between 0 and 1
+        :rtype: float
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.total, 'max': self.max,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'buckets': list(self.buckets)}
+
+
+_counters = defaultdict(int)
+_histograms = defaultdict(Histogram)
+
+
+def incr(name, value=1):
+    """
+    Increment the counter called name.
+
+    :param str name: dotted counter name, e.g. 'admission.rejected.ip'
+    :param int value: amount to add
+    """
+    _counters[name] += value
+
+
+def get(name):
+    """Return the current value of the counter called name."""
+    return _counters.get(name, 0)
+
+
+def observe(name, value):
+    """
+    Record a value, usually a duration in seconds, in the histogram
+    called name.
+
+    :param str name: dotted histogram name, e.g. 'lanes.data.wait'
+    :param float value: the observed value
+    """
+    _histograms[name].observe(value)
+
+
+def histogram(name):
+    """Return the histogram called name, or None if nothing was observed."""
+    return _histograms.get(name)
+
+
+def snapshot():
+    """
+    Return a copy of all counters and a summary of all histograms.
+
+    :rtype: dict
+    """
+    result = dict(_counters)
+    for name, hist in _histograms.items():
+        result[name] = hist.summary()
+    return result
+
+
+def reset():
+    """Reset all counters and histograms."""
+    _counters.clear()
+    _histograms.clear()
@@ -0,0 +1,131 @@
+"""
+Shared wire encodings of outbound messages.
+
+A message is sent to every subscriber in a row, and most of them use
+websockets. Rather than letting each session encode the body to UTF-8,
+wrap it in a SockJS frame and copy it behind a websocket header, the
+encodings are built once per message, and each session writes the
+websocket header and the shared payload to its stream as two separate
+buffers. Tornado keeps a reference to large buffers instead of copying
+them, so a large message is no longer copied once per subscriber.
+
+The bytes delivered by pika, or read from the ingest socket, are kept
+and used as the UTF-8 payload, so that the body is not encoded again.
+
+Allocations are counted in the 'outbound.messages' (messages seen),
+'outbound.encoded' (UTF-8 encodings made) and 'outbound.sockjs_frames'
+(SockJS frames built) counters. Session writes are counted in
+'outbound.shared_writes' and 'outbound.fallback_writes'.
+"""
+import json
+import struct
+from functools import lru_cache
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+
+import metrics
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+_FIN = 0x80
+
+
+class OutboundMessage(object):
+    """
+    A message body and its wire encodings, built on first use.
+
+    :param str text: the compact serialized JWS
+    :param bytes raw: the body as received, if it was received as bytes
+    """
+    __slots__ = ('text', '_utf8', '_sockjs')
+
+    def __init__(self, text, raw=None):
+        self.text = text
+        self._utf8 = raw
+        self._sockjs = None
+        metrics.incr('outbound.messages')
+
+    @property
+    def utf8(self):
+        """The UTF-8 encoded body."""
+        if self._utf8 is None:
+            self._utf8 = self.text.encode('utf-8')
+            metrics.incr('outbound.encoded')
+        return self._utf8
+
+    @property
+    def sockjs_frame(self):
+        """The SockJS frame carrying the body, 'a["<body>"]'."""
+        if self._sockjs is None:
+            self._sockjs = b''.join((b'a[', json.dumps(self.text).encode('utf-8'),
+                                     b']'))
+            metrics.incr('outbound.sockjs_frames')
+        return self._sockjs
+
+
+_current = None
+
+
+def prime(text, raw=None):
+    """
+    Record the message about to be fanned out, with its received bytes.
+
+    :param str text: the body, as passed to dispatch
+    :param bytes raw: the body as received
+    """
+    global _current
+    _current = OutboundMessage(text, raw)
+
+
+def message_for(text):
+    """
+    Return the OutboundMessage of a body. The last one is reused as long
+    as the same body object is sent.
+
+    :rtype: OutboundMessage
+    """
+    global _current
+    if _current is None or _current.text is not text:
+        _current = OutboundMessage(text)
+    return _current
+
+
+@lru_cache(maxsize=4096)
+def websocket_header(opcode, length):
+    """Return the header of an unmasked, final websocket frame."""
+    if length < 126:
+        return struct.pack('!BB', _FIN | opcode, length)
+    if length <= 0xFFFF:
+        return struct.pack('!BBH', _FIN | opcode, 126, length)
+    return struct.pack('!BBQ', _FIN | opcode, 127, length)
+
+
+def write_websocket(handler, payload, opcode):
+    """
+    Write a websocket frame as a header and the shared payload.
+
+    :param handler: a tornado WebSocketHandler
+    :param bytes payload: the frame payload
+    :param int opcode: OPCODE_TEXT or OPCODE_BINARY
+    :rtype: bool
+    :returns: False if the frame must be sent the regular way instead,
+        because the connection compresses its frames or isn't open
+
+    A closed stream is reported by calling handler.on_close on the next
+    IOLoop iteration, as tornado would.
+    """
+    ws_connection = getattr(handler, 'ws_connection', None)
+    if (ws_connection is None or ws_connection.stream is None or
+            getattr(ws_connection, '_compressor', None) is not None):
+        return False
+    stream = ws_connection.stream
+    try:
+        stream.write(websocket_header(opcode, len(payload)))
+        stream.write(payload)
+    except StreamClosedError:
+        # Not every handler has a server (sockjs router) to reach the
+        # IOLoop through, e.g. relay handlers.
+        IOLoop.current().add_callback(handler.on_close)
+    metrics.incr('outbound.shared_writes')
+    return True
@@ -0,0 +1,122 @@
+"""
+Cheap structural checks for compact bitjws tokens.
+
+These run before any elliptic curve work: the token is split into its
+three parts, the header and payload are base64url and JSON decoded, the
+signing algorithm and the required payload fields are checked and the
+issue time is compared to the local clock. Only tokens that pass are
+worth a full bitjws verification.
+
+Nothing here proves who signed the token; the header and payload
+returned must not be trusted until the signature has been verified.
+"""
+import json
+import time
+import base64
+import binascii
+
+# Algorithms accepted in the JWS header.
+ALLOWED_ALGORITHMS = frozenset(['CUSTOM-BITCOIN-SIGN'])
+
+# Default (seconds in the past, seconds in the future) accepted for iat.
+DEFAULT_IAT_WINDOW = (600, 60)
+
+
+class MalformedToken(ValueError):
+    """The token can't possibly pass verification."""
+
+
+class MissingField(MalformedToken):
+    """The token is well formed but its data lacks a required field."""
+
+
+def b64url_decode(segment):
+    """
+    Strictly decode a base64url segment, with or without padding.
+
+    :param str segment: the encoded segment
+    :rtype: bytes
+    :raises MalformedToken: if the segment isn't valid base64url
+    """
+    try:
+        segment = segment.encode('ascii')
+    except (AttributeError, UnicodeError):
+        raise MalformedToken('segment is not ascii')
+    segment += b'=' * (-len(segment) % 4)
+    try:
+        return base64.b64decode(segment, altchars=b'-_', validate=True)
+    except (binascii.Error, ValueError):
+        raise MalformedToken('bad base64')
+
+
+def _decode_json(segment):
+    try:
+        value = json.loads(b64url_decode(segment).decode('utf-8'))
+    except ValueError:
+        raise MalformedToken('bad json')
+    if not isinstance(value, dict):
+        raise MalformedToken('expected an object')
+    return value
+
+
+def split_token(token):
+    """
+    Split a compact token into its header, payload and signature segments.
+
+    :param str|bytes token: the compact serialized token
+    :rtype: list
+    :raises MalformedToken: if the token doesn't have three segments
+    """
+    if isinstance(token, bytes):
+        try:
+            token = token.decode('ascii')
+        except UnicodeError:
+            raise MalformedToken('token is not ascii')
+    if not isinstance(token, str):
+        raise MalformedToken('expected a string')
+    parts = token.split('.')
+    if len(parts) != 3 or not all(parts):
+        raise MalformedToken('expected three segments')
+    return parts
+
+
+def precheck(token, required=('method', ), iat_window=DEFAULT_IAT_WINDOW,
+             now=None):
+    """
+    Validate the structure of a compact token without verifying it.
+
+    :param str|bytes token: the compact serialized token
+    :param tuple required: fields that must be present in payload['data']
+    :param tuple iat_window: (seconds in the past, seconds in the future)
+        accepted for the payload iat, or None to skip the check
+    :param float now: the current time, defaults to time.time()
+    :rtype: tuple
+    :returns: the unverified (header, payload)
+    :raises MissingField: if payload['data'] lacks a required field
+    :raises MalformedToken: if the token fails any other check
+    """
+    header_seg, payload_seg, signature_seg = split_token(token)
+    header = _decode_json(header_seg)
+    if header.get('alg') not in ALLOWED_ALGORITHMS:
+        raise MalformedToken('unsupported algorithm')
+    payload = _decode_json(payload_seg)
+    b64url_decode(signature_seg)
+
+    data = payload.get('data')
+    if not isinstance(data, dict):
+        raise MalformedToken('data is not an object')
+    for field in required:
+        if field not in data:
+            raise MissingField('%s is required' % field)
+
+    if iat_window is not None:
+        iat = payload.get('iat')
+        if not isinstance(iat, (int, float)) or isinstance(iat, bool):
+            raise MalformedToken('bad iat')
+        if now is None:
+            now = time.time()
+        max_age, max_skew = iat_window
+        if not now - max_age <= iat <= now + max_skew:
+            raise MalformedToken('iat outside of the allowed window')
+
+    return header, payload
@@ -0,0 +1,94 @@
+"""
+Sampling profiler for the IOLoop thread.
+
+A background thread looks at the stack of the profiled thread every
+interval seconds and counts how often each stack is seen. Nothing runs
+between profiles, and while profiling the profiled thread is never
+interrupted, so the overhead is a small share of one core.
+
+The result is in the collapsed stack format read by flamegraph tools,
+one line per distinct stack, outermost frame first:
+
+    main (sockjs_server.py:340);run_forever (base_events.py:593);... 42
+"""
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+
+def frame_label(code):
+    """Return the label of a code object in collapsed stacks."""
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """
+    Sample the stack of one thread at a fixed interval.
+
+    :param int thread_id: the thread to profile, as returned by
+        threading.get_ident(), the calling thread by default
+    :param float interval: seconds between samples
+    """
+
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples = Counter()
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='bitjws-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def sample(self):
+        """Record the current stack of the profiled thread once."""
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        labels = self._labels
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = frame_label(code)
+            stack.append(label)
+            frame = frame.f_back
+        stack.reverse()
+        self.samples[';'.join(stack)] += 1
+
+    def _run(self):
+        next_sample = time.monotonic()
+        while not self._stop.is_set():
+            self.sample()
+            next_sample += self.interval
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                next_sample = time.monotonic()
+
+    def collapsed(self):
+        """
+        Return the samples as collapsed stacks, most frequent first.
+
+        :rtype: str
+        """
+        return ''.join('%s %d\n' % (stack, count)
+                       for stack, count in self.samples.most_common())
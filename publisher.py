@@ -0,0 +1,314 @@
+"""
+High throughput publisher for bitjws messages.
+
+Meant to be embedded in the processes producing updates, e.g. the
+flask-bitjws servers. A Publisher keeps a persistent AMQP connection on
+its own thread and event loop, and publish() only appends the message to
+a bounded buffer, so it never blocks the caller.
+
+On the publisher thread messages are taken from the buffer in batches,
+each batch being written to the socket in one go, and publishes are
+pipelined with publisher confirms: up to max_in_flight messages may be
+awaiting their confirmation. Messages nacked by the broker or left
+unconfirmed when the connection drops are put back at the head of the
+buffer and published again. A callback given to publish() is called,
+on the publisher thread, once the broker has confirmed the message.
+
+    publisher = Publisher(pikaconfig, privkey=privkey)
+    publisher.start()
+    publisher.sign_and_publish({'method': 'RESPONSE', 'model': 'coin', ...})
+    publisher.publish(signed_message)
+    ...
+    publisher.stop()
+
+Messages can optionally be signed on a pool of worker processes.
+"""
+import time
+import asyncio
+import logging
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+import bitjws
+
+import metrics
+from util import setupLogHandlers
+from precheck import precheck, MalformedToken
+from sharding import routing_key_for
+from sockjs_pika_consumer import topic_key
+
+# Seconds before reconnecting after the connection is lost.
+RECONNECT_DELAY = 1
+
+_signer_privkey = None
+
+
+def _init_signer(privkey_bytes):
+    global _signer_privkey
+    _signer_privkey = bitjws.PrivateKey(privkey_bytes)
+
+
+def _sign(data):
+    return bitjws.sign_serialize(_signer_privkey, data=data, iat=time.time())
+
+
+class Publisher(object):
+    """
+    Publish bitjws messages to the exchange of the sockjs servers.
+
+    :param config: the config module, e.g. pikaconfig
+    :param bitjws.PrivateKey privkey: key used by sign_and_publish
+    :param int max_buffer: messages buffered before publish() refuses more
+    :param int max_in_flight: messages awaiting a confirmation at most
+    :param int batch_size: messages published per event loop iteration
+    :param int sign_workers: size of the signing process pool, 0 to sign
+        in the calling thread
+    """
+
+    def __init__(self, config, privkey=None, max_buffer=10000,
+                 max_in_flight=1000, batch_size=100, sign_workers=0):
+        self.config = config
+        self.privkey = privkey
+        self.max_buffer = max_buffer
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+
+        self._url = config.BROKER_URL
+        self._shard_count = getattr(config, 'SHARD_COUNT', 0)
+        exchange = config.SHARD_EXCHANGE if self._shard_count else config.EXCHANGE
+        self._exchange = exchange['exchange']
+        self._exchange_type = exchange['exchange_type']
+
+        # (routing key, body, callback) tuples waiting to be published,
+        # and the published ones waiting for their confirmation by
+        # delivery tag.
+        self._buffer = deque()
+        self._unconfirmed = OrderedDict()
+        self._delivery_tag = 0
+
+        self._loop = None
+        self._thread = None
+        self._connection = None
+        self._channel = None
+        self._ready = False
+        self._closing = False
+        self._drain_scheduled = False
+
+        self._pool = None
+        if sign_workers:
+            self._pool = ProcessPoolExecutor(
+                sign_workers, initializer=_init_signer,
+                initargs=(privkey.private_key, ))
+
+        logger = logging.getLogger(name='api-stream_publisher')
+        for h in setupLogHandlers(fname='API-stream_publisher.log'):
+            logger.addHandler(h)
+        logger.setLevel(logging.INFO)
+        self._log = logger
+
+    @property
+    def pending(self):
+        """Number of messages buffered or awaiting their confirmation."""
+        return len(self._buffer) + len(self._unconfirmed)
+
+    def start(self):
+        """Start the publisher thread and connect to RabbitMQ."""
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run,
+                                        name='bitjws-publisher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Wait up to timeout seconds for pending messages to be confirmed,
+        then close the connection and stop the publisher thread.
+        """
+        self.flush(timeout)
+        self._closing = True
+        self._loop.call_soon_threadsafe(self._close)
+        self._thread.join(timeout)
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every message published so far has been confirmed.
+
+        :rtype: bool
+        :returns: False if messages are still pending after timeout seconds
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def publish(self, message, routing_key=None, callback=None):
+        """
+        Queue a signed message for publishing, without blocking.
+
+        Can be called from any thread. When sharding is enabled and no
+        routing key is given, the routing key of the message's shard is
+        used.
+
+        :param str message: a compact serialized bitjws message
+        :param str routing_key: the routing key
+        :param callable callback: called without arguments on the
+            publisher thread once the broker confirmed the message
+        :rtype: bool
+        :returns: False if the buffer is full and the message was dropped
+        """
+        if len(self._buffer) >= self.max_buffer:
+            metrics.incr('publisher.dropped')
+            return False
+        if routing_key is None:
+            routing_key = self._routing_key(message)
+        self._buffer.append((routing_key, message, callback))
+        if not self._drain_scheduled and self._loop is not None:
+            self._drain_scheduled = True
+            self._loop.call_soon_threadsafe(self._drain)
+        return True
+
+    def sign_and_publish(self, data):
+        """
+        Sign data with the publisher key and queue it for publishing.
+
+        With a signing pool the message is signed on a worker process and
+        queued once signed, and a future resolving to the message is
+        returned. Otherwise it is signed right away and the result of
+        publish() is returned.
+
+        :param dict data: the message data
+        """
+        if self._pool is None:
+            return self.publish(bitjws.sign_serialize(self.privkey, data=data,
+                                                      iat=time.time()))
+        future = self._pool.submit(_sign, data)
+        future.add_done_callback(self._on_signed)
+        return future
+
+    def _on_signed(self, future):
+        if future.exception() is not None:
+            self._log.error('Signing failed: %r' % future.exception())
+            return
+        self.publish(future.result())
+
+    def _routing_key(self, message):
+        if not self._shard_count:
+            return ''
+        try:
+            data = precheck(message, required=('model', ),
+                            iat_window=None)[1]['data']
+            return routing_key_for(topic_key(data), self._shard_count)
+        except (MalformedToken, ValueError):
+            return ''
+
+    # The methods below run on the publisher thread.
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._connect()
+        self._loop.run_forever()
+
+    def _connect(self):
+        self._log.info('Connecting to %s' % self._url)
+        self._connection = AsyncioConnection(
+            pika.URLParameters(self._url),
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_closed,
+            on_close_callback=self.on_connection_closed,
+            custom_ioloop=self._loop)
+
+    def _close(self):
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+        else:
+            self._loop.stop()
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_closed(self, connection, reason):
+        self._ready = False
+        self._channel = None
+        # Whatever wasn't confirmed is published again on the next
+        # connection, in the original order.
+        self._buffer.extendleft(reversed(list(self._unconfirmed.values())))
+        self._unconfirmed.clear()
+        if self._closing:
+            self._loop.stop()
+        else:
+            self._log.warning('Connection closed, reopening in %s seconds: %s'
+                              % (RECONNECT_DELAY, reason))
+            self._loop.call_later(RECONNECT_DELAY, self._connect)
+
+    def on_channel_open(self, channel):
+        self._channel = channel
+        self._delivery_tag = 0
+        channel.exchange_declare(exchange=self._exchange,
+                                 exchange_type=self._exchange_type,
+                                 callback=self.on_exchange_declareok)
+
+    def on_exchange_declareok(self, unused_frame):
+        self._channel.confirm_delivery(self.on_delivery_confirmation,
+                                       callback=self.on_confirm_selectok)
+
+    def on_confirm_selectok(self, unused_frame):
+        self._log.info('Publisher ready')
+        self._ready = True
+        self._drain()
+
+    def on_delivery_confirmation(self, method_frame):
+        """
+        Invoked by pika when RabbitMQ confirms a publish. A confirmation
+        with the multiple flag covers every delivery tag up to its own.
+        """
+        method = method_frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            tags = []
+            for tag in self._unconfirmed:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag]
+        items = []
+        for tag in tags:
+            item = self._unconfirmed.pop(tag, None)
+            if item is not None:
+                items.append(item)
+        if acked:
+            metrics.incr('publisher.confirmed', len(tags))
+            for routing_key, body, callback in items:
+                if callback is not None:
+                    callback()
+        else:
+            metrics.incr('publisher.nacked', len(items))
+            self._buffer.extendleft(reversed(items))
+        self._drain()
+
+    def _drain(self):
+        """Publish the next batch of buffered messages."""
+        self._drain_scheduled = False
+        if not self._ready:
+            return
+        published = 0
+        while (self._buffer and published < self.batch_size and
+               len(self._unconfirmed) < self.max_in_flight):
+            routing_key, body, callback = item = self._buffer.popleft()
+            self._channel.basic_publish(self._exchange, routing_key, body)
+            self._delivery_tag += 1
+            self._unconfirmed[self._delivery_tag] = item
+            published += 1
+        metrics.incr('publisher.published', published)
+        # Let the event loop write this batch and read confirmations
+        # before publishing the next one.
+        if (self._buffer and published == self.batch_size and
+                not self._drain_scheduled):
+            self._drain_scheduled = True
+            self._loop.call_soon(self._drain)
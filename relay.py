@@ -0,0 +1,215 @@
+"""
+Relay mode: a sockjs_server fed by an upstream sockjs_server.
+
+An edge node, with RELAY_UPSTREAM set, holds no broker connection.
+Instead it connects to the /relay endpoint of an upstream node and
+subscribes there to the topics its own sessions subscribe to, and only
+to those: the first local subscriber of a topic subscribes the edge, the
+last one to leave unsubscribes it. Upstream nodes can be edges of their
+own upstream, so nodes form a fan-out tree where each one serves a
+bounded number of sessions and edges.
+
+The upstream verified the messages it relays, so edges trust them and
+only decode their payload to find the local subscribers, as with the
+ingest socket.
+
+Edges authenticate with a signed {"method": "RELAY"} message, signed by
+RELAY_KEY, whose pubhash must be in the RELAY_PUBHASHES of the upstream.
+Subscriptions are then JSON frames:
+
+    {"method": "SUBSCRIBE", "topics": [{"model": "coin", "id": "1"}, ...]}
+    {"method": "UNSUBSCRIBE", "topics": [...]}
+
+and the upstream sends the UTF-8 encoded message bodies, one per binary
+frame. An edge whose connection backs up by more than RELAY_MAX_BUFFER
+bytes is disconnected, and reconnects.
+"""
+import json
+import time
+import asyncio
+
+import bitjws
+from tornado import websocket
+from tornado.iostream import StreamBufferFullError
+
+import metrics
+import outbound
+from ingest import IngestClient, RECONNECT_DELAY
+from precheck import precheck, MalformedToken, MissingField
+from replay import replay_key
+from sockjs_pika_consumer import topic_key, topic_frame
+
+# Seconds between websocket pings on the relay connection.
+PING_INTERVAL = 10
+
+
+class RelayHandler(websocket.WebSocketHandler):
+    """
+    The upstream end of a relay connection, subscribed to the consumer
+    like a session.
+
+    :param AsyncConsumer consumer: the consumer delivering messages
+    :param iterable relays: the pubhashes of the edges allowed to connect
+    :param ReplayCache replay_cache: the cache refusing replayed messages
+    :param tuple iat_window: accepted age of the messages, see precheck
+    :param int max_buffer: bytes buffered for the edge before it is
+        disconnected
+    """
+
+    def initialize(self, consumer, relays, replay_cache, iat_window,
+                   max_buffer=64 * 1024 * 1024):
+        self.consumer = consumer
+        self.relays = frozenset(relays)
+        self.replay_cache = replay_cache
+        self.iat_window = iat_window
+        self.max_buffer = max_buffer
+        self.pubhash = None
+
+    def open(self):
+        self.ws_connection.stream.max_write_buffer_size = self.max_buffer
+
+    def on_message(self, message):
+        if self.pubhash is None:
+            self.pubhash = self.authenticate(message)
+            if self.pubhash is None:
+                metrics.incr('relay.rejected')
+                self.close(1008, 'bad credentials')
+            else:
+                metrics.incr('relay.edges_connected')
+            return
+        try:
+            frame = json.loads(message)
+            topics = [topic_key(topic) for topic in frame['topics']]
+        except (ValueError, TypeError, KeyError):
+            self.close(1003, 'invalid data')
+            return
+        if frame.get('method') == 'SUBSCRIBE':
+            self.consumer.listener_add(self, topics)
+        elif frame.get('method') == 'UNSUBSCRIBE':
+            self.consumer.listener_remove(self, topics)
+
+    def authenticate(self, message):
+        """
+        Return the pubhash of an edge's RELAY message, or None if it
+        isn't signed by an allowed edge.
+
+        :rtype: str|None
+        """
+        try:
+            if isinstance(message, bytes):
+                message = message.decode('ascii')
+            unverified = precheck(message, iat_window=self.iat_window)[1]
+        except (UnicodeError, MalformedToken, MissingField):
+            return None
+        if unverified['data']['method'] != 'RELAY':
+            return None
+        replay = replay_key(message, unverified)
+        if self.replay_cache.seen(replay, unverified['iat']):
+            return None
+        try:
+            headers = bitjws.validate_deserialize(message)[0]
+        except Exception:
+            return None
+        # validate_deserialize returns (None, None) on a bad signature.
+        if headers is None or headers.get('kid') not in self.relays:
+            return None
+        self.replay_cache.add(replay, unverified['iat'])
+        return headers['kid']
+
+    def send(self, body, trace=None):
+        """Relay a verified message to the edge."""
+        if self.ws_connection is None:
+            return
+        try:
+            payload = outbound.message_for(body).utf8
+            if not outbound.write_websocket(self, payload,
+                                            outbound.OPCODE_BINARY):
+                self.write_message(payload, binary=True)
+        except StreamBufferFullError:
+            metrics.incr('relay.overflows')
+            self.close(1013, 'backed up')
+            return
+        except websocket.WebSocketClosedError:
+            # on_close unsubscribes the edge.
+            return
+        if trace is not None:
+            trace.mark_written()
+
+    def on_close(self):
+        self.consumer.listener_delete(self)
+
+
+class RelayClient(IngestClient):
+    """
+    The edge end of a relay connection: subscribe upstream to the topics
+    of the local sessions, and dispatch the messages relayed to them.
+
+    :param str url: the websocket URL of the upstream /relay endpoint
+    :param AsyncConsumer consumer: the edge consumer
+    :param bitjws.PrivateKey privkey: the key the edge authenticates with
+    """
+
+    def __init__(self, url, consumer, privkey):
+        super(RelayClient, self).__init__(url, consumer)
+        self.privkey = privkey
+        self.topics = set()
+
+    def start(self, io_loop=None):
+        """Follow the subscriptions of the consumer and connect upstream."""
+        self.consumer.add_on_topic_callback(self.on_topic)
+        super(RelayClient, self).start(io_loop)
+
+    def on_topic(self, topic, added):
+        if added:
+            self.topics.add(topic)
+        else:
+            self.topics.discard(topic)
+        self._write_topics('SUBSCRIBE' if added else 'UNSUBSCRIBE', [topic])
+
+    def _write_topics(self, method, topics):
+        if self._stream is None or not topics:
+            return
+        try:
+            self._stream.write_message(json.dumps({
+                'method': method, 'topics': [topic_frame(t) for t in topics]}))
+        except websocket.WebSocketClosedError:
+            # All the topics are sent again on reconnect.
+            pass
+
+    async def run(self):
+        while not self._stopped:
+            try:
+                conn = await websocket.websocket_connect(
+                    self.path, ping_interval=PING_INTERVAL)
+            except Exception as e:
+                self._log.warning('Upstream %s unavailable, retrying in %s '
+                                  'seconds: %r' % (self.path, RECONNECT_DELAY,
+                                                   e))
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                await conn.write_message(bitjws.sign_serialize(
+                    self.privkey, data={'method': 'RELAY'}, iat=time.time()))
+                self._stream = conn
+                self._write_topics('SUBSCRIBE', list(self.topics))
+                self._log.info('Relaying from %s' % self.path)
+                while True:
+                    if self.consumer.paused:
+                        # Load shedding, messages wait upstream.
+                        await self.consumer.wait_resumed()
+                    body = await conn.read_message()
+                    if body is None:
+                        break
+                    self.deliver(body)
+            except websocket.WebSocketClosedError:
+                pass
+            finally:
+                self._stream = None
+                conn.close()
+            if self._stopped:
+                break
+            self._log.warning('Upstream %s closed the relay (%s), retrying in '
+                              '%s seconds' % (self.path, conn.close_reason,
+                                              RECONNECT_DELAY))
+            await asyncio.sleep(RECONNECT_DELAY)
+        self._log.info('Stopped relaying from %s' % self.path)
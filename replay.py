@@ -0,0 +1,105 @@
+"""
+Replay protection for signed client messages.
+
+Accepted messages are remembered until their iat falls out of the
+accepted window. Keys are grouped into buckets by iat, so expiring old
+keys means dropping whole buckets, and the total number of keys is
+capped. When the cap is hit the oldest bucket is dropped and the window
+shrinks accordingly: messages older than what is remembered are treated
+as replays, so memory stays bounded without ever letting a replay
+through.
+
+Keys are derived from the signed part of the token (header and
+payload) or from its jti, not from the signature: ECDSA signatures are
+malleable, so a replayed message could carry a different but still
+valid signature.
+"""
+import time
+import hashlib
+
+
+def replay_key(token, payload=None):
+    """
+    Return the replay key for a compact token.
+
+    :param str token: the compact serialized token
+    :param dict payload: the decoded payload, used for its jti if present
+    :rtype: bytes
+    """
+    if payload and payload.get('jti'):
+        signed = 'jti:%s' % payload['jti']
+    else:
+        signed = token.rpartition('.')[0]
+    return hashlib.blake2b(signed.encode('utf-8'), digest_size=16).digest()
+
+
+class ReplayCache(object):
+    """
+    A time bucketed set of message keys.
+
+    :param float max_age: seconds a message is accepted after its iat
+    :param float bucket_seconds: width of each bucket
+    :param int max_entries: maximum number of keys remembered
+    """
+
+    def __init__(self, max_age, bucket_seconds=10, max_entries=1000000):
+        self.max_age = max_age
+        self.bucket_seconds = bucket_seconds
+        self.max_entries = max_entries
+        self._buckets = {}
+        self._floor = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _bucket_for(self, iat):
+        return int(iat // self.bucket_seconds)
+
+    def _expire(self, now):
+        floor = self._bucket_for(now - self.max_age)
+        if self._floor is not None and floor <= self._floor:
+            return
+        self._floor = floor
+        for number in [n for n in self._buckets if n < floor]:
+            self._size -= len(self._buckets.pop(number))
+
+    def _evict_oldest(self):
+        oldest = min(self._buckets)
+        self._size -= len(self._buckets.pop(oldest))
+        self._floor = max(self._floor, oldest + 1)
+
+    def seen(self, key, iat, now=None):
+        """
+        Return True if key was already accepted, or if iat is older than
+        what the cache still remembers.
+
+        :param bytes key: see replay_key
+        :param float iat: the message issue time
+        :rtype: bool
+        """
+        self._expire(time.time() if now is None else now)
+        number = self._bucket_for(iat)
+        if number < self._floor:
+            return True
+        bucket = self._buckets.get(number)
+        return bucket is not None and key in bucket
+
+    def add(self, key, iat, now=None):
+        """
+        Remember an accepted message.
+
+        :param bytes key: see replay_key
+        :param float iat: the message issue time
+        """
+        self._expire(time.time() if now is None else now)
+        number = self._bucket_for(iat)
+        if number < self._floor:
+            return
+        bucket = self._buckets.setdefault(number, set())
+        if key in bucket:
+            return
+        bucket.add(key)
+        self._size += 1
+        while self._size > self.max_entries:
+            self._evict_oldest()
@@ -0,0 +1,158 @@
+"""
+Session resume tokens and the subscription snapshot used for warm
+restarts.
+
+Every session is given a resume token in its open frame. When the
+session goes away, or when the server shuts down, the subscriptions of
+authenticated sessions are kept under their token for RESUME_TTL
+seconds. A client reconnecting within that time sends a signed RESUME
+message with its old token and gets its subscriptions back at the cost
+of a single signature check, instead of re-sending and re-authorizing a
+signed GET per topic. Tokens are bound to the pubhash that owned the
+subscriptions, so a stolen token is of no use without the key.
+
+On shutdown the registry is written to a memory-mapped file, and it is
+loaded back on startup, so a deploy does not turn into a resubscribe
+storm.
+"""
+import os
+import json
+import mmap
+import time
+import struct
+import secrets
+
+# Magic number and payload length at the start of a snapshot file.
+SNAPSHOT_HEADER = struct.Struct('!4sQ')
+SNAPSHOT_MAGIC = b'BJSS'
+
+
+def _encode_topic(topic):
+    return list(topic) if isinstance(topic, tuple) else topic
+
+
+def _decode_topic(topic):
+    return tuple(topic) if isinstance(topic, list) else topic
+
+
+class ResumeRegistry(object):
+    """
+    Subscriptions kept for sessions that may resume, by resume token.
+
+    :param float ttl: seconds a token stays valid once its session is gone
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def new_token():
+        """Return a new unguessable resume token."""
+        return secrets.token_urlsafe(16)
+
+    def retain(self, token, pubhash, topics, now=None):
+        """
+        Keep the subscriptions of a session that went away.
+
+        :param str token: the resume token of the session
+        :param str pubhash: the pubhash the session authenticated with
+        :param iterable topics: the topic keys the session subscribed to
+        """
+        if now is None:
+            now = time.time()
+        self._entries[token] = (pubhash, frozenset(topics), now + self.ttl)
+
+    def claim(self, token, pubhash, now=None):
+        """
+        Take the subscriptions kept under token, if they belong to pubhash.
+
+        A token can be claimed only once.
+
+        :rtype: frozenset|None
+        :returns: the topic keys, or None if the token is unknown, expired
+            or owned by another pubhash
+        """
+        if now is None:
+            now = time.time()
+        entry = self._entries.get(token)
+        if entry is None or entry[0] != pubhash:
+            return None
+        del self._entries[token]
+        if entry[2] < now:
+            return None
+        return entry[1]
+
+    def expire(self, now=None):
+        """Drop every entry whose token has expired."""
+        if now is None:
+            now = time.time()
+        expired = [token for token, entry in self._entries.items()
+                   if entry[2] < now]
+        for token in expired:
+            del self._entries[token]
+
+    def save(self, path, live=(), now=None):
+        """
+        Write the registry, and the subscriptions of the sessions still
+        open, to a memory-mapped snapshot file.
+
+        :param str path: the snapshot file
+        :param iterable live: (token, pubhash, topics) of the open sessions
+        """
+        if now is None:
+            now = time.time()
+        for token, pubhash, topics in live:
+            self.retain(token, pubhash, topics, now)
+        self.expire(now)
+        data = json.dumps({
+            'saved_at': now,
+            'sessions': [[token, pubhash, [_encode_topic(t) for t in topics],
+                          expires_at]
+                         for token, (pubhash, topics, expires_at)
+                         in self._entries.items()]
+        }).encode('utf-8')
+
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w+b') as f:
+            f.truncate(SNAPSHOT_HEADER.size + len(data))
+            with mmap.mmap(f.fileno(), 0) as snapshot:
+                SNAPSHOT_HEADER.pack_into(snapshot, 0, SNAPSHOT_MAGIC, len(data))
+                snapshot[SNAPSHOT_HEADER.size:] = data
+                snapshot.flush()
+        os.replace(tmp_path, path)
+
+    def load(self, path, now=None):
+        """
+        Load the entries of a snapshot file written by save.
+
+        A missing or corrupted snapshot is ignored.
+
+        :param str path: the snapshot file
+        :rtype: int
+        :returns: the number of entries loaded
+        """
+        if now is None:
+            now = time.time()
+        try:
+            with open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+                    magic, size = SNAPSHOT_HEADER.unpack_from(snapshot, 0)
+                    if magic != SNAPSHOT_MAGIC:
+                        return 0
+                    start = SNAPSHOT_HEADER.size
+                    data = json.loads(snapshot[start:start + size].decode('utf-8'))
+        except (OSError, ValueError, struct.error):
+            return 0
+
+        loaded = 0
+        for token, pubhash, topics, expires_at in data['sessions']:
+            if expires_at >= now:
+                self._entries[token] = (
+                    pubhash, frozenset(_decode_topic(t) for t in topics),
+                    expires_at)
+                loaded += 1
+        return loaded
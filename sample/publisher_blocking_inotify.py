@@ -27,7 +27,7 @@ class PTmp(ProcessEvent):
         pikaChannel.basic_publish(body=json.dumps(msg),
                                   exchange=pikaconfig.EXCHANGE['exchange'],
                                   routing_key='')
-        print event
+        print(event)
 
 notifier = Notifier(wm, PTmp())
 wdd = wm.add_watch('/proc', mask, rec=True)
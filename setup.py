@@ -4,7 +4,7 @@ readme = open('./README.rst').read()
 
 classifiers = [
     "License :: OSI Approved :: MIT License",
-    "Programming Language :: Python :: 2",
+    "Programming Language :: Python :: 3",
     "Topic :: Software Development :: Libraries"
 ]
 
@@ -21,12 +21,17 @@ setup(
     license="MIT",
     classifiers=classifiers,
     include_package_data=True,
+    python_requires=">=3.7",
     tests_require=["bravado_bitjws"],
     install_requires=[
-        "pika",
-        "tornado==3.2",
-        "sockjs-tornado",
-        "websocket-client==0.11.0",
+        "pika>=1.1",
+        "tornado>=6.0",
+        "sockjs-tornado>=1.0.7",
+        "websocket-client",
         "bitjws"
-    ]
+    ],
+    extras_require={
+        "msgpack": ["msgpack>=1.0"],
+        "cbor": ["cbor2"]
+    }
 )
@@ -0,0 +1,77 @@
+"""
+Topic sharding across a fixed set of consumer shards.
+
+Every topic (a model, or a model and id) is assigned to one of
+SHARD_COUNT shards with jump consistent hashing. Publishers send each
+message to SHARD_EXCHANGE with the routing key of its shard, every shard
+(`python ingest.py --shard N`) consumes only its own routing key, and
+web workers connect only to the shards holding topics their sessions
+subscribe to.
+
+A topic is always handled by the same shard, so per topic ordering is
+kept. Going from N to N + 1 shards moves only 1 / (N + 1) of the topics,
+the minimum possible.
+"""
+import struct
+import hashlib
+
+_UINT64 = struct.Struct('!Q')
+
+
+def jump_hash(key, num_buckets):
+    """
+    Jump consistent hash (Lamping and Veach).
+
+    :param int key: a 64 bit key
+    :param int num_buckets: number of buckets, at least 1
+    :rtype: int
+    """
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def topic_hash(topic):
+    """
+    Return a 64 bit hash of a topic key, stable across processes.
+
+    :param str|tuple topic: a topic key, see sockjs_pika_consumer.topic_key
+    :rtype: int
+    """
+    if isinstance(topic, tuple):
+        topic = '\x00'.join(topic)
+    digest = hashlib.blake2b(topic.encode('utf-8'), digest_size=8).digest()
+    return _UINT64.unpack(digest)[0]
+
+
+def shard_for(topic, shard_count):
+    """Return the shard holding the messages of a topic."""
+    return jump_hash(topic_hash(topic), shard_count)
+
+
+def shards_for_subscription(topic, shard_count):
+    """
+    Return the shards a subscriber to topic must read from.
+
+    A subscription to a single item needs its shard only, while a model
+    wide subscription needs every shard since the items of a model are
+    spread across all of them.
+
+    :rtype: list
+    """
+    if isinstance(topic, tuple):
+        return [shard_for(topic, shard_count)]
+    return list(range(shard_count))
+
+
+def shard_routing_key(shard):
+    """Return the AMQP routing key of a shard."""
+    return 'shard.%d' % shard
+
+
+def routing_key_for(topic, shard_count):
+    """Return the routing key publishers must use for a topic."""
+    return shard_routing_key(shard_for(topic, shard_count))
@@ -1,10 +1,18 @@
+import sys
+import asyncio
 import logging
 import pika
-from pika import adapters
-from collections import defaultdict
-from util import setupLogHandlers
+from pika.adapters.asyncio_connection import AsyncioConnection
+from util import setupLogHandlers, install_event_loop_policy
 import bitjws
-
+from precheck import precheck, MalformedToken, DEFAULT_IAT_WINDOW
+from replay import replay_key
+from dedup import DuplicateFilter
+from topiclog import History
+
+import metrics
+import outbound
+from tracing import Tracer
 import pikaconfig
 
 
@@ -13,10 +21,43 @@ KNOWN_MESSAGE_TYPE = set(['sockjsmq', 'auth'])
 KNOWN_MESSAGE_FRONT_TYPE = set(['sockjsmq', 'auth', 'pong'])
 
 
+def topic_key(data):
+    """
+    Return the subscription key for the data of a message.
+
+    Model wide subscriptions are keyed by the interned model name, and
+    subscriptions to a single item by a (model, id) tuple. Ids are
+    compared as strings, so 1337 and "1337" are the same item.
+
+    :param dict data: the message data, with a 'model' and maybe an 'id'
+    :rtype: str|tuple
+    :raises ValueError: if the model is not a string or the id is
+        neither a string nor an integer
+    """
+    model = data['model']
+    if not isinstance(model, str):
+        raise ValueError("Expected 'str' model got %r" % type(model))
+    model = sys.intern(model)
+    if 'id' not in data:
+        return model
+    item_id = data['id']
+    if not isinstance(item_id, (str, int)) or isinstance(item_id, bool):
+        raise ValueError("Expected 'str' or 'int' id got %r" % type(item_id))
+    return (model, str(item_id))
+
+
+def topic_frame(topic):
+    """Return the model and id fields describing a topic key in a frame."""
+    if isinstance(topic, tuple):
+        return {'model': topic[0], 'id': topic[1]}
+    return {'model': topic}
+
+
 class AsyncConsumer(object):
 
     EXCHANGE = pikaconfig.EXCHANGE['exchange']
     EXCHANGE_TYPE = pikaconfig.EXCHANGE['exchange_type']
+    ROUTING_KEY = ''
 
     def __init__(self, config, ioloop_instance=None):
         """Create a new instance of the consumer class, passing in the config
@@ -36,10 +77,18 @@ class AsyncConsumer(object):
         self._queue = None
 
         # self.last_tick = None
-        self._listener = defaultdict(set)
+        # Subscriptions are indexed both ways: listener -> topic keys, to
+        # drop a listener, and topic key -> listeners, for the fan-out.
+        # _topics holds the canonical instance of every key in use so that
+        # all subscriptions to a topic share it.
+        self._listener = {}
+        self._subscribers = {}
+        self._topics = {}
+        self._topic_callbacks = []
         self._ioloop_instance = ioloop_instance
 
         self.schemas = config.SCHEMAS
+        self.iat_window = getattr(config, 'IAT_WINDOW', DEFAULT_IAT_WINDOW)
 
         logger = logging.getLogger(name='api-stream_consumer')
         for h in setupLogHandlers(fname='API-stream_consumer.log'):
@@ -48,6 +97,41 @@ class AsyncConsumer(object):
         logger.info("Consumer created")
         self._log = logger
 
+        # Load shedding: consumption can be paused, and messages about an
+        # item conflated, keeping only the latest one per CONFLATE_INTERVAL.
+        self.paused = False
+        self._resumed = None
+        self.conflate = False
+        self.conflate_interval = getattr(config, 'CONFLATE_INTERVAL', 0.1)
+        self._conflated = {}
+
+        # Copies of a message sent by several publishers are dropped.
+        self.dedup = None
+        if getattr(config, 'DEDUP_WINDOW', None):
+            self.dedup = DuplicateFilter(
+                config.DEDUP_WINDOW,
+                getattr(config, 'DEDUP_CAPACITY', 100000),
+                getattr(config, 'DEDUP_ERROR_RATE', 1e-4),
+                getattr(config, 'DEDUP_EXACT_MAX', 10000))
+
+        # Verified messages of the models kept are logged for HISTORY
+        # requests, see topiclog.
+        self.history = None
+        if getattr(config, 'HISTORY_DIR', None):
+            self.history = History(
+                config.HISTORY_DIR,
+                getattr(config, 'HISTORY_MODELS', None) or list(self.schemas),
+                segment_bytes=getattr(config, 'HISTORY_SEGMENT_BYTES',
+                                      64 * 1024 * 1024),
+                index_interval=getattr(config, 'HISTORY_INDEX_INTERVAL', 4096),
+                max_bytes=getattr(config, 'HISTORY_MAX_BYTES', None),
+                max_age=getattr(config, 'HISTORY_MAX_AGE', None))
+
+        self.tracer = None
+        if getattr(config, 'LATENCY_TRACING', True):
+            self.tracer = Tracer(getattr(config, 'LATENCY_TRACE_SAMPLE', 0),
+                                 logger)
+
     def connect(self):
         """
         Connect to RabbitMQ and return the connection handle.
@@ -57,9 +141,25 @@ class AsyncConsumer(object):
         :rtype: pika.SelectConnection
         """
         self._log.info('Connecting to %s' % self._url)
-        return adapters.TornadoConnection(pika.URLParameters(self._url),
-                                          self.on_connection_open,
-                                          custom_ioloop=self._ioloop_instance)
+        return AsyncioConnection(pika.URLParameters(self._url),
+                                 on_open_callback=self.on_connection_open,
+                                 on_open_error_callback=self.on_connection_open_error,
+                                 custom_ioloop=self._asyncio_loop())
+
+    def _asyncio_loop(self):
+        """
+        Return the asyncio event loop the connection should run on.
+
+        Tornado >= 5 runs on top of asyncio, so when a Tornado IOLoop is
+        given its underlying asyncio loop is shared with pika. Otherwise
+        pika picks the current event loop.
+
+        :rtype: asyncio.AbstractEventLoop|None
+        """
+        if self._ioloop_instance is None:
+            return None
+        return getattr(self._ioloop_instance, 'asyncio_loop',
+                       self._ioloop_instance)
 
     def close_connection(self):
         """Close the connection to RabbitMQ."""
@@ -74,22 +174,33 @@ class AsyncConsumer(object):
         self._log.debug('Adding connection close callback')
         self._connection.add_on_close_callback(self.on_connection_closed)
 
-    def on_connection_closed(self, connection, reply_code, reply_text):
+    def on_connection_closed(self, connection, reason):
         """
         Invoked by pika when the connection to RabbitMQ is
         closed unexpectedly.
 
         :param pika.connection.Connection connection: The closed connection obj
-        :param int reply_code: The server provided reply_code if given
-        :param str reply_text: The server provided reply_text if given
+        :param Exception reason: exception representing reason for loss of
+            connection
         """
         self._channel = None
         if self._closing:
-            self._connection.ioloop.stop()
+            if self._ioloop_instance is None:
+                self._connection.ioloop.stop()
         else:
             # XXX Use exponential back-off instead.
-            self._log.warning('Connection closed, reopening in 5 seconds: (%s) %s', reply_code, reply_text)
-            self._connection.add_timeout(5, self.reconnect)
+            self._log.warning('Connection closed, reopening in 5 seconds: %s', reason)
+            self._connection.ioloop.call_later(5, self.reconnect)
+
+    def on_connection_open_error(self, unused_connection, err):
+        """
+        Invoked by pika if the connection to RabbitMQ can't be established.
+
+        :param pika.connection.Connection unused_connection: The connection
+        :param Exception err: The error
+        """
+        self._log.error('Connection open failed, reopening in 5 seconds: %s', err)
+        self._connection.ioloop.call_later(5, self.reconnect)
 
     def on_connection_open(self, unused_connection):
         """
@@ -107,15 +218,13 @@ class AsyncConsumer(object):
         """
         Invoked by the IOLoop timer if the connection is
         closed. See the on_connection_closed method.
-        """
-        # This is the old connection IOLoop instance, stop its ioloop
-        self._connection.ioloop.stop()
 
+        The new connection is attached to the same event loop, which keeps
+        running, so there is no need to restart it.
+        """
         if not self._closing:
             # Create a new connection
             self._connection = self.connect()
-            # There is now a new connection, needs a new ioloop to run
-            self._connection.ioloop.start()
 
     def add_on_channel_close_callback(self):
         """
@@ -125,7 +234,7 @@ class AsyncConsumer(object):
         self._log.info('Adding channel close callback')
         self._channel.add_on_close_callback(self.on_channel_closed)
 
-    def on_channel_closed(self, channel, reply_code, reply_text):
+    def on_channel_closed(self, channel, reason):
         """
         Invoked by pika when RabbitMQ unexpectedly closes the channel.
         Channels are usually closed if you attempt to do something that
@@ -134,12 +243,11 @@ class AsyncConsumer(object):
         to shutdown the object.
 
         :param pika.channel.Channel: The closed channel
-        :param int reply_code: The numeric reason the channel was closed
-        :param str reply_text: The text reason the channel was closed
+        :param Exception reason: why the channel was closed
         """
-        self._log.warning('Channel %i was closed: (%s) %s' % (
-            channel, reply_code, reply_text))
-        self._connection.close()
+        self._log.warning('Channel %i was closed: %s' % (channel, reason))
+        if not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
 
     def on_channel_open(self, channel):
         """
@@ -164,9 +272,9 @@ class AsyncConsumer(object):
         :param str|unicode exchange_name: The name of the exchange to declare
         """
         self._log.debug('Declaring exchange %s' % exchange_name)
-        self._channel.exchange_declare(self.on_exchange_declareok,
-                                       exchange_name,
-                                       self.EXCHANGE_TYPE)
+        self._channel.exchange_declare(exchange=exchange_name,
+                                       exchange_type=self.EXCHANGE_TYPE,
+                                       callback=self.on_exchange_declareok)
 
     def on_exchange_declareok(self, unused_frame):
         """
@@ -185,7 +293,8 @@ class AsyncConsumer(object):
         be invoked by pika.
         """
         self._log.debug('Declaring exclusive queue')
-        self._channel.queue_declare(self.on_queue_declareok, exclusive=True)
+        self._channel.queue_declare(queue='', exclusive=True,
+                                    callback=self.on_queue_declareok)
 
     def on_queue_declareok(self, method_frame):
         """
@@ -199,7 +308,9 @@ class AsyncConsumer(object):
         """
         self._queue = method_frame.method.queue
         self._log.debug('Binding %s to %s' % (self.EXCHANGE, self._queue))
-        self._channel.queue_bind(self.on_bindok, queue=self._queue, exchange=self.EXCHANGE)
+        self._channel.queue_bind(self._queue, self.EXCHANGE,
+                                 routing_key=self.ROUTING_KEY,
+                                 callback=self.on_bindok)
 
     def add_on_cancel_callback(self):
         """
@@ -249,8 +360,12 @@ class AsyncConsumer(object):
         Basic.Cancel RPC command.
         """
         if self._channel:
+            if self._consumer_tag is None:
+                # Paused, there is no consumer to cancel.
+                self.close_channel()
+                return
             self._log.debug('Sending a Basic.Cancel RPC command to RabbitMQ')
-            self._channel.basic_cancel(self.on_cancelok, self._consumer_tag)
+            self._channel.basic_cancel(self._consumer_tag, self.on_cancelok)
 
     def start_consuming(self):
         """
@@ -265,8 +380,40 @@ class AsyncConsumer(object):
         """
         self._log.debug('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
-        self._consumer_tag = self._channel.basic_consume(self.on_message,
-                                                         self._queue)
+        self._consumer_tag = None
+        if not self.paused:
+            self._consumer_tag = self._channel.basic_consume(self._queue,
+                                                             self.on_message)
+
+    def pause_consuming(self):
+        """
+        Stop taking messages from RabbitMQ, or from the ingest socket,
+        until resume_consuming is called. Messages wait in the queue.
+        """
+        if self.paused:
+            return
+        self._log.warning('Pausing consumption')
+        self.paused = True
+        self._resumed = asyncio.Event()
+        if self._channel and self._channel.is_open and self._consumer_tag:
+            self._channel.basic_cancel(self._consumer_tag)
+        self._consumer_tag = None
+
+    def resume_consuming(self):
+        """Take messages again after pause_consuming."""
+        if not self.paused:
+            return
+        self._log.warning('Resuming consumption')
+        self.paused = False
+        self._resumed.set()
+        if self._channel and self._channel.is_open and self._queue:
+            self._consumer_tag = self._channel.basic_consume(self._queue,
+                                                             self.on_message)
+
+    async def wait_resumed(self):
+        """Wait until consumption is resumed, if it is paused."""
+        while self.paused:
+            await self._resumed.wait()
 
     def on_bindok(self, unused_frame):
         """
@@ -299,10 +446,10 @@ class AsyncConsumer(object):
     def run(self):
         """
         Run the consumer by connecting to RabbitMQ and then
-        starting the IOLoop to block and allow the SelectConnection
-        to operate.
+        starting the asyncio event loop to block and allow the
+        AsyncioConnection to operate.
         """
-        self._connection.ioloop.start()
+        self._connection.ioloop.run_forever()
 
     def stop(self):
         """
@@ -318,7 +465,7 @@ class AsyncConsumer(object):
         self._log.info('Stopping')
         self._closing = True
         self.stop_consuming()
-        self._connection.ioloop.start()
+        self._connection.ioloop.run_forever()
         self._log.info('Stopped')
 
     def setup(self):
@@ -339,51 +486,250 @@ class AsyncConsumer(object):
         :param pika.channel.Channel unused_channel: The channel object
         :param pika.Spec.Basic.Deliver: basic_deliver method
         :param pika.Spec.BasicProperties: properties
-        :param str|unicode body: The message body
+        :param bytes|str body: The message body
         """
+        trace = self.tracer.start() if self.tracer is not None else None
+        # Bodies are not logged, formatting them costs a copy each.
         if basic_deliver and properties:
-            self._log.debug('Received message # %s: %s' % (
-                basic_deliver.delivery_tag, repr(body)))
+            self._log.debug('Received message # %s, %d bytes',
+                            basic_deliver.delivery_tag, len(body))
             self.acknowledge_message(basic_deliver.delivery_tag)
         else:
-            self._log.debug('Received direct message: %r' % body)
+            self._log.debug('Received direct message, %d bytes', len(body))
+
+        raw = None
+        if isinstance(body, bytes):
+            raw, body = body, body.decode('utf-8')
+        outbound.prime(body, raw)
+        payload_data = self.verify(body, trace)
+        if payload_data is not None:
+            self.dispatch(payload_data, body, trace)
+
+    def verify(self, body, trace=None):
+        """
+        Check a message and verify its signature.
+
+        Anything that can't be routed or verified is dropped by the
+        structural checks before doing the signature check, and so are
+        messages nobody here is subscribed to, going by their unverified
+        model and id, unless their model is kept in the history, and
+        copies of messages already verified (see dedup).
 
+        :param str body: the compact serialized message
+        :param MessageTrace trace: the trace of the message, if any
+        :rtype: dict|None
+        :returns: the verified payload data, or None if the message must
+            be dropped
+        """
+        try:
+            unverified = precheck(body, required=('method', 'model'),
+                                  iat_window=self.iat_window)[1]
+        except MalformedToken as e:
+            metrics.incr('consumer.precheck.rejected')
+            self._log.info('Dropping malformed message: %s' % e)
+            return None
         try:
-            payload_data = bitjws.validate_deserialize(body)[1]['data']
-        except Exception, e:
+            topic = topic_key(unverified['data'])
+        except ValueError as e:
+            self._log.info('Dropping unroutable message: %s' % e)
+            return None
+        if not self.has_subscribers(topic) and not self._logged(topic):
+            metrics.incr('consumer.unsubscribed_skipped')
+            return None
+        if self.dedup is not None:
+            key = replay_key(body, unverified)
+            if self.dedup.seen(key):
+                metrics.incr('consumer.duplicates')
+                return None
+        try:
+            headers, payload = bitjws.validate_deserialize(body)
+        except Exception as e:
             self._log.exception(e)
+            return None
+        if headers is None or payload is None:
+            # validate_deserialize returns (None, None) on a bad signature.
+            metrics.incr('consumer.bad_signature')
+            self._log.info('Dropping message with a bad signature')
+            return None
+        # Only verified messages are remembered, so that a forged copy
+        # can't get the genuine one dropped.
+        if self.dedup is not None:
+            self.dedup.add(key)
+        if trace is not None:
+            trace.mark_verified(payload.get('iat'))
+        return payload['data']
+
+    def dispatch(self, payload_data, body, trace=None):
+        """
+        Send a verified message to the listeners subscribed to its model
+        or to its item.
+
+        Listeners are called as listener.send(body, trace=trace), and
+        must call trace.mark_written() once the message is written to
+        their transport.
+
+        :param dict payload_data: the verified payload data
+        :param str body: the message as received
+        :param MessageTrace trace: the trace of the message, if any
+        """
+        try:
+            key = topic_key(payload_data)
+        except ValueError as e:
+            self._log.info('Dropping unroutable message: %s' % e)
+            return
+
+        if self.history is not None:
+            # Logged before conflation, so the history has every message.
+            self.history.append(key, outbound.message_for(body).utf8)
+
+        if self.conflate and isinstance(key, tuple):
+            # Only the latest message about an item is sent, when the
+            # conflation interval is over.
+            if not self._conflated:
+                self._conflation_loop().call_later(self.conflate_interval,
+                                                   self._flush_conflated)
+            elif key in self._conflated:
+                metrics.incr('shed.conflated')
+            self._conflated[key] = (payload_data, body, trace)
+            return
+        self._fanout(key, payload_data, body, trace)
+
+    def _conflation_loop(self):
+        return self._asyncio_loop() or asyncio.get_event_loop()
+
+    def _flush_conflated(self):
+        conflated, self._conflated = self._conflated, {}
+        for key, (payload_data, body, trace) in conflated.items():
+            self._fanout(key, payload_data, body, trace)
+
+    def _fanout(self, key, payload_data, body, trace=None):
+
+        if isinstance(key, tuple):
+            recipients = self._subscribers.get(key[0], ())
+            item_recipients = self._subscribers.get(key, ())
+        else:
+            recipients = self._subscribers.get(key, ())
+            item_recipients = ()
+        self._log.debug('sending body to %d listeners of %r',
+                        len(recipients) + len(item_recipients), key)
+        if trace is not None:
+            trace.mark_fanout(payload_data['model'],
+                              len(recipients) + len(item_recipients))
+        # Sending may close a session and unsubscribe it, so iterate over
+        # snapshots of the subscriber sets.
+        for listener in list(recipients):
+            listener.send(body, trace=trace)
+        for listener in list(item_recipients):
+            if listener not in recipients:
+                listener.send(body, trace=trace)
+        if trace is not None:
+            self.tracer.finish(trace)
+
+    def has_subscribers(self, key):
+        """
+        Tell if a message with the given topic key would be sent to any
+        listener, through its model or its item.
+
+        :param str|tuple key: see topic_key
+        :rtype: bool
+        """
+        subscribers = self._subscribers
+        if isinstance(key, tuple):
+            return key[0] in subscribers or key in subscribers
+        return key in subscribers
+
+    def _logged(self, key):
+        """Tell if messages with the given topic key are kept in history."""
+        if self.history is None:
+            return False
+        return self.history.wants(key[0] if isinstance(key, tuple) else key)
+
+    def add_on_topic_callback(self, callback):
+        """
+        Call callback(topic, added) whenever the first listener subscribes
+        to a topic (added is True) or the last one leaves it (added is
+        False). It is called right away for the topics already in use.
+
+        :param callable callback: the callback
+        """
+        self._topic_callbacks.append(callback)
+        for topic in list(self._topics):
+            callback(topic, True)
+
+    def _subscribe(self, instance, topic):
+        subscribers = self._subscribers.get(topic)
+        if subscribers is None:
+            topic = self._topics[topic] = topic
+            subscribers = self._subscribers[topic] = set()
+            for callback in self._topic_callbacks:
+                callback(topic, True)
+        else:
+            topic = self._topics[topic]
+        subscribers.add(instance)
+        return topic
+
+    def _unsubscribe(self, instance, topic):
+        subscribers = self._subscribers.get(topic)
+        if subscribers is None:
             return
-        self._log.info(self._listener)
-        for listener, allowed in self._listener.iteritems():
-            self._log.info('iterating _listeners\t %s: %s' % (listener, allowed))
-            if payload_data['model'] in allowed or ('id' in payload_data and "%s_id_%s" % (payload_data['model'], payload_data['id']) in allowed):
-                self._log.info('sending body\t %s' % body)
-                listener.send(body)
+        subscribers.discard(instance)
+        if not subscribers:
+            del self._subscribers[topic]
+            del self._topics[topic]
+            for callback in self._topic_callbacks:
+                callback(topic, False)
 
     def listener_set(self, instance, val):
-        if not isinstance(val, str):
-            raise TypeError("Expected 'str' got %r" % type(val))
-        self._listener[instance] = frozenset([val])
+        if not isinstance(val, (str, tuple)):
+            raise TypeError("Expected a topic key got %r" % type(val))
+        self.listener_delete(instance)
+        self.listener_add(instance, [val])
 
     def listener_add(self, instance, allowed=None):
-        self._listener[instance].update(allowed or [])
+        topics = self._listener.setdefault(instance, set())
+        for topic in allowed or []:
+            if topic not in topics:
+                topics.add(self._subscribe(instance, topic))
 
     def listener_remove(self, instance, disallowed=None):
-        self._listener[instance].difference_update(disallowed or [])
+        topics = self._listener.get(instance)
+        if not topics:
+            return
+        for topic in disallowed or []:
+            if topic in topics:
+                topics.discard(topic)
+                self._unsubscribe(instance, topic)
+
+    def listener_topics(self, instance):
+        """Return the topic keys instance is subscribed to."""
+        return frozenset(self._listener.get(instance, ()))
+
+    def listener_items(self):
+        """Return (listener, topic keys) pairs for every listener."""
+        return list(self._listener.items())
 
     def listener_allowed(self, instance, data):
-        """Incomplete/Naive bitjws auth (being developed)"""
+        """
+        Check that the schema route of a subscription allows GET, and
+        that the message is signed if the route requires a pubhash.
+        Whether the key may read the item is checked afterwards by the
+        policy of the session's Authorizer, if any (see authz).
+        """
         self._log.info("allowed: %s" % data)
         try:
             payload_data = bitjws.validate_deserialize(data)[1]['data']
         except Exception as e:
-            print e
+            self._log.info("allowed single sig err %s" % e)
             try:
                 headers, payload_data = bitjws.multisig_validate_deserialize(data)
             except Exception as e:
-                print e
                 self._log.info("allowed auth err %s" % e)
                 return False
+        try:
+            topic_key(payload_data)
+        except (KeyError, ValueError) as e:
+            self._log.info("allowed bad topic %s" % e)
+            return False
         if payload_data['model'] not in self.schemas:
             return False
         elif 'id' in payload_data:
@@ -399,13 +745,38 @@ class AsyncConsumer(object):
             if 'pubhash' not in payload_data:
                 return False
         return True
-        # TODO check if user is authorized for item
-        #item = self.sa['session'].query(self.sa_model).all()
+
+    def publish_allowed(self, payload_data, pubhash):
+        """
+        Check that the schema route of a client publish allows it: POST
+        to the model, or PUT to the item when an id is given. When the
+        route requires a pubhash, it must be the signer's.
+
+        :param dict payload_data: the verified payload data
+        :param str pubhash: the pubhash of the signing key
+        :rtype: bool
+        """
+        schema = self.schemas.get(payload_data['model'])
+        if schema is None:
+            return False
+        if 'id' in payload_data:
+            permissions = schema['routes'].get('/:id', {}).get('PUT')
+        else:
+            permissions = schema['routes'].get('/', {}).get('POST')
+        if permissions is None:
+            return False
+        if 'pubhash' in permissions:
+            if payload_data.get('pubhash') != pubhash:
+                return False
+        return True
 
     def listener_delete(self, instance):
-        self._listener.pop(instance, None)
+        for topic in self._listener.pop(instance, ()):
+            self._unsubscribe(instance, topic)
 
 if __name__ == "__main__":
+    install_event_loop_policy(getattr(pikaconfig, 'EVENT_LOOP_POLICY', None))
+    asyncio.set_event_loop(asyncio.new_event_loop())
     consumer = AsyncConsumer(pikaconfig)
     consumer.setup()
     try:
@@ -1,74 +1,266 @@
 import json
+import functools
+import signal
+import asyncio
 import time
 import logging
-from util import setupLogHandlers
+from util import setupLogHandlers, install_event_loop_policy
 
 
 import bitjws
 from tornado import web, ioloop
 from sockjs.tornado import SockJSRouter, SockJSConnection
-from sockjs_pika_consumer import AsyncConsumer
+from sockjs.tornado.session import Session
+from sockjs_pika_consumer import AsyncConsumer, topic_key, topic_frame
+from ingest import IngestClient, ShardedIngestClient
+from relay import RelayClient, RelayHandler
+from publisher import Publisher
+from admission import AdmissionControl, SessionPacer
+from lanes import PriorityLanes
+from precheck import precheck, MalformedToken, MissingField, DEFAULT_IAT_WINDOW
+from replay import ReplayCache, replay_key
+from resume import ResumeRegistry
+from timerwheel import TimerWheel
+from admin import ProfileHandler
+from loadshed import LagWatchdog
+from framing import StaticFrame, get_codec
+import authz
+import outbound
 
+import metrics
 import pikaconfig
 
 
-ERR_UNKNOWN_MSG = json.dumps({'method': 'error', 'reason': 'unknown message'})
-ERR_INVALID_DATA = json.dumps({'method': 'error', 'reason': 'invalid data'})
-ERR_AUTH_FAILED = json.dumps({'method': 'error', 'reason': 'bad credentials'})
+ERR_UNKNOWN_MSG = StaticFrame({'method': 'error', 'reason': 'unknown message'})
+ERR_INVALID_DATA = StaticFrame({'method': 'error', 'reason': 'invalid data'})
+ERR_AUTH_FAILED = StaticFrame({'method': 'error', 'reason': 'bad credentials'})
+ERR_RATE_LIMITED = StaticFrame({'method': 'error', 'reason': 'rate limited'})
+ERR_OVERLOADED = StaticFrame({'method': 'error', 'reason': 'overloaded'})
+ERR_NO_HISTORY = StaticFrame({'method': 'error',
+                              'reason': 'history not available'})
+PONG = StaticFrame({'method': 'pong'})
+
+# The open frame, spliced together so that the schemas, the same for
+# every session, are serialized once rather than per session.
+OPEN_FRAME = '{"method": "open", "now": %d, "resume": %s, "backoff": %s, "schemas": %s}'
+
+# Seconds before retrying to write the data lane of a session with no
+# transport attached, rounded up to a timer wheel tick.
+LANE_RETRY_DELAY = 0.05
+
+# Messages kept from a session still waiting for its open frame, handled
+# once it starts. Any more are ignored.
+MAX_HELD_MESSAGES = 8
 
 TOTP_NDIGITS = 6
 TOTP_TIMEOUT = 60 * 10  # 10 minutes
 
 
 class Connection(SockJSConnection):
+    # Per-session state lives in slots. SockJSConnection itself has no
+    # __slots__, so instances keep a __dict__, but it only holds the
+    # session set by the base class.
+    __slots__ = ('ip', 'user_id', 'pubhash', 'bucket', 'lanes',
+                 'drain_scheduled', 'dropped', 'resume_token', 'started', 'held',
+                 'last_seen', 'idle_timer', 'sub_timers', 'codec')
+
     schemas = pikaconfig.SCHEMAS
+    iat_window = getattr(pikaconfig, 'IAT_WINDOW', DEFAULT_IAT_WINDOW)
+    # Set by the router when shedding load.
+    reject_subscriptions = False
+
+    @classmethod
+    def configure(cls, logger, consumer, config, io_loop=None):
+        """
+        Attach the state shared by all the sessions of a router.
+
+        :param logging.Logger logger: the server logger
+        :param AsyncConsumer consumer: the consumer delivering messages
+        :param config: the config module, e.g. pikaconfig
+        :param tornado.ioloop.IOLoop io_loop: the loop deferred session
+            setups run on, the current one by default
+        """
+        cls.logger = logger
+        cls.consumer = consumer
+        cls.admission = AdmissionControl(config)
+        cls.pacer = SessionPacer(
+            getattr(config, 'SESSION_SETUP_RATE', None),
+            getattr(config, 'SESSION_SETUP_PER_TICK', 50),
+            getattr(config, 'SESSION_SETUP_MAX_PENDING', 10000),
+            getattr(config, 'RECONNECT_BACKOFF_MIN', 1),
+            io_loop)
+        cls.schemas_json = json.dumps(cls.schemas)
+        cls.schemas_encoded = {}
+        cls.timers = TimerWheel(getattr(config, 'TIMER_TICK', 1),
+                                getattr(config, 'TIMER_SLOTS', 512), io_loop)
+        cls.idle_timeout = getattr(config, 'SESSION_IDLE_TIMEOUT', None)
+        cls.lane_max_data = getattr(config, 'LANE_MAX_DATA', 1000)
+        cls.subscription_ttl = getattr(config, 'SUBSCRIPTION_TTL', None)
+        cls.authorizer = authz.from_config(config)
+        # Client publishes share one pipelined publisher per process.
+        cls.publisher = None
+        cls.publish_authorizer = None
+        cls.max_message_size = cls.max_publish_size = 1024
+        if getattr(config, 'PUBLISH_ENABLED', False):
+            # Publishes are only accepted under a write policy.
+            cls.publish_authorizer = authz.from_config(config, 'PUBLISH')
+        if cls.publish_authorizer is not None:
+            cls.publisher = Publisher(
+                config,
+                max_buffer=getattr(config, 'PUBLISH_MAX_BUFFER', 10000),
+                max_in_flight=getattr(config, 'PUBLISH_MAX_IN_FLIGHT', 1000))
+            cls.publisher.start()
+            cls.max_publish_size = getattr(config, 'PUBLISH_MAX_BYTES', 16384)
+        elif getattr(config, 'PUBLISH_ENABLED', False):
+            logger.warning('publishing disabled: PUBLISH_ENABLED needs '
+                           'PUBLISH_POLICY_URL or PUBLISH_POLICY')
+        # History reads are sent on the data lane, so they must fit in it.
+        cls.history_max_records = min(
+            getattr(config, 'HISTORY_MAX_RECORDS', 500),
+            getattr(config, 'LANE_MAX_DATA', 1000))
+        cls.history_max_scan = getattr(config, 'HISTORY_MAX_SCAN_BYTES',
+                                       1024 * 1024)
+        cls.replay_cache = ReplayCache(
+            cls.iat_window[0],
+            getattr(config, 'REPLAY_BUCKET_SECONDS', 10),
+            getattr(config, 'REPLAY_MAX_ENTRIES', 1000000))
+        cls.resume_registry = ResumeRegistry(getattr(config, 'RESUME_TTL', 300))
+        cls.snapshot_path = getattr(config, 'RESUME_SNAPSHOT', None)
+        if cls.snapshot_path:
+            loaded = cls.resume_registry.load(cls.snapshot_path)
+            logger.info('Loaded %d resumable sessions from %s' % (
+                loaded, cls.snapshot_path))
+
+    @classmethod
+    def save_snapshot(cls):
+        """
+        Write the subscriptions of the authenticated sessions to the
+        snapshot file, so that they can be resumed after a restart.
+        """
+        if not cls.snapshot_path:
+            return
+        live = [(conn.resume_token, conn.pubhash, topics)
+                for conn, topics in cls.consumer.listener_items()
+                if conn.pubhash and topics]
+        cls.resume_registry.save(cls.snapshot_path, live)
+        cls.logger.info('Saved %d resumable sessions to %s' % (
+            len(cls.resume_registry), cls.snapshot_path))
 
     def on_message(self, msg):
-        if len(str(msg)) > 1024:
+        self.last_seen = time.monotonic()
+        # Only PUBLISH messages may be larger than max_message_size, and
+        # only once the session started.
+        if len(msg) > (self.max_publish_size if self.started else
+                       self.max_message_size):
             self.logger.info('rejected message from %s (%s): too large' % (
                 self.ip, self))
-            self.send(ERR_INVALID_DATA)
+            if self.started:
+                self.send_control(ERR_INVALID_DATA)
+            else:
+                metrics.incr('admission.held_dropped')
             return
+        # Admission control only looks at connection state, so it runs
+        # before the message is decoded or verified. Sessions still
+        # waiting for their open frame are not served yet.
+        if not self.started:
+            self._hold(msg)
+            return
+        if self.admission.check(self.bucket, self.ip, self.pubhash):
+            self.send_control(ERR_RATE_LIMITED)
+            return
+
+        if isinstance(msg, bytes):
+            # A binary envelope, see framing.
+            try:
+                if self.codec is None:
+                    raise ValueError('binary frame in text mode')
+                msg = self.codec.open_envelope(msg)
+            except ValueError as e:
+                self.logger.info('rejected message from %s (%s): %s' % (
+                    self.ip, self, e))
+                self.send_control(ERR_INVALID_DATA)
+                return
 
         received_at = '%.6f' % time.time()
 
-        self.logger.info('%s @ %s' % (str(msg), received_at))
-        # Check if the message received has at least the required fields.
+        self.logger.info('%s @ %s' % (msg, received_at))
+        # Check the structure and the required fields before spending
+        # any time on the signature.
         try:
-            payload_data = bitjws.validate_deserialize(msg)[1]['data']
-            if 'method' not in payload_data:
-                self.logger.info("method not in payload data")
-                self.send(ERR_UNKNOWN_MSG)  # method is required
+            unverified = precheck(msg, iat_window=self.iat_window)[1]
+            method = unverified['data']['method']
+            if method != 'PUBLISH' and len(msg) > self.max_message_size:
+                raise MalformedToken('message too large')
+            if (method in ('GET', 'HISTORY', 'PUBLISH') and
+                    'model' not in unverified['data']):
+                raise MissingField('model is required')
+            if (self.reject_subscriptions and
+                    method in ('GET', 'RESUME', 'HISTORY')):
+                metrics.incr('shed.subscriptions_rejected')
+                self.send_control(ERR_OVERLOADED)
                 return
-        except Exception, e:
+        except MissingField as e:
+            self.logger.info(e)
+            self.send_control(ERR_UNKNOWN_MSG)
+            return
+        except MalformedToken as e:
+            metrics.incr('precheck.rejected')
+            self.logger.info('rejected message from %s (%s): %s' % (
+                self.ip, self, e))
+            self.send_control(ERR_INVALID_DATA)
+            return
+
+        # Replays are dropped before verification; the key is only
+        # remembered once the signature has been checked.
+        replay = replay_key(msg, unverified)
+        if self.replay_cache.seen(replay, unverified['iat']):
+            metrics.incr('replay.rejected')
+            self.logger.info('rejected message from %s (%s): replayed' % (
+                self.ip, self))
+            self.send_control(ERR_INVALID_DATA)
+            return
+
+        try:
+            headers, payload = bitjws.validate_deserialize(msg)
+            payload_data = payload['data']
+            self.pubhash = headers.get('kid', self.pubhash)
+        except Exception as e:
             self.logger.exception(e)
-            self.send(ERR_INVALID_DATA)
+            self.send_control(ERR_INVALID_DATA)
             return
+        self.replay_cache.add(replay, unverified['iat'])
         self.logger.info(payload_data)
         # Handle the incoming message based on the method specified.
         if payload_data['method'] == 'GET':
-            if 'model' not in payload_data:
-                self.logger.info("model not in payload data")
-                self.send(ERR_UNKNOWN_MSG)  # model is required
+            try:
+                lname = topic_key(payload_data)
+            except ValueError as e:
+                self.logger.info('rejected subscription from %s (%s): %s' % (
+                    self.ip, self, e))
+                self.send_control(ERR_INVALID_DATA)
                 return
             allowed = self.consumer.listener_allowed(self, msg)
             self.logger.info(allowed)
             if not allowed:
                 self.logger.info("authentication failed")
-                self.send(ERR_AUTH_FAILED)
+                self.send_control(ERR_AUTH_FAILED)
                 return
-            if 'id' in payload_data:
-                lname = "%s_id_%s" % (payload_data['model'], payload_data['id'])
-            else:
-                lname = payload_data['model']
-            self.logger.info('adding listener to %s' % lname)
-            self.consumer.listener_add(self, [lname])
+            if self.authorizer is not None:
+                self._authorize(lname, self._add_listener)
+                return
+            self._add_listener(lname)
+        elif payload_data['method'] == 'RESUME':
+            self._handle_resume(payload_data)
+        elif payload_data['method'] == 'HISTORY':
+            self._handle_history(payload_data, msg)
+        elif payload_data['method'] == 'PUBLISH':
+            self._handle_publish(payload_data, msg)
         elif payload_data['method'] == 'ping':
             self._handle_ping(payload_data, received_at)
         else:
             self.logger.info('unknown message: "%s" @ %s' % (
                 payload_data['method'], received_at))
-            self.send(ERR_UNKNOWN_MSG)
+            self.send_control(ERR_UNKNOWN_MSG)
 
     def on_open(self, info):
         # Take care to use a proxy that ends up passing the right
@@ -76,17 +268,434 @@ class Connection(SockJSConnection):
         # and headers like X-Fowarded-For.
         self.ip = info.ip
         self.user_id = None
+        self.pubhash = None
+        self.bucket = self.admission.session_bucket()
+        # Created when a message first has to wait, see _enqueue.
+        self.lanes = None
+        self.drain_scheduled = False
+        self.dropped = 0
+        self.resume_token = self.resume_registry.new_token()
+        self.started = False
+        self.held = None
+        self.last_seen = time.monotonic()
+        self.idle_timer = None
+        self.sub_timers = None
+        # Raw websocket clients may ask for binary frames.
+        self.codec = None
+        encoding = info.get_argument('encoding')
+        if encoding and getattr(self.session.handler, 'name',
+                                None) == 'rawwebsocket':
+            if isinstance(encoding, bytes):
+                encoding = encoding.decode('ascii', 'replace')
+            self.codec = get_codec(encoding)
+            if self.codec is None:
+                self.logger.info('encoding %r not available, using text' % (
+                    encoding, ))
+        if self.idle_timeout:
+            self.idle_timer = self.timers.schedule(self.idle_timeout,
+                                                   self._check_idle)
         self.logger.info("%s (%s)" % (self, self.ip))
+        # The open frame is sent once the pacer lets this session in.
+        self.pacer.admit(self)
 
-        self.send(json.dumps({
-            'method': 'open',
-            'now': int(time.time()),
-            'schemas': self.schemas
-        }))
+    def start(self):
+        """Send the open frame, called by the pacer."""
+        self.started = True
+        now, backoff = int(time.time()), self.pacer.backoff()
+        if self.codec is None:
+            self.send_control(OPEN_FRAME % (
+                now, json.dumps(self.resume_token), json.dumps(backoff),
+                self.schemas_json))
+        else:
+            schemas = self.schemas_encoded.get(self.codec)
+            if schemas is None:
+                schemas = self.schemas_encoded[self.codec] = (
+                    self.codec.dumps(self.schemas))
+            self.send_control(self.codec.encode_map(
+                [('method', 'open'), ('now', now),
+                 ('resume', self.resume_token), ('backoff', backoff)],
+                [('schemas', schemas)]))
+        held, self.held = self.held, None
+        for msg in held or ():
+            self.on_message(msg)
+
+    def _hold(self, msg):
+        """Keep a message sent before the open frame, to handle at start."""
+        if self.held is None:
+            self.held = []
+        if len(self.held) >= MAX_HELD_MESSAGES:
+            metrics.incr('admission.held_dropped')
+            return
+        self.held.append(msg)
+
+    def reject(self, retry_after):
+        """Turn the session away, called by the pacer when it is full."""
+        self.logger.info('rejected session %s (%s): busy, retry after %s' % (
+            self, self.ip, retry_after))
+        self.send_control({'method': 'error', 'reason': 'busy',
+                           'retry_after': retry_after})
+        self.session.close(3503, 'busy')
 
     def on_close(self):
         self.logger.info("close %s" % self)
+        self.held = None
+        if self.started:
+            self.pacer.release()
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        if self.sub_timers:
+            for timer in self.sub_timers.values():
+                timer.cancel()
+            self.sub_timers = None
+        topics = self.consumer.listener_topics(self)
+        if self.pubhash and topics:
+            self.resume_registry.retain(self.resume_token, self.pubhash, topics)
         self.consumer.listener_delete(self)
+        self.lanes = None
+
+    def send(self, message, binary=False, trace=None):
+        """
+        Send a data message, queued behind any pending control frame.
+
+        :param str message: the compact serialized JWS
+        :param MessageTrace trace: the latency trace of the message
+        """
+        if self.codec is not None:
+            message = self.codec.envelope(message)
+        self._enqueue(message, False, trace)
+
+    def send_control(self, frame):
+        """
+        Send a control frame ahead of any queued data message.
+
+        :param dict|StaticFrame|str|bytes frame: the frame, or the frame
+            already encoded for this session
+        """
+        if isinstance(frame, StaticFrame):
+            frame = frame.encode(self.codec)
+        elif isinstance(frame, dict):
+            if self.codec is None:
+                frame = json.dumps(frame)
+            else:
+                frame = self.codec.dumps(frame)
+        self._enqueue(frame, True)
+
+    def _write(self, message):
+        SockJSConnection.send(self, message, self.codec is not None)
+
+    def _write_data(self, message):
+        """
+        Write a data message. On websockets the encodings shared by every
+        session the message goes to are written, see outbound.
+        """
+        handler = self.session.handler
+        name = getattr(handler, 'name', None)
+        if name == 'rawwebsocket':
+            if self.codec is not None:
+                written = outbound.write_websocket(handler, message,
+                                                   outbound.OPCODE_BINARY)
+            else:
+                written = outbound.write_websocket(
+                    handler, outbound.message_for(message).utf8,
+                    outbound.OPCODE_TEXT)
+        elif (name == 'websocket' and handler.active and
+                not self.session.send_queue):
+            written = outbound.write_websocket(
+                handler, outbound.message_for(message).sockjs_frame,
+                outbound.OPCODE_TEXT)
+            if written:
+                self.session.stats.on_pack_sent(1)
+        else:
+            written = False
+        if not written:
+            metrics.incr('outbound.fallback_writes')
+            self._write(message)
+
+    def _enqueue(self, message, control, trace=None):
+        if self.is_closed:
+            return
+        # Control frames skip queued data right away, and data goes out
+        # directly when nothing is queued and the transport can take it.
+        if control:
+            direct = self.lanes is None or not self.lanes.control
+        else:
+            direct = not self.lanes and self._writable()
+        if direct:
+            metrics.incr('lanes.direct')
+            if control:
+                self._write(message)
+            else:
+                self._write_data(message)
+            if trace is not None:
+                trace.mark_written()
+            return
+        if self.lanes is None:
+            self.lanes = PriorityLanes(self.lane_max_data)
+        if self.lanes.push(message, control, trace=trace):
+            self.dropped += 1
+        if not self.drain_scheduled:
+            self.drain_scheduled = True
+            self.session.server.io_loop.add_callback(self._drain)
+
+    def _drain(self):
+        self.drain_scheduled = False
+        if self.is_closed:
+            self.lanes = None
+            return
+        if self.lanes is None:
+            return
+        if self.dropped:
+            # Tell the client it missed messages, so it can catch up.
+            dropped, self.dropped = self.dropped, 0
+            self.send_control({'method': 'dropped', 'count': dropped})
+        if self.lanes.drain(self._write, self._writable,
+                            write_data=self._write_data):
+            self.drain_scheduled = True
+            if self._writable():
+                # Only the batch limit was hit.
+                self.session.server.io_loop.add_callback(self._drain)
+            else:
+                self._wait_writable()
+        else:
+            # Idle sessions don't keep empty lanes around.
+            self.lanes = None
+
+    def _wait_writable(self):
+        """
+        Call _drain once the transport may take more data: when a
+        websocket has flushed its write buffer, or on a later timer wheel
+        tick for a session with no transport attached.
+        """
+        handler = self.session.handler
+        ws_connection = getattr(handler, 'ws_connection', None)
+        stream = getattr(ws_connection, 'stream', None)
+        if (handler is not None and handler.active and stream is not None
+                and not stream.closed() and stream.writing()):
+            # The future of an empty write resolves once everything
+            # written before it has been flushed.
+            stream.write(b'').add_done_callback(lambda future: self._drain())
+            return
+        self.timers.schedule(LANE_RETRY_DELAY, self._drain)
+
+    def _writable(self):
+        """
+        Tell if the transport can take more data right now: a handler is
+        attached and, for websockets, nothing is left in its write buffer.
+        """
+        handler = self.session.handler
+        if handler is None or not handler.active:
+            return False
+        ws_connection = getattr(handler, 'ws_connection', None)
+        if ws_connection is None or ws_connection.stream is None:
+            return True
+        return not ws_connection.stream.writing()
+
+    def _handle_resume(self, data):
+        """Process a "RESUME" message.
+
+        The subscriptions kept under the resume token of a previous session
+        are given to this one, provided the message was signed by the key
+        that owned them. They were authorized when first subscribed to, so
+        they are not checked again.
+        """
+        topics = self.resume_registry.claim(data.get('token'), self.pubhash)
+        if topics is None:
+            self.logger.info('resume failed for %s (%s)' % (self, self.ip))
+            self.send_control(ERR_AUTH_FAILED)
+            return
+        metrics.incr('resume.resumed')
+        self.logger.info('resuming %d listeners' % len(topics))
+        self._subscribe(topics)
+        self.send_control({'method': 'resumed', 'subscriptions': len(topics)})
+
+    def _handle_history(self, data, msg):
+        """Process a "HISTORY" message.
+
+        Up to limit logged messages about the model, or the item if an id
+        is given, are sent from sequence number from_seq or from time
+        since, up to time until. They are sent as data messages, after a
+        history frame giving their count, the from_seq to ask for next and
+        whether more records follow. A read scans at most
+        HISTORY_MAX_SCAN_BYTES of the log, so it can end early, with more
+        set, even when fewer records than asked for were found.
+        """
+        history = self.consumer.history
+        if history is None or not history.wants(data['model']):
+            self.send_control(ERR_NO_HISTORY)
+            return
+        query = {}
+        try:
+            for name, kind in (('from_seq', int), ('since', (int, float)),
+                               ('until', (int, float)), ('limit', int)):
+                value = data.get(name)
+                if value is not None:
+                    if isinstance(value, bool) or not isinstance(value, kind):
+                        raise ValueError('invalid %s' % name)
+                    query[name] = value
+            if query.get('from_seq', 0) < 0 or query.get('limit', 1) < 1:
+                raise ValueError('out of range')
+            topic = topic_key(data)
+        except ValueError as e:
+            self.logger.info('rejected history request from %s (%s): %s' % (
+                self.ip, self, e))
+            self.send_control(ERR_INVALID_DATA)
+            return
+        query['limit'] = min(query.get('limit', self.history_max_records),
+                             self.history_max_records)
+        query['max_scan'] = self.history_max_scan
+        if not self.consumer.listener_allowed(self, msg):
+            self.logger.info("authentication failed")
+            self.send_control(ERR_AUTH_FAILED)
+            return
+        send = functools.partial(self._send_history, query=query)
+        if self.authorizer is not None:
+            self._authorize(topic, send)
+            return
+        send(topic)
+
+    def _send_history(self, topic, query):
+        records, next_seq, more = self.consumer.history.read(topic, **query)
+        metrics.incr('history.reads')
+        frame = {'method': 'history', 'count': len(records),
+                 'next_seq': next_seq, 'more': more}
+        frame.update(topic_frame(topic))
+        self.send_control(frame)
+        for seq, at, body in records:
+            self.send(body.decode('utf-8'))
+
+    def _handle_publish(self, data, msg):
+        """Process a "PUBLISH" message.
+
+        The signed message itself is published to the exchange, provided
+        the schema route of its model and the write policy let this key
+        write it. Publishes
+        are pipelined: the session gets a {"method": "published", "ref":
+        ...} frame, with the ref given in the message if any, once the
+        broker confirmed each of them.
+        """
+        ref = data.get('ref')
+        if self.publisher is None:
+            self._publish_error('publishing not available', ref)
+            return
+        try:
+            topic = topic_key(data)
+        except ValueError as e:
+            self.logger.info('rejected publish from %s (%s): %s' % (
+                self.ip, self, e))
+            self._publish_error('invalid data', ref)
+            return
+        if not self.consumer.publish_allowed(data, self.pubhash):
+            self.logger.info('%s not allowed to publish to %r' % (
+                self.pubhash, data['model']))
+            self._publish_error('bad credentials', ref)
+            return
+        self._authorize(
+            topic, lambda topic: self._publish(msg, ref),
+            authorizer=self.publish_authorizer,
+            denied=lambda: self._publish_error('bad credentials', ref))
+
+    def _publish(self, msg, ref):
+        # Confirmations arrive on the publisher thread.
+        confirmed = functools.partial(self.session.server.io_loop.add_callback,
+                                      self._on_published, ref)
+        if not self.publisher.publish(msg, callback=confirmed):
+            metrics.incr('publish.rejected')
+            self._publish_error('overloaded', ref)
+            return
+        metrics.incr('publish.accepted')
+
+    def _on_published(self, ref):
+        metrics.incr('publish.confirmed')
+        if self.is_closed:
+            return
+        self.send_control({'method': 'published', 'ref': ref})
+
+    def _publish_error(self, reason, ref):
+        self.send_control({'method': 'error', 'reason': reason, 'ref': ref})
+
+    def _authorize(self, topic, callback, authorizer=None, denied=None):
+        """
+        Call callback(topic) once the policy allows this session's key to
+        read topic, or to publish to it with the publish_authorizer.
+        Cached decisions are applied right away; others are looked up
+        without blocking the IOLoop. Denied requests get ERR_AUTH_FAILED,
+        or denied() is called if given.
+        """
+        if authorizer is None:
+            authorizer = self.authorizer
+        model, item_id = topic if isinstance(topic, tuple) else (topic, None)
+        allowed = authorizer.cached(self.pubhash, model, item_id)
+        if allowed is not None:
+            self._on_authorized(topic, allowed, callback, denied)
+            return
+        future = authorizer.lookup(self.pubhash, model, item_id)
+        future.add_done_callback(lambda future: self._on_authorized(
+            topic, future.result(), callback, denied))
+
+    def _on_authorized(self, topic, allowed, callback, denied=None):
+        if self.is_closed:
+            return
+        if not allowed:
+            self.logger.info('%s not authorized for %r' % (self.pubhash, topic))
+            if denied is None:
+                self.send_control(ERR_AUTH_FAILED)
+            else:
+                denied()
+            return
+        callback(topic)
+
+    def _add_listener(self, topic):
+        self.logger.info('adding listener to %r' % (topic, ))
+        self._subscribe([topic])
+        frame = {'method': 'subscribed'}
+        frame.update(topic_frame(topic))
+        self.send_control(frame)
+
+    def _subscribe(self, topics):
+        """
+        Add this session to the subscribers of topics, for
+        SUBSCRIPTION_TTL seconds if set. Subscribing again to a topic
+        renews it.
+        """
+        self.consumer.listener_add(self, topics)
+        if not self.subscription_ttl:
+            return
+        if self.sub_timers is None:
+            self.sub_timers = {}
+        for topic in topics:
+            timer = self.sub_timers.get(topic)
+            if timer is not None:
+                timer.cancel()
+            self.sub_timers[topic] = self.timers.schedule(
+                self.subscription_ttl, self._expire_subscription, topic)
+
+    def _expire_subscription(self, topic):
+        del self.sub_timers[topic]
+        if self.is_closed:
+            return
+        metrics.incr('timers.subscriptions_expired')
+        self.consumer.listener_remove(self, [topic])
+        frame = {'method': 'expired'}
+        frame.update(topic_frame(topic))
+        self.send_control(frame)
+
+    def _check_idle(self):
+        """
+        Close the session if it sent nothing for SESSION_IDLE_TIMEOUT
+        seconds. The timer is only pushed back when it fires, so that
+        inbound messages just have to update last_seen.
+        """
+        self.idle_timer = None
+        if self.is_closed:
+            return
+        idle = time.monotonic() - self.last_seen
+        if idle < self.idle_timeout:
+            self.idle_timer = self.timers.schedule(self.idle_timeout - idle,
+                                                   self._check_idle)
+            return
+        metrics.incr('timers.idle_reaped')
+        self.logger.info('closing idle session %s (%s)' % (self, self.ip))
+        self.session.close(3000, 'idle')
 
     def _handle_ping(self, data, received_at):
         """Process a "ping" message.
@@ -97,15 +706,73 @@ class Connection(SockJSConnection):
         """
         if not self.user_id:
             # User is not logged in, pong only to this connection.
-            self.send(json.dumps({'method': 'pong'}))
+            self.send_control(PONG)
             return
 
         msg = json.dumps({'method': 'pong', 'for': self.user_id})
         self.consumer.on_message(None, None, None, msg)
 
 
+class WheelSession(Session):
+    """
+    A sockjs session whose heartbeats are driven by the timer wheel of
+    its connection class instead of one IOLoop timeout per session.
+
+    A websocket that is still writing when a heartbeat is due, without
+    having written anything since the previous heartbeat, is taken for
+    half-open and closed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(WheelSession, self).__init__(*args, **kwargs)
+        self._heartbeat_due = None
+        self._write_progress = None
+
+    def start_heartbeat(self):
+        self.stop_heartbeat()
+        self._heartbeat_due = None
+        self._heartbeat_timer = self.conn.timers.schedule(
+            self._heartbeat_interval / 1000.0, self._wheel_heartbeat)
+
+    def stop_heartbeat(self):
+        if self._heartbeat_timer is not None:
+            self._heartbeat_timer.cancel()
+            self._heartbeat_timer = None
+
+    def delay_heartbeat(self):
+        # Pushed back lazily when the timer fires.
+        self._heartbeat_due = (time.monotonic() +
+                               self._heartbeat_interval / 1000.0)
+
+    def _wheel_heartbeat(self):
+        self._heartbeat_timer = None
+        if self.handler is None or self.conn is None:
+            return
+        interval = self._heartbeat_interval / 1000.0
+        due, self._heartbeat_due = self._heartbeat_due, None
+        if due is not None and due - time.monotonic() > 0:
+            self._heartbeat_timer = self.conn.timers.schedule(
+                due - time.monotonic(), self._wheel_heartbeat)
+            return
+        ws_connection = getattr(self.handler, 'ws_connection', None)
+        stream = ws_connection and ws_connection.stream
+        if stream is not None and stream.writing():
+            progress = getattr(stream, '_total_write_done_index', None)
+            if progress is not None and progress == self._write_progress:
+                metrics.incr('timers.heartbeat_timeouts')
+                self.close(3000, 'heartbeat timeout')
+                return
+            self._write_progress = progress
+        else:
+            self._write_progress = None
+        self._heartbeat()
+        self._heartbeat_timer = self.conn.timers.schedule(
+            interval, self._wheel_heartbeat)
+
+
 class SockJSPikaRouter(SockJSRouter):
     def __init__(self, connection, *args, **kwargs):
+        kwargs.setdefault('session_kls', WheelSession)
         super(SockJSPikaRouter, self).__init__(connection, *args, **kwargs)
 
         logger = logging.getLogger(name='api-stream')
@@ -113,16 +780,113 @@ class SockJSPikaRouter(SockJSRouter):
             logger.addHandler(h)
         logger.setLevel(logging.DEBUG)
         logger.info("Router created")
-        self._connection.logger = logger
 
         consumer = AsyncConsumer(pikaconfig, self.io_loop)
-        consumer.setup()
-        self._connection.consumer = consumer
+        ingest_socket = getattr(pikaconfig, 'INGEST_SOCKET', None)
+        shard_count = getattr(pikaconfig, 'SHARD_COUNT', 0)
+        upstream = getattr(pikaconfig, 'RELAY_UPSTREAM', None)
+        if upstream:
+            # Verified messages come from an upstream node, for the
+            # topics subscribed to here.
+            privkey = bitjws.PrivateKey(bitjws.wif_to_privkey(
+                pikaconfig.RELAY_KEY))
+            RelayClient(upstream, consumer, privkey).start(self.io_loop)
+        elif shard_count:
+            # Verified messages come from the shards holding the topics
+            # subscribed to.
+            ShardedIngestClient(pikaconfig.SHARD_SOCKET, shard_count,
+                                consumer).start(self.io_loop)
+        elif ingest_socket:
+            # Verified messages come from the per-host ingest process.
+            IngestClient(ingest_socket, consumer).start(self.io_loop)
+        else:
+            consumer.setup()
+        self._connection.configure(logger, consumer, pikaconfig, self.io_loop)
+        self._connection.timers.start()
+        registry = self._connection.resume_registry
+        ioloop.PeriodicCallback(registry.expire,
+                                registry.ttl * 1000).start()
+        if consumer.history is not None:
+            ioloop.PeriodicCallback(
+                consumer.history.enforce_retention,
+                getattr(pikaconfig, 'HISTORY_RETENTION_INTERVAL', 60) * 1000
+            ).start()
 
+        self.logger = logger
+        self.consumer = consumer
+        levels = getattr(pikaconfig, 'LOAD_SHED_LEVELS', None)
+        if levels:
+            self.watchdog = LagWatchdog(
+                levels, self.on_load_level,
+                getattr(pikaconfig, 'LAG_CHECK_INTERVAL', 0.1),
+                getattr(pikaconfig, 'LOAD_SHED_HOLD', 5),
+                io_loop=self.io_loop)
+            self.watchdog.start()
 
-Router = SockJSPikaRouter(Connection, '')
-app = web.Application(Router.urls)
+    def on_load_level(self, level, lag):
+        """
+        Shed load according to the level reported by the lag watchdog.
+        Each level adds to the ones below it, and going down a level
+        undoes its measure.
 
-if __name__ == "__main__":
+            1. send only the latest message about an item per
+               CONFLATE_INTERVAL
+            2. stop consuming messages, they wait in the broker, and are
+               conflated once consumption resumes at level 1
+            3. reject new subscriptions
+        """
+        self.logger.warning('IOLoop lag %.3fs, load level %d' % (lag, level))
+        self.consumer.conflate = level >= 1
+        if level >= 2:
+            self.consumer.pause_consuming()
+        else:
+            self.consumer.resume_consuming()
+        self._connection.reject_subscriptions = level >= 3
+
+
+def make_app():
+    """
+    Create the SockJS router and the Tornado application serving it.
+
+    This must be called after the event loop policy has been installed,
+    since the router binds its consumer to the current IOLoop.
+
+    :rtype: tornado.web.Application
+    """
+    router = SockJSPikaRouter(Connection, '', io_loop=ioloop.IOLoop.current())
+    urls = list(router.urls)
+    admins = getattr(pikaconfig, 'ADMIN_PUBHASHES', ())
+    if admins:
+        urls.append((r'/admin/profile', ProfileHandler, dict(
+            admins=admins, replay_cache=Connection.replay_cache,
+            iat_window=Connection.iat_window,
+            interval=getattr(pikaconfig, 'PROFILE_INTERVAL', 0.005),
+            max_seconds=getattr(pikaconfig, 'PROFILE_MAX_SECONDS', 60))))
+    relays = getattr(pikaconfig, 'RELAY_PUBHASHES', ())
+    if relays:
+        urls.append((r'/relay', RelayHandler, dict(
+            consumer=router.consumer, relays=relays,
+            replay_cache=Connection.replay_cache,
+            iat_window=Connection.iat_window,
+            max_buffer=getattr(pikaconfig, 'RELAY_MAX_BUFFER',
+                               64 * 1024 * 1024))))
+    return web.Application(urls)
+
+
+async def main():
+    app = make_app()
     app.listen(8123)
-    ioloop.IOLoop.instance().start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    Connection.save_snapshot()
+    if Connection.publisher is not None:
+        Connection.publisher.stop()
+
+
+if __name__ == "__main__":
+    install_event_loop_policy(getattr(pikaconfig, 'EVENT_LOOP_POLICY', None))
+    asyncio.run(main())
@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import time
 import pika
 
 import bitjws
@@ -28,13 +29,8 @@ def publish(message):
 privkey = bitjws.PrivateKey()
 pubhash = bitjws.pubkey_to_addr(privkey.pubkey.serialize())
 
-mdata = {'metal': 'testinium', 'mint': 'publisherDummy.py'}
-msg = bitjws.sign_serialize(privkey,
-                            metal=mdata['metal'],
-                            mint=mdata['mint'],
-                            pubhash=pubhash,
-                            headers={},
-                            permissions=['authenticate'],
-                            method='RESPONSE',
-                            model='coin')
+mdata = {'metal': 'testinium', 'mint': 'publisherDummy.py',
+         'pubhash': pubhash, 'method': 'RESPONSE', 'model': 'coin'}
+# Consumers drop messages without a recent iat before verifying them.
+msg = bitjws.sign_serialize(privkey, data=mdata, iat=time.time())
 publish(msg)
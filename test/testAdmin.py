@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import asyncio
+import unittest
+
+from tornado import web
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import bitjws
+
+from admin import AdminHandler, ProfileHandler
+from precheck import DEFAULT_IAT_WINDOW
+from replay import ReplayCache
+
+
+class DummyRequest(object):
+
+    def __init__(self, body):
+        self.body = body.encode('ascii')
+
+
+class AuthenticateTest(unittest.TestCase):
+
+    def setUp(self):
+        privkey = bitjws.PrivateKey()
+        self.message = bitjws.sign_serialize(
+            privkey, data={'method': 'PROFILE', 'seconds': 1},
+            iat=time.time())
+        self.pubhash = bitjws.validate_deserialize(self.message)[0]['kid']
+        self.replay_cache = ReplayCache(DEFAULT_IAT_WINDOW[0])
+
+    def authenticate(self, admins):
+        # The handler is driven directly, without a request cycle.
+        handler = AdminHandler.__new__(AdminHandler)
+        handler.initialize(admins, self.replay_cache, DEFAULT_IAT_WINDOW)
+        handler.request = DummyRequest(self.message)
+        return handler.authenticate()
+
+    def assertForbidden(self, admins):
+        with self.assertRaises(web.HTTPError) as cm:
+            self.authenticate(admins)
+        self.assertEqual(cm.exception.status_code, 403)
+
+    def test_admin(self):
+        self.assertEqual(self.authenticate([self.pubhash]),
+                         {'method': 'PROFILE', 'seconds': 1})
+
+    def test_bad_signature(self):
+        # As bitjws does when the signature doesn't match.
+        validate = bitjws.validate_deserialize
+        bitjws.validate_deserialize = lambda token: (None, None)
+        self.addCleanup(setattr, bitjws, 'validate_deserialize', validate)
+        self.assertForbidden([self.pubhash])
+
+    def test_pubhash_not_allowed(self):
+        self.assertForbidden(['other'])
+
+    def test_replay(self):
+        self.authenticate([self.pubhash])
+        self.assertForbidden([self.pubhash])
+
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.privkey = bitjws.PrivateKey()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def post(self, **data):
+        message = bitjws.sign_serialize(self.privkey, data=data,
+                                        iat=time.time())
+        pubhash = bitjws.validate_deserialize(message)[0]['kid']
+        handler = ProfileHandler.__new__(ProfileHandler)
+        handler.initialize([pubhash], ReplayCache(DEFAULT_IAT_WINDOW[0]),
+                           DEFAULT_IAT_WINDOW)
+        handler.request = DummyRequest(message)
+        return self.loop.run_until_complete(handler.post())
+
+    def test_seconds_must_be_finite(self):
+        for seconds in ('nan', 'inf', '-inf', float('nan'), 'x', None):
+            with self.assertRaises(web.HTTPError) as cm:
+                self.post(method='PROFILE', seconds=seconds)
+            self.assertEqual(cm.exception.status_code, 400)
+        self.assertFalse(ProfileHandler.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
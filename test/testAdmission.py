@@ -0,0 +1,175 @@
+import os
+import sys
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import metrics
+from admission import (TokenBucket, KeyedRateLimiter, AdmissionControl,
+                       SessionPacer)
+
+
+class Config(object):
+    RATE_LIMIT_SESSION = (1, 2)
+    RATE_LIMIT_IP = (1, 3)
+    RATE_LIMIT_PUBHASH = (1, 1)
+    RATE_LIMIT_MAX_KEYS = 2
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(2, 3, now=0)
+        self.assertTrue(all(bucket.consume(0) for _ in range(3)))
+        self.assertFalse(bucket.consume(0))
+        self.assertTrue(bucket.consume(0.5))
+        self.assertFalse(bucket.consume(0.5))
+
+    def test_refill_is_capped(self):
+        bucket = TokenBucket(1, 2, now=0)
+        bucket.consume(0)
+        bucket.consume(0)
+        self.assertTrue(bucket.is_full(100))
+        bucket.consume(100)
+        self.assertEqual(bucket.tokens, 1)
+
+
+class KeyedRateLimiterTest(unittest.TestCase):
+
+    def test_keys_are_independent(self):
+        limiter = KeyedRateLimiter(1, 1)
+        self.assertTrue(limiter.allow('a', 0))
+        self.assertFalse(limiter.allow('a', 0))
+        self.assertTrue(limiter.allow('b', 0))
+
+    def test_least_recently_used_bucket_is_evicted(self):
+        limiter = KeyedRateLimiter(1, 1, max_keys=2)
+        limiter.allow('a', 0)
+        limiter.allow('b', 10)
+        limiter.allow('a', 10)
+        limiter.allow('c', 10)
+        self.assertEqual(len(limiter), 2)
+        # 'b' was evicted and starts over, 'a' kept its empty bucket.
+        self.assertTrue(limiter.allow('b', 10))
+        self.assertFalse(limiter.allow('c', 10))
+
+    def test_cap_holds_under_churn(self):
+        limiter = KeyedRateLimiter(1, 1, max_keys=100)
+        for n in range(10000):
+            # Every key stays busy, none of the buckets ever refills.
+            limiter.allow('key-%d' % n, 0)
+            limiter.allow('key-%d' % n, 0)
+            self.assertLessEqual(len(limiter), 100)
+        self.assertEqual(len(limiter), 100)
+
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.admission = AdmissionControl(Config)
+
+    def test_session_limit(self):
+        bucket = self.admission.session_bucket()
+        self.assertIsNone(self.admission.check(bucket, '1.2.3.4'))
+        self.assertIsNone(self.admission.check(bucket, '1.2.3.4'))
+        self.assertEqual(self.admission.check(bucket, '1.2.3.4'), 'session')
+        self.assertEqual(metrics.get('admission.rejected.session'), 1)
+
+    def test_ip_limit_spans_sessions(self):
+        for _ in range(3):
+            bucket = self.admission.session_bucket()
+            self.assertIsNone(self.admission.check(bucket, '1.2.3.4'))
+        bucket = self.admission.session_bucket()
+        self.assertEqual(self.admission.check(bucket, '1.2.3.4'), 'ip')
+
+    def test_pubhash_limit(self):
+        self.assertIsNone(self.admission.check(None, '1.1.1.1', 'pub'))
+        self.assertEqual(self.admission.check(None, '2.2.2.2', 'pub'),
+                         'pubhash')
+        self.assertEqual(metrics.get('admission.rejected.pubhash'), 1)
+
+
+
+class DummySession(object):
+    is_closed = False
+
+    def __init__(self):
+        self.started = False
+        self.retry_after = None
+
+    def start(self):
+        self.started = True
+
+    def reject(self, retry_after):
+        self.retry_after = retry_after
+
+
+class DummyLoop(object):
+    def __init__(self):
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def call_later(self, delay, callback):
+        self.callbacks.append(callback)
+
+    def run(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class SessionPacerTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.loop = DummyLoop()
+
+    def test_unpaced(self):
+        pacer = SessionPacer(None, io_loop=self.loop)
+        sessions = [DummySession() for _ in range(100)]
+        for session in sessions:
+            pacer.admit(session)
+        self.assertTrue(all(s.started for s in sessions))
+        self.assertEqual(pacer.sessions, 100)
+
+    def test_per_tick_limit(self):
+        pacer = SessionPacer((1000, 1000), per_tick=3, io_loop=self.loop)
+        sessions = [DummySession() for _ in range(7)]
+        for session in sessions:
+            pacer.admit(session)
+        self.assertEqual(sum(s.started for s in sessions), 3)
+        self.assertEqual(len(pacer), 4)
+        self.loop.run()
+        self.assertEqual(sum(s.started for s in sessions), 6)
+        self.loop.run()
+        self.assertTrue(all(s.started for s in sessions))
+        self.assertEqual(metrics.get('admission.sessions.deferred'), 4)
+
+    def test_reject_when_full(self):
+        pacer = SessionPacer((1, 1), per_tick=10, max_pending=2,
+                             min_backoff=2, io_loop=self.loop)
+        sessions = [DummySession() for _ in range(4)]
+        for session in sessions:
+            pacer.admit(session)
+        self.assertTrue(sessions[0].started)
+        self.assertEqual(len(pacer), 2)
+        self.assertIsNone(sessions[2].retry_after)
+        self.assertGreaterEqual(sessions[3].retry_after, 2)
+        self.assertEqual(metrics.get('admission.sessions.rejected'), 1)
+
+    def test_backoff_spread(self):
+        pacer = SessionPacer((10, 10), min_backoff=1, io_loop=self.loop)
+        pacer.sessions = 1000
+        delays = [pacer.backoff() for _ in range(100)]
+        self.assertTrue(all(1 <= d <= 100 for d in delays))
+        self.assertGreater(max(delays) - min(delays), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import os
+import sys
+import asyncio
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import metrics
+from authz import Authorizer, CallablePolicy, HTTPPolicy, from_config
+
+
+def allow_absolute(pubhash, model, item_id):
+    return os.path.isabs(pubhash)
+
+
+class SlowPolicy(object):
+    """A policy allowing odd ids, answering after a loop iteration."""
+
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    async def check(self, pubhash, model, item_id):
+        self.calls.append((pubhash, model, item_id))
+        await asyncio.sleep(0)
+        if self.fail:
+            raise IOError('policy unavailable')
+        return int(item_id) % 2 == 1
+
+
+class AuthorizerTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_concurrent_lookups_are_coalesced(self):
+        policy = SlowPolicy()
+        authorizer = Authorizer(policy)
+
+        async def burst():
+            return await asyncio.gather(*[
+                authorizer.authorize('pk', 'coin', '1') for _ in range(10)])
+
+        self.assertEqual(self.run_async(burst()), [True] * 10)
+        self.assertEqual(policy.calls, [('pk', 'coin', '1')])
+        self.assertEqual(metrics.get('authz.coalesced'), 9)
+
+    def test_decisions_are_cached(self):
+        policy = SlowPolicy()
+        authorizer = Authorizer(policy, ttl=60, negative_ttl=10)
+        self.assertTrue(self.run_async(authorizer.authorize('pk', 'coin', '1')))
+        self.assertFalse(self.run_async(authorizer.authorize('pk', 'coin', '2')))
+        self.assertTrue(authorizer.cached('pk', 'coin', '1'))
+        self.assertIs(authorizer.cached('pk', 'coin', '2'), False)
+        self.assertIsNone(authorizer.cached('other', 'coin', '1'))
+        self.assertEqual(len(policy.calls), 2)
+        self.assertEqual(metrics.get('authz.denied'), 1)
+
+    def test_decisions_expire(self):
+        authorizer = Authorizer(SlowPolicy(), ttl=60, negative_ttl=10)
+        self.run_async(authorizer.authorize('pk', 'coin', '1'))
+        self.run_async(authorizer.authorize('pk', 'coin', '2'))
+        now = authorizer._cache[('pk', 'coin', '2')][1]
+        self.assertIsNone(authorizer.cached('pk', 'coin', '2', now=now))
+        self.assertTrue(authorizer.cached('pk', 'coin', '1', now=now))
+        self.assertIsNone(authorizer.cached('pk', 'coin', '1', now=now + 60))
+        self.assertEqual(len(authorizer), 0)
+
+    def test_errors_deny_and_are_not_cached(self):
+        policy = SlowPolicy(fail=True)
+        authorizer = Authorizer(policy)
+        self.assertFalse(self.run_async(authorizer.authorize('pk', 'coin', '1')))
+        self.assertIsNone(authorizer.cached('pk', 'coin', '1'))
+        self.assertEqual(metrics.get('authz.errors'), 1)
+        policy.fail = False
+        self.assertTrue(self.run_async(authorizer.authorize('pk', 'coin', '1')))
+
+    def test_cache_is_bounded(self):
+        authorizer = Authorizer(SlowPolicy(), max_entries=2)
+        for item_id in ('1', '3', '5'):
+            self.run_async(authorizer.authorize('pk', 'coin', item_id))
+        self.assertEqual(len(authorizer), 2)
+        self.assertIsNone(authorizer.cached('pk', 'coin', '1'))
+
+    def test_concurrency_is_limited(self):
+        running = []
+        peak = []
+
+        async def check(pubhash, model, item_id):
+            running.append(item_id)
+            peak.append(len(running))
+            await asyncio.sleep(0.001)
+            running.remove(item_id)
+            return True
+
+        authorizer = Authorizer(CallablePolicy(check), max_concurrent=3)
+
+        async def burst():
+            return await asyncio.gather(*[
+                authorizer.authorize('pk', 'coin', str(i)) for i in range(10)])
+
+        self.assertEqual(self.run_async(burst()), [True] * 10)
+        self.assertEqual(max(peak), 3)
+
+
+class FromConfigTest(unittest.TestCase):
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(from_config(object()))
+
+    def test_local_policy(self):
+        class Config(object):
+            AUTHZ_POLICY = __name__ + '.allow_absolute'
+            AUTHZ_CACHE_TTL = 5
+
+        authorizer = from_config(Config)
+        self.assertIsInstance(authorizer.policy, CallablePolicy)
+        self.assertEqual(authorizer.ttl, 5)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertTrue(loop.run_until_complete(
+                authorizer.authorize('/', 'coin', None)))
+            self.assertFalse(loop.run_until_complete(
+                authorizer.authorize('pk', 'coin', None)))
+        finally:
+            loop.close()
+
+    def test_write_policy(self):
+        class Config(object):
+            AUTHZ_POLICY = __name__ + '.allow_absolute'
+            PUBLISH_POLICY_URL = 'http://127.0.0.1:8002/publish'
+            AUTHZ_CACHE_TTL = 5
+
+        authorizer = from_config(Config, 'PUBLISH')
+        self.assertIsInstance(authorizer.policy, HTTPPolicy)
+        self.assertEqual(authorizer.policy.url, Config.PUBLISH_POLICY_URL)
+        self.assertEqual(authorizer.ttl, 5)
+        self.assertIsNone(from_config(object(), 'PUBLISH'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,442 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import unittest
+
+from sockjs.tornado import SockJSRouter
+from tornado.testing import AsyncTestCase
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import bitjws
+
+import metrics
+import pikaconfig
+from lanes import PriorityLanes
+from admission import SessionPacer
+from authz import Authorizer, CallablePolicy
+from sockjs_server import Connection, WheelSession, MAX_HELD_MESSAGES
+from sockjs_pika_consumer import AsyncConsumer
+
+
+class Config(object):
+    """pikaconfig, with sessions set up at once and no snapshot."""
+
+for _name in dir(pikaconfig):
+    if _name.isupper():
+        setattr(Config, _name, getattr(pikaconfig, _name))
+Config.SESSION_SETUP_RATE = None
+Config.RESUME_SNAPSHOT = None
+Config.RATE_LIMIT_SESSION = None
+Config.RATE_LIMIT_IP = None
+Config.RATE_LIMIT_PUBHASH = None
+
+
+class DummyFuture(object):
+
+    def __init__(self):
+        self.callbacks = []
+
+    def add_done_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def resolve(self):
+        for callback in self.callbacks:
+            callback(self)
+
+
+class DummyStream(object):
+    """Stand-in for a websocket stream, backed up while writing is set."""
+
+    def __init__(self):
+        self.is_writing = False
+        self.flushed = []
+
+    def closed(self):
+        return False
+
+    def writing(self):
+        return self.is_writing
+
+    def write(self, data):
+        future = DummyFuture()
+        self.flushed.append(future)
+        return future
+
+
+class DummyWSConnection(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+
+
+class DummyHandler(object):
+    name = None
+    active = True
+
+    def __init__(self):
+        self.ws_connection = DummyWSConnection(DummyStream())
+
+
+class DummyLoop(object):
+
+    def __init__(self):
+        self.callbacks = []
+        self.delayed = []
+
+    def add_callback(self, callback, *args):
+        self.callbacks.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        self.delayed.append((delay, callback))
+
+    def run(self):
+        while self.callbacks:
+            callback, args = self.callbacks.pop(0)
+            callback(*args)
+
+
+class DummyServer(object):
+
+    def __init__(self):
+        self.io_loop = DummyLoop()
+
+
+class DummySession(object):
+    """Stand-in for a sockjs session, keeping the messages written."""
+    is_closed = False
+
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.server = DummyServer()
+        self.sent = []
+
+    def send_message(self, msg, stats=True, binary=False):
+        self.sent.append(msg)
+
+
+class DummyPublisher(object):
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, message, routing_key=None, callback=None):
+        self.published.append(message)
+        return True
+
+
+class DummyInfo(object):
+    ip = '10.0.0.1'
+
+    def get_argument(self, name):
+        return None
+
+
+class DummyTransport(object):
+    """Stand-in for a sockjs transport handler, keeping the packets sent."""
+    name = 'xhr'
+    active = True
+
+    def __init__(self):
+        self.packets = []
+        self.closed = False
+
+    def get_conn_info(self):
+        return DummyInfo()
+
+    def send_pack(self, message, binary=False):
+        self.packets.append(message)
+
+    def session_closed(self):
+        self.closed = True
+
+
+def frames(session):
+    return [json.loads(msg) if msg.startswith('{') else msg
+            for msg in session.sent]
+
+
+class ConnectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.consumer = AsyncConsumer(Config)
+        self.consumer._log.setLevel(logging.CRITICAL)
+        logger = logging.getLogger('test-connection')
+        logger.setLevel(logging.CRITICAL)
+        Connection.configure(logger, self.consumer, Config)
+        self.privkey = bitjws.PrivateKey()
+
+    def connect(self, handler=None):
+        session = DummySession(handler)
+        conn = Connection(session)
+        conn.on_open(DummyInfo())
+        return conn, session
+
+    def sign(self, **data):
+        return bitjws.sign_serialize(self.privkey, data=data, iat=time.time())
+
+
+class LanesTest(ConnectionTestCase):
+
+    def test_control_frames_skip_queued_data(self):
+        handler = DummyHandler()
+        conn, session = self.connect(handler)
+        stream = handler.ws_connection.stream
+        stream.is_writing = True
+        conn.send('data-1')
+        conn.send('data-2')
+        conn.send_control({'method': 'pong'})
+        self.assertEqual(frames(session)[1:], [{'method': 'pong'}])
+        stream.is_writing = False
+        session.server.io_loop.run()
+        self.assertEqual(frames(session)[1:],
+                         [{'method': 'pong'}, 'data-1', 'data-2'])
+
+    def test_lanes_only_exist_while_messages_wait(self):
+        handler = DummyHandler()
+        conn, session = self.connect(handler)
+        self.assertIsNone(conn.lanes)
+        conn.send('direct')
+        self.assertIsNone(conn.lanes)
+        handler.ws_connection.stream.is_writing = True
+        conn.send('queued')
+        self.assertEqual(len(conn.lanes), 1)
+        handler.ws_connection.stream.is_writing = False
+        session.server.io_loop.run()
+        self.assertEqual(frames(session)[1:], ['direct', 'queued'])
+        self.assertIsNone(conn.lanes)
+
+    def test_overflow_is_reported(self):
+        handler = DummyHandler()
+        conn, session = self.connect(handler)
+        conn.lanes = PriorityLanes(max_data=2)
+        handler.ws_connection.stream.is_writing = True
+        for n in range(5):
+            conn.send('data-%d' % n)
+        self.assertEqual(metrics.get('lanes.data.dropped'), 3)
+        handler.ws_connection.stream.is_writing = False
+        session.server.io_loop.run()
+        self.assertEqual(frames(session)[1:], [
+            {'method': 'dropped', 'count': 3}, 'data-3', 'data-4'])
+
+    def test_retry_when_stream_flushes(self):
+        handler = DummyHandler()
+        conn, session = self.connect(handler)
+        stream = handler.ws_connection.stream
+        stream.is_writing = True
+        conn.send('data')
+        session.server.io_loop.run()
+        # No polling: the drain waits for the stream to flush.
+        self.assertEqual(session.server.io_loop.delayed, [])
+        self.assertEqual(len(stream.flushed), 1)
+        self.assertEqual(frames(session)[1:], [])
+        stream.is_writing = False
+        stream.flushed[0].resolve()
+        self.assertEqual(frames(session)[1:], ['data'])
+
+    def test_retry_on_timer_tick_without_transport(self):
+        conn, session = self.connect(None)
+        conn.send('data')
+        session.server.io_loop.run()
+        self.assertEqual(session.server.io_loop.delayed, [])
+        self.assertEqual(session.sent[1:], [])
+        session.handler = DummyHandler()
+        Connection.timers.advance()
+        self.assertEqual(frames(session)[1:], ['data'])
+
+
+class SubscribeTest(ConnectionTestCase):
+
+    def test_subscription_is_acknowledged(self):
+        conn, session = self.connect(DummyHandler())
+        conn.on_message(self.sign(method='GET', model='coin', id=1))
+        self.assertEqual(frames(session)[-1], {'method': 'subscribed',
+                                                'model': 'coin', 'id': '1'})
+        self.assertEqual(self.consumer.listener_topics(conn),
+                         frozenset([('coin', '1')]))
+
+
+class MessageSizeTest(ConnectionTestCase):
+
+    def setUp(self):
+        super(MessageSizeTest, self).setUp()
+        # As with PUBLISH_MAX_BYTES, without starting a publisher.
+        Connection.max_publish_size = 4096
+
+    def test_only_publish_messages_may_be_larger(self):
+        conn, session = self.connect(DummyHandler())
+        filler = 'x' * Connection.max_message_size
+        conn.on_message(self.sign(method='GET', model='coin', id=1,
+                                  filler=filler))
+        self.assertEqual(frames(session)[-1], {'method': 'error',
+                                                'reason': 'invalid data'})
+        conn.on_message(self.sign(method='PUBLISH', model='coin', id=1,
+                                  filler=filler))
+        # Past the size check, up to the missing publisher.
+        self.assertEqual(frames(session)[-1]['reason'],
+                         'publishing not available')
+        conn.on_message(self.sign(method='PUBLISH', model='coin', id=1,
+                                  filler=filler * 4))
+        self.assertEqual(frames(session)[-1]['reason'], 'invalid data')
+
+
+class PublishTest(ConnectionTestCase):
+
+    def setUp(self):
+        super(PublishTest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.writers = set()
+        Connection.publisher = self.publisher = DummyPublisher()
+        Connection.publish_authorizer = Authorizer(CallablePolicy(
+            lambda pubhash, model, item_id: pubhash in self.writers))
+
+    def publish(self, conn, **data):
+        msg = self.sign(method='PUBLISH', model='coin', ref=1, **data)
+        conn.on_message(msg)
+        # Let the policy lookup complete.
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        return msg
+
+    def test_unauthorized_key_is_refused(self):
+        conn, session = self.connect(DummyHandler())
+        self.publish(conn, id=1)
+        self.assertEqual(frames(session)[-1], {
+            'method': 'error', 'reason': 'bad credentials', 'ref': 1})
+        self.assertEqual(self.publisher.published, [])
+
+    def test_authorized_key_publishes(self):
+        conn, session = self.connect(DummyHandler())
+        self.writers.add(bitjws.validate_deserialize(
+            self.sign(method='ping'))[0]['kid'])
+        msg = self.publish(conn, id=1)
+        self.assertEqual(self.publisher.published, [msg])
+        self.assertEqual(metrics.get('publish.accepted'), 1)
+
+
+class PacedSessionTest(ConnectionTestCase):
+
+    def setUp(self):
+        super(PacedSessionTest, self).setUp()
+        # One session set up right away, the next ones wait in line.
+        Connection.pacer = SessionPacer((1, 1), io_loop=DummyLoop())
+        self.connect()
+
+    def test_messages_wait_for_the_open_frame(self):
+        conn, session = self.connect(DummyHandler())
+        self.assertFalse(conn.started)
+        conn.on_message(self.sign(method='GET', model='coin', id=1))
+        self.assertEqual(session.sent, [])
+        conn.start()
+        sent = frames(session)
+        self.assertEqual(sent[0]['method'], 'open')
+        self.assertEqual(sent[1:], [{'method': 'subscribed',
+                                     'model': 'coin', 'id': '1'}])
+
+    def test_held_messages_are_capped(self):
+        conn, session = self.connect(DummyHandler())
+        for n in range(MAX_HELD_MESSAGES + 2):
+            conn.on_message(self.sign(method='GET', model='coin', id=n))
+        self.assertEqual(session.sent, [])
+        self.assertEqual(metrics.get('admission.held_dropped'), 2)
+        conn.start()
+        self.assertEqual(len(self.consumer.listener_topics(conn)),
+                         MAX_HELD_MESSAGES)
+
+    def test_oversize_messages_are_not_held(self):
+        conn, session = self.connect(DummyHandler())
+        conn.on_message('x' * (Connection.max_message_size + 1))
+        self.assertIsNone(conn.held)
+        self.assertEqual(session.sent, [])
+        self.assertEqual(metrics.get('admission.held_dropped'), 1)
+
+
+class SessionTestCase(AsyncTestCase):
+    """Connections driven through real sockjs sessions."""
+
+    config = Config
+
+    def setUp(self):
+        super(SessionTestCase, self).setUp()
+        metrics.reset()
+        consumer = AsyncConsumer(self.config, self.io_loop)
+        consumer._log.setLevel(logging.CRITICAL)
+        logger = logging.getLogger('test-connection')
+        logger.setLevel(logging.CRITICAL)
+        Connection.configure(logger, consumer, self.config, self.io_loop)
+        self.router = SockJSRouter(Connection, '', io_loop=self.io_loop,
+                                   session_kls=WheelSession)
+        self.sessions = 0
+
+    def tearDown(self):
+        self.router._sessions_cleanup.stop()
+        super(SessionTestCase, self).tearDown()
+
+    def connect(self):
+        self.sessions += 1
+        session = WheelSession(Connection, self.router,
+                               'session-%d' % self.sessions)
+        conn, transport = session.conn, DummyTransport()
+        session.set_handler(transport)
+        session.verify_state()
+        return conn, session, transport
+
+
+class IdleConfig(Config):
+    SESSION_IDLE_TIMEOUT = 2
+
+
+class IdleTest(SessionTestCase):
+
+    config = IdleConfig
+
+    def test_idle_session_is_closed(self):
+        conn, session, transport = self.connect()
+        conn.last_seen -= 5
+        for _ in range(3):
+            Connection.timers.advance()
+        self.assertTrue(session.is_closed)
+        self.assertEqual(session.close_reason, (3000, 'idle'))
+        self.assertEqual(transport.packets[-1], 'c[3000,"idle"]')
+        self.assertTrue(transport.closed)
+        self.assertEqual(metrics.get('timers.idle_reaped'), 1)
+        self.assertEqual(metrics.get('timers.errors'), 0)
+
+    def test_active_session_is_kept(self):
+        conn, session, transport = self.connect()
+        for _ in range(3):
+            Connection.timers.advance()
+        self.assertFalse(session.is_closed)
+
+
+class BusyConfig(Config):
+    SESSION_SETUP_RATE = (1, 1)
+    SESSION_SETUP_MAX_PENDING = 0
+
+
+class RejectTest(SessionTestCase):
+
+    config = BusyConfig
+
+    def test_session_is_turned_away(self):
+        self.connect()
+        conn, session, transport = self.connect()
+        self.assertTrue(session.is_closed)
+        self.assertEqual(session.close_reason, (3503, 'busy'))
+        error = json.loads(json.loads(transport.packets[1][1:])[0])
+        self.assertEqual(error['reason'], 'busy')
+        self.assertIn('retry_after', error)
+        self.assertEqual(transport.packets[-1], 'c[3503,"busy"]')
+
+
+if __name__ == '__main__':
+    unittest.main()
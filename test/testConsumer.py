@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import time
+import base64
+import logging
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import bitjws
+
+import metrics
+import pikaconfig
+from tracing import MessageTrace
+from sockjs_pika_consumer import AsyncConsumer, topic_key
+
+
+def segment(obj):
+    return base64.urlsafe_b64encode(
+        json.dumps(obj).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def unsigned_message(data):
+    """A well formed token, with a signature that doesn't verify."""
+    return '.'.join((segment({'alg': 'CUSTOM-BITCOIN-SIGN', 'typ': 'JWT'}),
+                     segment({'data': data, 'iat': time.time()}),
+                     segment('signature')))
+
+
+def forged_message(data):
+    """A signed token, with its signature altered."""
+    genuine = bitjws.sign_serialize(bitjws.PrivateKey(), data=data,
+                                    iat=time.time())
+    head, signature = genuine.rsplit('.', 1)
+    return '%s.%s%s' % (head, 'B' if signature[0] == 'A' else 'A',
+                        signature[1:])
+
+
+class DummyListener(object):
+    """Stand-in for a connection, keeping the messages sent to it."""
+
+    def __init__(self):
+        self.received = []
+
+    def send(self, body, trace=None):
+        self.received.append(body)
+
+
+class TopicKeyTest(unittest.TestCase):
+
+    def test_keys(self):
+        self.assertEqual(topic_key({'model': 'coin'}), 'coin')
+        self.assertEqual(topic_key({'model': 'coin', 'id': 1337}),
+                         ('coin', '1337'))
+        self.assertEqual(topic_key({'model': 'coin', 'id': '1337'}),
+                         ('coin', '1337'))
+
+    def test_invalid_types(self):
+        for data in ({'model': ['coin']}, {'model': None},
+                     {'model': 'coin', 'id': {'a': 1}},
+                     {'model': 'coin', 'id': [1]},
+                     {'model': 'coin', 'id': True}):
+            self.assertRaises(ValueError, topic_key, data)
+
+
+class SubscriptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = AsyncConsumer(pikaconfig)
+        self.consumer._log.setLevel(logging.CRITICAL)
+
+    def test_topic_keys_are_shared(self):
+        a, b = DummyListener(), DummyListener()
+        self.consumer.listener_add(a, [topic_key({'model': 'coin', 'id': 1})])
+        self.consumer.listener_add(b, [topic_key({'model': 'coin', 'id': 1})])
+        key_a, = self.consumer.listener_topics(a)
+        key_b, = self.consumer.listener_topics(b)
+        self.assertIs(key_a, key_b)
+
+    def test_add_remove_delete(self):
+        a = DummyListener()
+        self.consumer.listener_add(a, ['coin', ('coin', '1')])
+        self.consumer.listener_add(a, ['coin'])
+        self.assertEqual(self.consumer.listener_topics(a),
+                         frozenset(['coin', ('coin', '1')]))
+        self.consumer.listener_remove(a, ['coin'])
+        self.assertEqual(self.consumer.listener_topics(a),
+                         frozenset([('coin', '1')]))
+        self.consumer.listener_delete(a)
+        self.assertEqual(self.consumer.listener_topics(a), frozenset())
+        self.assertEqual(self.consumer._subscribers, {})
+        self.assertEqual(self.consumer._topics, {})
+
+    def test_fanout(self):
+        model, item, both, other = (DummyListener() for _ in range(4))
+        self.consumer.listener_add(model, ['coin'])
+        self.consumer.listener_add(item, [('coin', '1')])
+        self.consumer.listener_add(both, ['coin', ('coin', '1')])
+        self.consumer.listener_add(other, [('coin', '2')])
+        self.consumer.dispatch({'method': 'RESPONSE', 'model': 'coin',
+                                'id': 1}, 'body')
+        # Listeners subscribed both ways get the message once.
+        self.assertEqual(model.received, ['body'])
+        self.assertEqual(item.received, ['body'])
+        self.assertEqual(both.received, ['body'])
+        self.assertEqual(other.received, [])
+
+    def test_listener_allowed_rejects_invalid_topics(self):
+        privkey = bitjws.PrivateKey()
+        for data in ({'method': 'GET', 'model': ['coin']},
+                     {'method': 'GET', 'model': 'coin', 'id': {'a': 1}}):
+            msg = bitjws.sign_serialize(privkey, data=data, iat=time.time())
+            self.assertFalse(self.consumer.listener_allowed(None, msg))
+        msg = bitjws.sign_serialize(privkey, data={
+            'method': 'GET', 'model': 'coin', 'id': 1}, iat=time.time())
+        self.assertTrue(self.consumer.listener_allowed(None, msg))
+
+
+class HasSubscribersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = AsyncConsumer(pikaconfig)
+        self.consumer._log.setLevel(logging.CRITICAL)
+
+    def test_model_and_item_subscriptions(self):
+        self.assertFalse(self.consumer.has_subscribers(('coin', '1')))
+        self.consumer.listener_add('a', [('coin', '1')])
+        self.assertTrue(self.consumer.has_subscribers(('coin', '1')))
+        self.assertFalse(self.consumer.has_subscribers(('coin', '2')))
+        self.assertFalse(self.consumer.has_subscribers('coin'))
+        self.consumer.listener_add('b', ['coin'])
+        self.assertTrue(self.consumer.has_subscribers(('coin', '2')))
+        self.consumer.listener_delete('a')
+        self.consumer.listener_delete('b')
+        self.assertFalse(self.consumer.has_subscribers(('coin', '1')))
+
+
+class VerifyTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.consumer = AsyncConsumer(pikaconfig)
+        self.consumer._log.setLevel(logging.CRITICAL)
+
+    def test_unsubscribed_messages_are_skipped(self):
+        self.consumer.listener_add('a', [('coin', '1')])
+        body = unsigned_message({'method': 'RESPONSE', 'model': 'coin',
+                                 'id': 2})
+        self.assertIsNone(self.consumer.verify(body))
+        self.assertEqual(metrics.get('consumer.unsubscribed_skipped'), 1)
+
+    def test_subscribed_messages_are_verified(self):
+        self.consumer.listener_add('a', [('coin', '1')])
+        body = unsigned_message({'method': 'RESPONSE', 'model': 'coin',
+                                 'id': 1})
+        # Goes on to the signature check.
+        self.consumer.verify(body)
+        self.assertEqual(metrics.get('consumer.unsubscribed_skipped'), 0)
+
+    def test_bad_signature(self):
+        self.consumer.listener_add('a', [('coin', '1')])
+        body = forged_message({'method': 'RESPONSE', 'model': 'coin',
+                               'id': 1})
+        # As bitjws does when the signature doesn't match.
+        validate = bitjws.validate_deserialize
+        bitjws.validate_deserialize = lambda token: (None, None)
+        self.addCleanup(setattr, bitjws, 'validate_deserialize', validate)
+        self.assertIsNone(self.consumer.verify(body))
+        trace = MessageTrace()
+        self.assertIsNone(self.consumer.verify(body, trace))
+        self.assertIsNone(trace.verified)
+        self.assertEqual(metrics.get('consumer.bad_signature'), 2)
+
+
+class PublishAllowedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = AsyncConsumer(pikaconfig)
+        self.consumer._log.setLevel(logging.CRITICAL)
+        self.consumer.schemas = {'coin': {'routes': {
+            '/': {'POST': ['authenticate']},
+            '/:id': {'PUT': ['authenticate', 'pubhash']}}}}
+
+    def test_routes(self):
+        allowed = self.consumer.publish_allowed
+        self.assertTrue(allowed({'model': 'coin'}, 'pub'))
+        self.assertFalse(allowed({'model': 'user'}, 'pub'))
+        # The item route requires the signer's pubhash.
+        self.assertFalse(allowed({'model': 'coin', 'id': 1}, 'pub'))
+        self.assertFalse(allowed({'model': 'coin', 'id': 1,
+                                  'pubhash': 'other'}, 'pub'))
+        self.assertTrue(allowed({'model': 'coin', 'id': 1,
+                                 'pubhash': 'pub'}, 'pub'))
+        del self.consumer.schemas['coin']['routes']['/']['POST']
+        self.assertFalse(allowed({'model': 'coin'}, 'pub'))
+
+
+if __name__ == '__main__':
+    unittest.main()
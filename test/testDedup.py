@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import logging
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import bitjws
+
+import metrics
+import pikaconfig
+from dedup import BloomFilter, DuplicateFilter
+from replay import replay_key
+from sockjs_pika_consumer import AsyncConsumer
+
+
+def key(i):
+    return replay_key('header.payload-%d.signature' % i)
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(key(i))
+        self.assertTrue(all(key(i) in bloom for i in range(1000)))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(key(i))
+        false_positives = sum(key(i) in bloom for i in range(1000, 11000))
+        self.assertLess(false_positives, 300)
+
+
+class DuplicateFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_duplicate_within_window(self):
+        dedup = DuplicateFilter(window=10)
+        self.assertFalse(dedup.seen(key(1), now=0))
+        dedup.add(key(1), now=0)
+        self.assertTrue(dedup.seen(key(1), now=1))
+        self.assertFalse(dedup.seen(key(2), now=1))
+        self.assertEqual(metrics.get('dedup.duplicates'), 1)
+
+    def test_previous_window_is_kept(self):
+        dedup = DuplicateFilter(window=10)
+        dedup.add(key(1), now=5)
+        self.assertTrue(dedup.seen(key(1), now=16))
+        self.assertTrue(dedup.seen(key(1), now=24))
+        # Two rotations later the key is forgotten.
+        self.assertFalse(dedup.seen(key(1), now=26))
+
+    def test_idle_gap_forgets_everything(self):
+        dedup = DuplicateFilter(window=10)
+        dedup.add(key(1), now=0)
+        self.assertFalse(dedup.seen(key(1), now=100))
+
+    def test_exact_set_overflows_to_bloom(self):
+        dedup = DuplicateFilter(window=10, capacity=100, error_rate=0.001,
+                                exact_max=10)
+        for i in range(50):
+            dedup.add(key(i), now=0)
+        self.assertEqual(len(dedup._current.keys), 10)
+        self.assertFalse(dedup._current.complete)
+        self.assertTrue(all(dedup.seen(key(i), now=1) for i in range(50)))
+        self.assertGreater(metrics.get('dedup.bloom_hits'), 0)
+
+    def test_exact_set_has_no_false_positives(self):
+        # A tiny, saturated filter would match anything, but the exact
+        # set still holds every key of the window.
+        dedup = DuplicateFilter(window=10, capacity=1, error_rate=0.5,
+                                exact_max=100)
+        for i in range(50):
+            dedup.add(key(i), now=0)
+        self.assertFalse(any(dedup.seen(key(i), now=1)
+                             for i in range(50, 1000)))
+
+
+class ConsumerDedupTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.consumer = AsyncConsumer(pikaconfig)
+        self.consumer._log.setLevel(logging.CRITICAL)
+        self.consumer.listener_add('a', ['coin'])
+        privkey = bitjws.PrivateKey()
+        data = {'method': 'RESPONSE', 'model': 'coin', 'id': 1}
+        self.genuine = bitjws.sign_serialize(privkey, data=data,
+                                             iat=time.time())
+        # Same header and payload, so the same replay key, but a
+        # signature that doesn't match.
+        head, signature = self.genuine.rsplit('.', 1)
+        self.forged = '%s.%s%s' % (head, 'B' if signature[0] == 'A' else 'A',
+                                   signature[1:])
+        validate = bitjws.validate_deserialize
+
+        def validate_deserialize(token):
+            if token == self.forged:
+                return None, None
+            return validate(token)
+        bitjws.validate_deserialize = validate_deserialize
+        self.addCleanup(setattr, bitjws, 'validate_deserialize', validate)
+
+    def test_forged_copy_first(self):
+        self.assertIsNone(self.consumer.verify(self.forged))
+        self.assertEqual(self.consumer.verify(self.genuine)['id'], 1)
+        self.assertIsNone(self.consumer.verify(self.genuine))
+        self.assertEqual(metrics.get('consumer.duplicates'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
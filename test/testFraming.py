@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+from framing import CODECS, StaticFrame, get_codec
+
+TOKEN = 'eyJhbGciOiJub25lIn0.eyJkYXRhIjp7fX0.c2ln'
+
+
+class StaticFrameTest(unittest.TestCase):
+
+    def test_text(self):
+        frame = StaticFrame({'method': 'pong'})
+        self.assertEqual(json.loads(frame.encode()), {'method': 'pong'})
+        self.assertIs(frame.encode(), frame.encode())
+
+    def test_unknown_codec(self):
+        self.assertIsNone(get_codec('json5'))
+
+
+class CodecTest(unittest.TestCase):
+
+    def setUp(self):
+        if not CODECS:
+            self.skipTest('neither msgpack nor cbor2 is installed')
+
+    def test_encode_map(self):
+        for codec in CODECS.values():
+            schemas = codec.dumps({'coin': {'id': 1}})
+            data = codec.encode_map([('method', 'open'), ('now', 10)],
+                                    [('schemas', schemas)])
+            self.assertEqual(codec.loads(data), {
+                'method': 'open', 'now': 10, 'schemas': {'coin': {'id': 1}}})
+            with self.assertRaises(ValueError):
+                codec.encode_map([(str(i), i) for i in range(16)])
+
+    def test_envelope(self):
+        for codec in CODECS.values():
+            envelope = codec.envelope(TOKEN)
+            self.assertEqual(codec.loads(envelope),
+                             {'jws': TOKEN.encode('ascii')})
+            self.assertIs(codec.envelope(TOKEN), envelope)
+            self.assertEqual(codec.open_envelope(envelope), TOKEN)
+
+    def test_invalid_envelope(self):
+        for codec in CODECS.values():
+            for data in (b'\xff\x00', codec.dumps({'jwt': b'x'}),
+                         codec.dumps([1])):
+                with self.assertRaises(ValueError):
+                    codec.open_envelope(data)
+
+    def test_static_frame(self):
+        frame = StaticFrame({'method': 'error', 'reason': 'busy'})
+        for codec in CODECS.values():
+            self.assertEqual(codec.loads(frame.encode(codec)), frame.frame)
+            self.assertIs(frame.encode(codec), frame.encode(codec))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import logging
+import tempfile
+import unittest
+
+from tornado import gen
+from tornado.iostream import StreamBufferFullError
+from tornado.netutil import bind_unix_socket
+from tornado.testing import AsyncTestCase, gen_test
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import metrics
+import pikaconfig
+from sharding import shards_for_subscription
+from sockjs_pika_consumer import AsyncConsumer
+from ingest import (FRAME_HEADER, encode_frame, IngestConsumer, IngestServer,
+                    IngestClient, ShardedIngestClient)
+
+
+def segment(obj):
+    return base64.urlsafe_b64encode(
+        json.dumps(obj).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def message(data):
+    """A token as verified by the ingest process."""
+    return '.'.join((segment({'alg': 'CUSTOM-BITCOIN-SIGN', 'typ': 'JWT'}),
+                     segment({'data': data, 'iat': time.time()}),
+                     segment('signature')))
+
+
+class DummyListener(object):
+
+    def __init__(self):
+        self.received = []
+
+    def send(self, body, trace=None):
+        self.received.append(body)
+
+
+class DummyStream(object):
+    """Stand-in for a worker stream, failing writes once full."""
+
+    def __init__(self, full=False):
+        self.full = full
+        self.written = []
+        self.closed = False
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write(self, data):
+        if self.full:
+            raise StreamBufferFullError('full')
+        self.written.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+class DummyLoop(object):
+
+    def spawn_callback(self, callback, *args):
+        pass
+
+
+def quiet(consumer):
+    consumer._log.setLevel(logging.CRITICAL)
+    return consumer
+
+
+class FramingTest(unittest.TestCase):
+
+    def test_encode_frame(self):
+        frame = encode_frame('héllo')
+        self.assertEqual(FRAME_HEADER.unpack(frame[:4])[0], 6)
+        self.assertEqual(frame[4:], 'héllo'.encode('utf-8'))
+        self.assertEqual(encode_frame(b'abc'), b'\x00\x00\x00\x03abc')
+
+    def test_deliver(self):
+        consumer = quiet(AsyncConsumer(pikaconfig))
+        listener = DummyListener()
+        consumer.listener_add(listener, [('coin', '1')])
+        client = IngestClient('unused', consumer)
+        body = message({'method': 'RESPONSE', 'model': 'coin', 'id': 1})
+        client.deliver(body.encode('utf-8'))
+        client.deliver(b'not a token')
+        self.assertEqual(listener.received, [body])
+
+
+class IngestConsumerTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.consumer = quiet(IngestConsumer(pikaconfig))
+
+    def test_forwards_to_workers(self):
+        stream = DummyStream()
+        self.consumer.add_worker(stream)
+        body = message({'method': 'RESPONSE', 'model': 'coin'})
+        self.consumer.dispatch({'method': 'RESPONSE', 'model': 'coin'}, body)
+        self.assertEqual(b''.join(stream.written), encode_frame(body))
+
+    def test_full_worker_is_dropped(self):
+        slow, fast = DummyStream(full=True), DummyStream()
+        self.consumer.add_worker(slow)
+        self.consumer.add_worker(fast)
+        body = message({'method': 'RESPONSE', 'model': 'coin'})
+        self.consumer.dispatch({'method': 'RESPONSE', 'model': 'coin'}, body)
+        self.assertTrue(slow.closed)
+        self.assertEqual(self.consumer._workers, set([fast]))
+        self.assertEqual(metrics.get('ingest.worker_dropped'), 1)
+        self.assertEqual(b''.join(fast.written), encode_frame(body))
+
+
+class IngestRoundTripTest(AsyncTestCase):
+
+    def setUp(self):
+        super(IngestRoundTripTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'ingest.sock')
+        self.ingest = quiet(IngestConsumer(pikaconfig, self.io_loop))
+        self.server = IngestServer(self.ingest)
+        self.server.add_socket(bind_unix_socket(self.path))
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+        super(IngestRoundTripTest, self).tearDown()
+
+    @gen_test
+    def test_round_trip(self):
+        worker = quiet(AsyncConsumer(pikaconfig, self.io_loop))
+        listener = DummyListener()
+        worker.listener_add(listener, ['coin'])
+        client = IngestClient(self.path, worker)
+        client.start(self.io_loop)
+        while not self.ingest._workers:
+            yield gen.sleep(0.01)
+        bodies = [message({'method': 'RESPONSE', 'model': 'coin', 'id': n,
+                           'filler': 'x' * n * 1000}) for n in range(3)]
+        for body in bodies:
+            self.ingest.dispatch({'method': 'RESPONSE', 'model': 'coin'},
+                                 body)
+        while len(listener.received) < len(bodies):
+            yield gen.sleep(0.01)
+        self.assertEqual(listener.received, bodies)
+        client.stop()
+
+
+class ShardedIngestClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = quiet(AsyncConsumer(pikaconfig))
+        self.client = ShardedIngestClient('/tmp/shard-%d.sock', 4,
+                                          self.consumer)
+        self.client.start(DummyLoop())
+
+    def test_refcounting(self):
+        shard, = shards_for_subscription(('coin', '1'), 4)
+        # Find another item held by the same shard.
+        other = next(('coin', str(n)) for n in range(2, 1000)
+                     if shards_for_subscription(('coin', str(n)), 4) ==
+                     [shard])
+        a, b = DummyListener(), DummyListener()
+        self.consumer.listener_add(a, [('coin', '1')])
+        ingest = self.client._clients[shard]
+        self.assertEqual(ingest.path, '/tmp/shard-%d.sock' % shard)
+        self.consumer.listener_add(b, [('coin', '1'), other])
+        self.assertIs(self.client._clients[shard], ingest)
+        self.assertEqual(self.client._topics_per_shard[shard], 2)
+        self.consumer.listener_delete(a)
+        self.consumer.listener_remove(b, [('coin', '1')])
+        self.assertIs(self.client._clients[shard], ingest)
+        self.assertFalse(ingest._stopped)
+        # The last topic of the shard goes away.
+        self.consumer.listener_delete(b)
+        self.assertNotIn(shard, self.client._clients)
+        self.assertTrue(ingest._stopped)
+
+    def test_model_subscription_uses_every_shard(self):
+        listener = DummyListener()
+        self.consumer.listener_add(listener, ['coin'])
+        self.assertEqual(sorted(self.client._clients), [0, 1, 2, 3])
+        self.consumer.listener_delete(listener)
+        self.assertEqual(self.client._clients, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import metrics
+from lanes import PriorityLanes
+
+
+class PriorityLanesTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.written = []
+
+    def test_control_goes_first(self):
+        lanes = PriorityLanes()
+        lanes.push('data-1', now=0)
+        lanes.push('data-2', now=0)
+        lanes.push('pong', control=True, now=1)
+        self.assertFalse(lanes.drain(self.written.append, lambda: True, now=2))
+        self.assertEqual(self.written, ['pong', 'data-1', 'data-2'])
+        self.assertEqual(len(lanes), 0)
+
+    def test_overflow_drops_oldest(self):
+        lanes = PriorityLanes(max_data=2)
+        self.assertFalse(lanes.push('a', now=0))
+        self.assertFalse(lanes.push('b', now=0))
+        self.assertTrue(lanes.push('c', now=0))
+        # Control frames are never dropped.
+        for _ in range(5):
+            self.assertFalse(lanes.push('error', control=True, now=0))
+        self.assertEqual(metrics.get('lanes.data.dropped'), 1)
+        lanes.drain(self.written.append, lambda: True, now=0)
+        self.assertEqual(self.written, ['error'] * 5 + ['b', 'c'])
+
+    def test_data_waits_for_writable_transport(self):
+        lanes = PriorityLanes()
+        lanes.push('data', now=0)
+        lanes.push('pong', control=True, now=0)
+        self.assertTrue(lanes.drain(self.written.append, lambda: False,
+                                    now=0))
+        self.assertEqual(self.written, ['pong'])
+        self.assertFalse(lanes.drain(self.written.append, lambda: True,
+                                     now=0))
+        self.assertEqual(self.written, ['pong', 'data'])
+
+    def test_batch(self):
+        lanes = PriorityLanes()
+        for n in range(5):
+            lanes.push(n, now=0)
+        self.assertTrue(lanes.drain(self.written.append, lambda: True,
+                                    batch=3, now=0))
+        self.assertEqual(self.written, [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import metrics
+from loadshed import LagWatchdog
+
+LEVELS = ((0.1, 0.05), (0.25, 0.1), (0.5, 0.2))
+
+
+class LagWatchdogTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.changes = []
+        self.watchdog = LagWatchdog(LEVELS, self.on_level, hold=5,
+                                    smoothing=1)
+
+    def on_level(self, level, lag):
+        self.changes.append(level)
+
+    def test_steps_up_at_once(self):
+        self.assertEqual(self.watchdog.update(0.01, now=0), 0)
+        self.assertEqual(self.watchdog.update(0.3, now=1), 2)
+        self.assertEqual(self.watchdog.update(1, now=2), 3)
+        self.assertEqual(self.changes, [2, 3])
+        self.assertEqual(metrics.get('watchdog.level.2'), 1)
+
+    def test_steps_down_after_hold(self):
+        self.watchdog.update(1, now=0)
+        # Below the enter threshold but above the exit one: no change.
+        self.watchdog.update(0.3, now=1)
+        self.watchdog.update(0.3, now=100)
+        self.assertEqual(self.watchdog.level, 3)
+        self.watchdog.update(0.01, now=101)
+        self.watchdog.update(0.01, now=104)
+        self.assertEqual(self.watchdog.level, 3)
+        self.watchdog.update(0.01, now=106)
+        self.assertEqual(self.watchdog.level, 2)
+        self.watchdog.update(0.01, now=111)
+        self.watchdog.update(0.01, now=116)
+        self.assertEqual(self.changes, [3, 2, 1, 0])
+
+    def test_spike_resets_hold(self):
+        self.watchdog.update(0.15, now=0)
+        self.watchdog.update(0.01, now=1)
+        self.watchdog.update(0.07, now=4)
+        self.watchdog.update(0.01, now=7)
+        self.assertEqual(self.watchdog.level, 1)
+        self.watchdog.update(0.01, now=12)
+        self.assertEqual(self.watchdog.level, 0)
+
+    def test_smoothing(self):
+        watchdog = LagWatchdog(LEVELS, self.on_level, smoothing=0.5)
+        watchdog.update(0.15, now=0)
+        self.assertEqual(watchdog.level, 0)
+        watchdog.update(0.15, now=1)
+        self.assertEqual(watchdog.level, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
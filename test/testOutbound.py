@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import metrics
+import outbound
+
+TOKEN = 'eyJhbGciOiJub25lIn0.eyJkYXRhIjp7fX0.c2ln'
+
+
+class DummyStream(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+
+class DummyConnection(object):
+    def __init__(self, compressor=None):
+        self.stream = DummyStream()
+        self._compressor = compressor
+
+
+class DummyHandler(object):
+    def __init__(self, ws_connection):
+        self.ws_connection = ws_connection
+
+
+class OutboundMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_reuses_received_bytes(self):
+        raw = TOKEN.encode('ascii')
+        outbound.prime(TOKEN, raw)
+        self.assertIs(outbound.message_for(TOKEN).utf8, raw)
+        self.assertEqual(metrics.get('outbound.encoded'), 0)
+
+    def test_encodes_once(self):
+        text = ''.join(TOKEN)
+        message = outbound.message_for(text)
+        self.assertIs(outbound.message_for(text), message)
+        self.assertIs(message.utf8, message.utf8)
+        self.assertEqual(message.sockjs_frame,
+                         ('a[%s]' % json.dumps(TOKEN)).encode('ascii'))
+        self.assertIs(message.sockjs_frame, message.sockjs_frame)
+        self.assertEqual(metrics.get('outbound.messages'), 1)
+        self.assertEqual(metrics.get('outbound.encoded'), 1)
+        self.assertEqual(metrics.get('outbound.sockjs_frames'), 1)
+
+    def test_new_body(self):
+        first = outbound.message_for(TOKEN)
+        self.assertIsNot(outbound.message_for(TOKEN + '.'), first)
+
+
+class WebsocketTest(unittest.TestCase):
+
+    def test_header(self):
+        self.assertEqual(outbound.websocket_header(1, 5), b'\x81\x05')
+        self.assertEqual(outbound.websocket_header(2, 300), b'\x82\x7e\x01\x2c')
+        self.assertEqual(outbound.websocket_header(1, 70000),
+                         b'\x81\x7f' + (70000).to_bytes(8, 'big'))
+
+    def test_shared_payload(self):
+        payload = b'x' * 100000
+        handlers = [DummyHandler(DummyConnection()) for _ in range(3)]
+        for handler in handlers:
+            self.assertTrue(outbound.write_websocket(
+                handler, payload, outbound.OPCODE_TEXT))
+        for handler in handlers:
+            header, written = handler.ws_connection.stream.writes
+            self.assertEqual(header, outbound.websocket_header(1, 100000))
+            self.assertIs(written, payload)
+
+    def test_fallback(self):
+        self.assertFalse(outbound.write_websocket(
+            DummyHandler(DummyConnection(compressor=object())), b'x', 1))
+        self.assertFalse(outbound.write_websocket(DummyHandler(None), b'x', 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
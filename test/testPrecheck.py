@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import time
+import base64
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+from precheck import precheck, MalformedToken, MissingField
+
+
+def b64(value):
+    if not isinstance(value, bytes):
+        value = json.dumps(value).encode('utf-8')
+    return base64.urlsafe_b64encode(value).rstrip(b'=').decode('ascii')
+
+
+def make_token(data, alg='CUSTOM-BITCOIN-SIGN', iat=None, signature=b'x' * 65):
+    header = {'alg': alg, 'typ': 'JWT', 'kid': '1abc'}
+    payload = {'aud': None, 'data': data,
+               'iat': time.time() if iat is None else iat}
+    return '.'.join([b64(header), b64(payload), b64(signature)])
+
+
+class PrecheckTest(unittest.TestCase):
+
+    def test_good_token(self):
+        token = make_token({'method': 'GET', 'model': 'coin'})
+        header, payload = precheck(token, required=('method', 'model'))
+        self.assertEqual(header['kid'], '1abc')
+        self.assertEqual(payload['data']['model'], 'coin')
+
+    def test_bytes_token(self):
+        token = make_token({'method': 'ping'}).encode('ascii')
+        self.assertEqual(precheck(token)[1]['data']['method'], 'ping')
+
+    def test_segments(self):
+        self.assertRaises(MalformedToken, precheck, 'a.b')
+        self.assertRaises(MalformedToken, precheck, 'a..c')
+        self.assertRaises(MalformedToken, precheck, 42)
+
+    def test_bad_base64(self):
+        header, payload, signature = make_token({'method': 'ping'}).split('.')
+        for bad in ('!' + header, header + '*'):
+            self.assertRaises(MalformedToken, precheck,
+                              '.'.join([bad, payload, signature]))
+        self.assertRaises(MalformedToken, precheck,
+                          '.'.join([header, payload, signature + '$']))
+
+    def test_bad_algorithm(self):
+        for alg in ('none', 'HS256', None):
+            self.assertRaises(MalformedToken, precheck,
+                              make_token({'method': 'ping'}, alg=alg))
+
+    def test_missing_fields(self):
+        self.assertRaises(MissingField, precheck, make_token({'model': 'coin'}))
+        self.assertRaises(MissingField, precheck, make_token({'method': 'GET'}),
+                          required=('method', 'model'))
+
+    def test_iat_window(self):
+        now = 1000000.0
+        for iat in (now - 601, now + 61, 'now', True):
+            self.assertRaises(MalformedToken, precheck,
+                              make_token({'method': 'ping'}, iat=iat),
+                              iat_window=(600, 60), now=now)
+        token = make_token({'method': 'ping'}, iat=now - 10)
+        self.assertTrue(precheck(token, iat_window=(600, 60), now=now))
+        self.assertTrue(precheck(make_token({'method': 'ping'}, iat=0),
+                                 iat_window=None))
+
+
+if __name__ == '__main__':
+    unittest.main()
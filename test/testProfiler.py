@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+import threading
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+from profiler import SamplingProfiler, frame_label
+
+
+def busy_wait(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+class SamplingProfilerTest(unittest.TestCase):
+
+    def test_sample_current_thread(self):
+        profiler = SamplingProfiler()
+        profiler.sample()
+        stack, count = profiler.samples.most_common(1)[0]
+        self.assertEqual(count, 1)
+        self.assertIn(frame_label(self.test_sample_current_thread.__code__),
+                      stack)
+        self.assertTrue(stack.endswith(
+            frame_label(SamplingProfiler.sample.__code__)))
+
+    def test_profile_thread(self):
+        profiler = SamplingProfiler(threading.get_ident(), interval=0.001)
+        profiler.start()
+        self.assertTrue(profiler.running)
+        busy_wait(0.2)
+        profiler.stop()
+        self.assertFalse(profiler.running)
+        self.assertGreater(sum(profiler.samples.values()), 10)
+        collapsed = profiler.collapsed()
+        self.assertIn(frame_label(busy_wait.__code__), collapsed)
+        for line in collapsed.splitlines():
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(int(count) > 0)
+
+    def test_unknown_thread(self):
+        profiler = SamplingProfiler(thread_id=-1)
+        profiler.sample()
+        self.assertEqual(profiler.collapsed(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
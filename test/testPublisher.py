@@ -0,0 +1,166 @@
+import os
+import sys
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import pika
+
+import pikaconfig
+from publisher import Publisher
+
+
+class DummyChannel(object):
+    """Stand-in for a confirm mode channel, keeping the bodies published."""
+
+    def __init__(self):
+        self.published = []
+
+    def basic_publish(self, exchange, routing_key, body):
+        self.published.append(body)
+
+
+def confirmation(method, delivery_tag, multiple=False):
+    return pika.frame.Method(1, method(delivery_tag=delivery_tag,
+                                       multiple=multiple))
+
+
+class DummyLoop(object):
+    """Stand-in for the publisher thread's event loop."""
+
+    def __init__(self):
+        self.soon = []
+        self.later = []
+        self.woken = 0
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.woken += 1
+
+    def call_soon(self, callback, *args):
+        self.soon.append(callback)
+
+    def call_later(self, delay, callback, *args):
+        self.later.append((delay, callback))
+
+
+class PublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = Publisher(pikaconfig, max_buffer=100,
+                                   max_in_flight=5, batch_size=3)
+        self.publisher._channel = self.channel = DummyChannel()
+        self.publisher._loop = self.loop = DummyLoop()
+        self.publisher._ready = True
+
+    def publish(self, *messages):
+        for message in messages:
+            self.publisher.publish(message)
+
+    def test_confirm(self):
+        self.publish('a', 'b')
+        self.publisher._drain()
+        self.assertEqual(self.publisher.pending, 2)
+        self.publisher.on_delivery_confirmation(
+            confirmation(pika.spec.Basic.Ack, 1))
+        self.assertEqual(list(self.publisher._unconfirmed), [2])
+        self.publisher.on_delivery_confirmation(
+            confirmation(pika.spec.Basic.Ack, 2))
+        self.assertEqual(self.publisher.pending, 0)
+
+    def test_multiple_ack(self):
+        self.publish('a', 'b', 'c')
+        self.publisher._drain()
+        self.publisher.on_delivery_confirmation(
+            confirmation(pika.spec.Basic.Ack, 2, multiple=True))
+        self.assertEqual(list(self.publisher._unconfirmed), [3])
+
+    def test_nacked_messages_are_requeued_first(self):
+        self.publish('a', 'b', 'c', 'd')
+        self.publisher._drain()
+        self.assertEqual(self.channel.published, ['a', 'b', 'c'])
+        self.publisher.on_delivery_confirmation(
+            confirmation(pika.spec.Basic.Nack, 2, multiple=True))
+        # a and b go out again ahead of d.
+        self.assertEqual(self.channel.published[3:], ['a', 'b', 'd'])
+
+    def test_batching(self):
+        self.publish(*'abcdefg')
+        self.publisher._drain()
+        # One batch per event loop iteration, the next one scheduled.
+        self.assertEqual(self.channel.published, ['a', 'b', 'c'])
+        self.assertEqual(self.loop.soon, [self.publisher._drain])
+        self.loop.soon.pop()()
+        # At most max_in_flight messages await their confirmation.
+        self.assertEqual(self.channel.published, list('abcde'))
+        self.publisher.on_delivery_confirmation(
+            confirmation(pika.spec.Basic.Ack, 5, multiple=True))
+        self.assertEqual(self.channel.published, list('abcdefg'))
+
+    def test_requeue_on_reconnect(self):
+        self.publish('a', 'b', 'c', 'd')
+        self.publisher._drain()
+        self.publisher.on_delivery_confirmation(
+            confirmation(pika.spec.Basic.Ack, 1))
+        self.publisher.on_connection_closed(None, 'gone')
+        self.assertFalse(self.publisher._ready)
+        self.assertEqual(self.loop.later,
+                         [(1, self.publisher._connect)])
+        # Unconfirmed messages come back in their original order.
+        self.assertEqual([item[1] for item in self.publisher._buffer],
+                         ['b', 'c', 'd'])
+        channel = DummyChannel()
+        self.publisher._channel = channel
+        self.publisher._delivery_tag = 0
+        self.publisher._ready = True
+        self.publisher._drain()
+        self.assertEqual(channel.published, ['b', 'c', 'd'])
+
+
+class PublisherConfirmTest(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = Publisher(pikaconfig, max_buffer=10)
+        self.publisher._channel = self.channel = DummyChannel()
+        self.publisher._ready = True
+        self.confirmed = []
+
+    def publish(self, message):
+        return self.publisher.publish(
+            message, callback=lambda: self.confirmed.append(message))
+
+    def test_callbacks_on_ack(self):
+        for message in ('a', 'b', 'c'):
+            self.publish(message)
+        self.publisher._drain()
+        self.assertEqual(self.channel.published, ['a', 'b', 'c'])
+        self.publisher.on_delivery_confirmation(
+            confirmation(pika.spec.Basic.Ack, 2, multiple=True))
+        self.assertEqual(self.confirmed, ['a', 'b'])
+        self.publisher.on_delivery_confirmation(
+            confirmation(pika.spec.Basic.Ack, 3))
+        self.assertEqual(self.confirmed, ['a', 'b', 'c'])
+        self.assertEqual(self.publisher.pending, 0)
+
+    def test_nacked_messages_are_published_again(self):
+        self.publish('a')
+        self.publisher._drain()
+        self.publisher.on_delivery_confirmation(
+            confirmation(pika.spec.Basic.Nack, 1))
+        self.assertEqual(self.confirmed, [])
+        self.assertEqual(self.channel.published, ['a', 'a'])
+        self.publisher.on_delivery_confirmation(
+            confirmation(pika.spec.Basic.Ack, 2))
+        self.assertEqual(self.confirmed, ['a'])
+
+    def test_full_buffer(self):
+        self.publisher._ready = False
+        for n in range(10):
+            self.assertTrue(self.publish(str(n)))
+        self.assertFalse(self.publish('x'))
+
+
+if __name__ == '__main__':
+    unittest.main()
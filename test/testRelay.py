@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import time
+import logging
+import unittest
+
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.testing import AsyncTestCase, gen_test
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import bitjws
+
+import metrics
+import pikaconfig
+from precheck import DEFAULT_IAT_WINDOW
+from relay import RelayClient, RelayHandler
+from replay import ReplayCache
+from sockjs_pika_consumer import AsyncConsumer
+
+
+class DummyStream(object):
+    """Stand-in for the upstream websocket, keeping the frames written."""
+
+    def __init__(self):
+        self.frames = []
+
+    def write_message(self, message):
+        self.frames.append(json.loads(message))
+
+
+class RelayClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = AsyncConsumer(pikaconfig)
+        self.consumer._log.setLevel(logging.WARNING)
+        self.client = RelayClient('ws://upstream/relay', self.consumer, None)
+        self.consumer.add_on_topic_callback(self.client.on_topic)
+
+    def test_follows_aggregated_topics(self):
+        self.client._stream = stream = DummyStream()
+        self.consumer.listener_add('a', ['coin', ('coin', '1')])
+        self.consumer.listener_add('b', [('coin', '1')])
+        self.assertEqual(stream.frames, [
+            {'method': 'SUBSCRIBE', 'topics': [{'model': 'coin'}]},
+            {'method': 'SUBSCRIBE', 'topics': [{'model': 'coin', 'id': '1'}]},
+        ])
+        self.consumer.listener_delete('a')
+        self.assertEqual(stream.frames[2:], [
+            {'method': 'UNSUBSCRIBE', 'topics': [{'model': 'coin'}]}])
+        self.assertEqual(self.client.topics, set([('coin', '1')]))
+
+    def test_topics_kept_while_disconnected(self):
+        self.consumer.listener_add('a', ['coin', ('coin', '1')])
+        self.consumer.listener_delete('a')
+        self.consumer.listener_add('b', [('coin', '2')])
+        self.assertEqual(self.client.topics, set([('coin', '2')]))
+        # Sent all at once when connected.
+        self.client._stream = stream = DummyStream()
+        self.client._write_topics('SUBSCRIBE', list(self.client.topics))
+        self.assertEqual(stream.frames, [
+            {'method': 'SUBSCRIBE', 'topics': [{'model': 'coin', 'id': '2'}]}])
+
+
+class ClosedStream(object):
+    """Stand-in for the stream of an edge that went away."""
+
+    def write(self, data):
+        raise StreamClosedError()
+
+
+class DummyWSConnection(object):
+    _compressor = None
+
+    def __init__(self, stream):
+        self.stream = stream
+
+
+class DummyListener(object):
+
+    def __init__(self):
+        self.received = []
+
+    def send(self, body, trace=None):
+        self.received.append(body)
+
+
+class RelayHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.privkey = bitjws.PrivateKey()
+        self.message = self.sign(method='RELAY')
+        self.pubhash = bitjws.validate_deserialize(self.message)[0]['kid']
+        self.closed = []
+
+    def handler(self, relays, replay_cache=None):
+        # The handler is driven directly, without a websocket.
+        handler = RelayHandler.__new__(RelayHandler)
+        handler.initialize(AsyncConsumer(pikaconfig), relays,
+                           replay_cache or ReplayCache(DEFAULT_IAT_WINDOW[0]),
+                           DEFAULT_IAT_WINDOW)
+        handler.close = lambda code, reason: self.closed.append(code)
+        return handler
+
+    def sign(self, **data):
+        return bitjws.sign_serialize(self.privkey, data=data, iat=time.time())
+
+    def test_allowed_edge(self):
+        handler = self.handler([self.pubhash])
+        handler.on_message(self.message)
+        self.assertEqual(handler.pubhash, self.pubhash)
+        self.assertEqual(self.closed, [])
+        self.assertEqual(metrics.get('relay.edges_connected'), 1)
+
+    def test_bad_signature(self):
+        handler = self.handler([self.pubhash])
+        # As bitjws does when the signature doesn't match.
+        validate = bitjws.validate_deserialize
+        bitjws.validate_deserialize = lambda token: (None, None)
+        self.addCleanup(setattr, bitjws, 'validate_deserialize', validate)
+        handler.on_message(self.message)
+        self.assertIsNone(handler.pubhash)
+        self.assertEqual(self.closed, [1008])
+        self.assertEqual(metrics.get('relay.rejected'), 1)
+
+    def test_pubhash_not_allowed(self):
+        handler = self.handler(['other'])
+        handler.on_message(self.message)
+        self.assertIsNone(handler.pubhash)
+        self.assertEqual(self.closed, [1008])
+
+    def test_not_a_relay_message(self):
+        handler = self.handler([self.pubhash])
+        self.assertIsNone(handler.authenticate(self.sign(method='GET')))
+
+    def test_replay(self):
+        first = self.handler([self.pubhash])
+        first.on_message(self.message)
+        self.assertEqual(first.pubhash, self.pubhash)
+        # Another connection sending the same message is refused.
+        second = self.handler([self.pubhash], first.replay_cache)
+        second.on_message(self.message)
+        self.assertIsNone(second.pubhash)
+        self.assertEqual(self.closed, [1008])
+
+
+class RelayFanoutTest(AsyncTestCase):
+
+    @gen_test
+    def test_closed_edge(self):
+        consumer = AsyncConsumer(pikaconfig, self.io_loop)
+        consumer._log.setLevel(logging.WARNING)
+        handler = RelayHandler.__new__(RelayHandler)
+        handler.initialize(consumer, [], ReplayCache(DEFAULT_IAT_WINDOW[0]),
+                           DEFAULT_IAT_WINDOW)
+        handler.ws_connection = DummyWSConnection(ClosedStream())
+        listener = DummyListener()
+        # Model subscribers are sent to before item subscribers.
+        consumer.listener_add(handler, ['coin'])
+        consumer.listener_add(listener, [('coin', '1')])
+        consumer._fanout(('coin', '1'), {'model': 'coin', 'id': 1}, 'body')
+        # The rest of the fan-out goes on, and the edge is unsubscribed.
+        self.assertEqual(listener.received, ['body'])
+        yield gen.moment
+        self.assertEqual(consumer.listener_topics(handler), frozenset())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+from replay import ReplayCache, replay_key
+
+
+class ReplayKeyTest(unittest.TestCase):
+
+    def test_signature_is_ignored(self):
+        self.assertEqual(replay_key('h.p.sig1'), replay_key('h.p.sig2'))
+        self.assertNotEqual(replay_key('h.p.sig'), replay_key('h.q.sig'))
+
+    def test_jti(self):
+        self.assertEqual(replay_key('h.p.s', {'jti': 'x'}),
+                         replay_key('h.q.s', {'jti': 'x'}))
+
+
+class ReplayCacheTest(unittest.TestCase):
+
+    def test_replay_within_window(self):
+        cache = ReplayCache(60, bucket_seconds=10)
+        self.assertFalse(cache.seen(b'a', 100, now=100))
+        cache.add(b'a', 100, now=100)
+        self.assertTrue(cache.seen(b'a', 100, now=150))
+        self.assertFalse(cache.seen(b'b', 100, now=150))
+
+    def test_expiry_drops_buckets(self):
+        cache = ReplayCache(60, bucket_seconds=10)
+        cache.add(b'a', 100, now=100)
+        cache.add(b'b', 125, now=125)
+        self.assertEqual(len(cache), 2)
+        # Bucket 10 (iat 100-109) expires once now - 60 reaches 110.
+        self.assertFalse(cache.seen(b'c', 130, now=170))
+        self.assertEqual(len(cache), 1)
+        # Anything older than the remembered window counts as a replay.
+        self.assertTrue(cache.seen(b'a', 100, now=170))
+
+    def test_capacity_shrinks_window(self):
+        cache = ReplayCache(600, bucket_seconds=10, max_entries=2)
+        cache.add(b'a', 100, now=100)
+        cache.add(b'b', 110, now=110)
+        cache.add(b'c', 120, now=120)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.seen(b'x', 105, now=120))
+        self.assertTrue(cache.seen(b'b', 110, now=120))
+        self.assertFalse(cache.seen(b'x', 110, now=120))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+from resume import ResumeRegistry
+
+
+class ResumeRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_claim(self):
+        registry = ResumeRegistry(ttl=10)
+        registry.retain('tok', 'pub', ['coin', ('coin', '1')], now=0)
+        self.assertIsNone(registry.claim('tok', 'other', now=1))
+        self.assertEqual(registry.claim('tok', 'pub', now=1),
+                         frozenset(['coin', ('coin', '1')]))
+        # A token can only be claimed once.
+        self.assertIsNone(registry.claim('tok', 'pub', now=1))
+
+    def test_expiry(self):
+        registry = ResumeRegistry(ttl=10)
+        registry.retain('a', 'pub', ['coin'], now=0)
+        registry.retain('b', 'pub', ['coin'], now=5)
+        self.assertIsNone(registry.claim('a', 'pub', now=11))
+        registry.expire(now=16)
+        self.assertEqual(len(registry), 0)
+
+    def test_snapshot_roundtrip(self):
+        registry = ResumeRegistry(ttl=10)
+        registry.retain('closed', 'pub1', ['coin'], now=0)
+        registry.save(self.path, [('open', 'pub2', {('coin', '7')})], now=5)
+
+        restored = ResumeRegistry(ttl=10)
+        self.assertEqual(restored.load(self.path, now=12), 1)
+        self.assertIsNone(restored.claim('closed', 'pub1', now=12))
+        self.assertEqual(restored.claim('open', 'pub2', now=12),
+                         frozenset([('coin', '7')]))
+
+    def test_missing_or_corrupted_snapshot(self):
+        registry = ResumeRegistry()
+        self.assertEqual(registry.load(self.path), 0)
+        with open(self.path, 'wb') as f:
+            f.write(b'garbage')
+        self.assertEqual(registry.load(self.path), 0)
+        open(self.path, 'wb').close()
+        self.assertEqual(registry.load(self.path), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
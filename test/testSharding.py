@@ -0,0 +1,50 @@
+import os
+import sys
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+from sharding import (jump_hash, shard_for, shards_for_subscription,
+                      routing_key_for)
+
+TOPICS = [('coin', str(i)) for i in range(5000)]
+
+
+class ShardingTest(unittest.TestCase):
+
+    def test_stable(self):
+        self.assertEqual(shard_for(('coin', '1337'), 8),
+                         shard_for(('coin', '1337'), 8))
+        self.assertEqual(jump_hash(0, 1), 0)
+
+    def test_balanced(self):
+        counts = [0] * 4
+        for topic in TOPICS:
+            counts[shard_for(topic, 4)] += 1
+        for count in counts:
+            self.assertTrue(1000 < count < 1500, counts)
+
+    def test_minimal_movement(self):
+        moved = 0
+        for topic in TOPICS:
+            before, after = shard_for(topic, 4), shard_for(topic, 5)
+            if before != after:
+                # Topics only ever move to the new shard.
+                self.assertEqual(after, 4)
+                moved += 1
+        self.assertTrue(800 < moved < 1200, moved)
+
+    def test_subscriptions(self):
+        self.assertEqual(shards_for_subscription('coin', 3), [0, 1, 2])
+        topic = ('coin', '1')
+        self.assertEqual(shards_for_subscription(topic, 3),
+                         [shard_for(topic, 3)])
+        self.assertEqual(routing_key_for(topic, 3),
+                         'shard.%d' % shard_for(topic, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,7 +32,7 @@ try:
     user = bitjws_client.user.addUser(user=luser).result()
 except:
     bitjws_client = None
-    print "Could not connet to BitJWS server... Continuing without it."
+    print("Could not connet to BitJWS server... Continuing without it.")
     pass
 
 pika_url_parameters = pika.URLParameters(pikaconfig.BROKER_URL)
@@ -86,7 +86,7 @@ class GoodClient(unittest.TestCase, CommonTestMixin):
         msg = self.client.recv()
         try:
             data = json.loads(msg)
-        except Exception, e:
+        except Exception as e:
             self.fail("Unexpected error: %s" % e)
         # self.assertIn('schemas', data)
         self.assertIn('now', data)
@@ -99,7 +99,7 @@ class GoodClient(unittest.TestCase, CommonTestMixin):
         self.client.send(bitjws_msg)
         try:
             response_msg = client_wait_for(self.client, 'pong')
-        except Exception, e:
+        except Exception as e:
             self.fail("Unexpected error: %s" % e)
         self.assertIn('method', response_msg)
         self.assertEqual(response_msg['method'], 'pong')
@@ -136,7 +136,7 @@ class GoodClient(unittest.TestCase, CommonTestMixin):
 
         try:
             msg_response = client_wait_for(self.client, 'RESPONSE', 'coin')
-        except Exception, e:
+        except Exception as e:
             self.fail("Unexpected error: %s" % e)
 
         self.assertIn('data', msg_response)
@@ -179,7 +179,7 @@ class GoodClient(unittest.TestCase, CommonTestMixin):
                                    routing_key='')
         try:
             msg_response = client_wait_for(self.client, 'RESPONSE', 'coin')
-        except Exception, e:
+        except Exception as e:
             self.fail("Unexpected error: %s" % e)
 
         self.assertIn('data', msg_response)
@@ -210,7 +210,7 @@ class BadClient(unittest.TestCase, CommonTestMixin):
 
         try:
             msg_response = client_wait_for(self.client, 'error')
-        except Exception, e:
+        except Exception as e:
             self.fail("Unexpected error: %s" % e)
 
         self.assertEqual(msg_response['reason'], 'unknown message')
@@ -229,7 +229,7 @@ class BadClient(unittest.TestCase, CommonTestMixin):
 
         try:
             msg_response = client_wait_for(self.client, 'error')
-        except Exception, e:
+        except Exception as e:
             self.fail("Unexpected error: %s" % e)
 
         self.assertEqual(msg_response['reason'], 'unknown message')
@@ -257,7 +257,7 @@ class BadClient(unittest.TestCase, CommonTestMixin):
 
         try:
             msg_response = client_wait_for(self.client, 'error')
-        except Exception, e:
+        except Exception as e:
             self.fail("Unexpected error: %s" % e)
 
         # returning 'invalid data' for now on bad signature; maybe returning
@@ -317,7 +317,7 @@ class BadClient(unittest.TestCase, CommonTestMixin):
     #
     #     try:
     #         msg_response = client_wait_for(self.client, 'RESPONSE', 'coin')
-    #     except Exception, e:
+    #     except Exception as e:
     #         self.fail("Unexpected error: %s" % e)
     #
     #     self.assertIn('data', msg_response)
@@ -363,7 +363,7 @@ class MessageLeak(unittest.TestCase):
 
         try:
             data = client_wait_for(client, 'RESPONSE', 'coin', 5)
-        except Exception, e:
+        except Exception as e:
             self.fail("Unexpected error: %s" % e)
         self.assertIsNone(data)
         client.close()
@@ -411,7 +411,7 @@ class MessageLeak(unittest.TestCase):
 
         try:
             data = client_wait_for(client, 'RESPONSE', 'coin', 5)
-        except Exception, e:
+        except Exception as e:
             self.fail("Unexpected error: %s" % e)
         self.assertIsNone(data)
         client.close()
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+from timerwheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TimerWheel(tick=1, slots=8)
+        self.fired = []
+
+    def advance(self, ticks):
+        for _ in range(ticks):
+            self.wheel.advance()
+
+    def test_fires_on_deadline(self):
+        self.wheel.schedule(3, self.fired.append, 'a')
+        self.wheel.schedule(2.5, self.fired.append, 'b')
+        self.advance(2)
+        self.assertEqual(self.fired, [])
+        self.advance(1)
+        self.assertEqual(sorted(self.fired), ['a', 'b'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_never_early(self):
+        # Most of the current tick has gone by.
+        self.wheel._last_tick = time.monotonic() - 0.9
+        self.wheel.schedule(1, self.fired.append, 'a')
+        self.advance(1)
+        self.assertEqual(self.fired, [])
+        self.advance(1)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_more_than_a_turn(self):
+        self.wheel.schedule(8, self.fired.append, 'turn')
+        self.wheel.schedule(20, self.fired.append, 'late')
+        self.advance(7)
+        self.assertEqual(self.fired, [])
+        self.advance(1)
+        self.assertEqual(self.fired, ['turn'])
+        self.advance(11)
+        self.assertEqual(self.fired, ['turn'])
+        self.advance(1)
+        self.assertEqual(self.fired, ['turn', 'late'])
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(2, self.fired.append, 'a')
+        self.assertTrue(timer.active)
+        timer.cancel()
+        timer.cancel()
+        self.assertFalse(timer.active)
+        self.assertEqual(len(self.wheel), 0)
+        self.advance(10)
+        self.assertEqual(self.fired, [])
+
+    def test_reschedule_from_callback(self):
+        def again():
+            self.fired.append(len(self.fired))
+            if len(self.fired) < 3:
+                self.wheel.schedule(1, again)
+        self.wheel.schedule(1, again)
+        self.advance(3)
+        self.assertEqual(self.fired, [0, 1, 2])
+
+    def test_failing_callback(self):
+        def fail():
+            raise ValueError('boom')
+        self.wheel.schedule(1, fail)
+        self.wheel.schedule(1, self.fired.append, 'ok')
+        self.assertEqual(self.wheel.advance(), 2)
+        self.assertEqual(self.fired, ['ok'])
+
+
+if __name__ == '__main__':
+    unittest.main()
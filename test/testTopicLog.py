@@ -0,0 +1,173 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+from topiclog import TopicLog, History
+
+
+def body(n):
+    return ('message-%d' % n).encode('ascii')
+
+
+class TopicLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'coin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fill(self, log, count, item_ids=(b'', )):
+        for n in range(1, count + 1):
+            log.append(item_ids[n % len(item_ids)], body(n), now=1000 + n)
+
+    def test_read_by_seq(self):
+        log = TopicLog(self.path, index_interval=64)
+        self.fill(log, 50)
+        records = log.read(first_seq=20, limit=5)
+        self.assertEqual([r[0] for r in records], [20, 21, 22, 23, 24])
+        self.assertEqual(records[0], (20, 1020.0, body(20)))
+        self.assertEqual(len(log.read(limit=100)), 50)
+        self.assertEqual(log.read(first_seq=51), [])
+
+    def test_read_by_time(self):
+        log = TopicLog(self.path, index_interval=64)
+        self.fill(log, 50)
+        records = log.read(since=1010.5, until=1013)
+        self.assertEqual([r[0] for r in records], [11, 12, 13])
+
+    def test_read_by_item(self):
+        log = TopicLog(self.path, index_interval=64)
+        self.fill(log, 20, item_ids=(b'1', b'2'))
+        records = log.read(item_id=b'1', limit=3)
+        self.assertEqual([r[0] for r in records], [2, 4, 6])
+
+    def test_segments_roll(self):
+        log = TopicLog(self.path, segment_bytes=200, index_interval=64)
+        self.fill(log, 50)
+        self.assertGreater(len(log.segments), 2)
+        self.assertEqual([r[0] for r in log.read(first_seq=1, limit=100)],
+                         list(range(1, 51)))
+        self.assertEqual([r[0] for r in log.read(since=1040, limit=3)],
+                         [40, 41, 42])
+
+    def test_retention_by_size(self):
+        log = TopicLog(self.path, segment_bytes=200, max_bytes=500)
+        self.fill(log, 50)
+        self.assertLessEqual(log.size, 500 + 200)
+        records = log.read(limit=100)
+        self.assertEqual(records[-1][0], 50)
+        self.assertGreater(records[0][0], 1)
+
+    def test_retention_by_age(self):
+        log = TopicLog(self.path, segment_bytes=200, max_age=10)
+        self.fill(log, 50)
+        log.enforce_retention(now=1050)
+        # The segment being written to is kept.
+        self.assertGreaterEqual(log.read(limit=100)[0][1], 1040 - 10)
+        log.enforce_retention(now=5000)
+        self.assertEqual(len(log.segments), 1)
+
+    def test_reload(self):
+        log = TopicLog(self.path, segment_bytes=200, index_interval=64)
+        self.fill(log, 30)
+        log.close()
+        log = TopicLog(self.path, segment_bytes=200, index_interval=64)
+        self.assertEqual(log.last_seq, 30)
+        self.assertEqual(log.append(b'', body(31)), 31)
+        self.assertEqual(log.read(first_seq=30), [
+            (30, 1030.0, body(30)), (31, log.segments[-1].last_time,
+                                     body(31))])
+
+    def test_partial_record_is_truncated(self):
+        log = TopicLog(self.path, index_interval=64)
+        self.fill(log, 10)
+        log.close()
+        segment = log.segments[-1].path
+        with open(segment, 'ab') as f:
+            f.write(b'\x00\x00\x01\x00partial')
+        log = TopicLog(self.path, index_interval=64)
+        self.assertEqual(log.last_seq, 10)
+        self.assertEqual(log.append(b'', body(11), now=1011), 11)
+        self.assertEqual(log.read(first_seq=10), [
+            (10, 1010.0, body(10)), (11, 1011.0, body(11))])
+
+    def test_times_stay_ordered(self):
+        log = TopicLog(self.path)
+        log.append(b'', body(1), now=1000)
+        log.append(b'', body(2), now=990)
+        self.assertEqual([r[1] for r in log.read()], [1000.0, 1000.0])
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_models_kept(self):
+        history = History(self.dir, ['coin', '../etc'])
+        self.assertTrue(history.wants('coin'))
+        self.assertFalse(history.wants('user'))
+        self.assertFalse(history.wants('../etc'))
+        history.append('user', body(1))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_read_topics(self):
+        history = History(self.dir, ['coin'])
+        history.append(('coin', '1'), body(1), now=1)
+        history.append(('coin', '2'), body(2), now=2)
+        history.append('coin', body(3), now=3)
+        self.assertEqual(history.read(('coin', '2')),
+                         ([(2, 2.0, body(2))], 4, False))
+        records, next_seq, more = history.read('coin', limit=2)
+        self.assertEqual([r[0] for r in records], [1, 2])
+        self.assertEqual((next_seq, more), (3, True))
+        self.assertEqual(history.read('coin', first_seq=next_seq),
+                         ([(3, 3.0, body(3))], 4, False))
+
+    def test_scan_is_bounded(self):
+        history = History(self.dir, ['coin'], segment_bytes=2000,
+                          index_interval=100)
+        for n in range(1, 201):
+            history.append(('coin', '1' if n == 150 else '2'), body(n),
+                           now=n)
+        # A rare item is read in several steps, none scanning the log.
+        found, first_seq, reads = [], None, 0
+        while True:
+            records, first_seq, more = history.read(
+                ('coin', '1'), first_seq=first_seq, max_scan=1000)
+            found.extend(r[0] for r in records)
+            reads += 1
+            if not more:
+                break
+        self.assertEqual(found, [150])
+        self.assertEqual(first_seq, 201)
+        self.assertGreater(reads, 5)
+
+    def test_bounded_scan_goes_on_from_next_seq(self):
+        history = History(self.dir, ['coin'], segment_bytes=2000,
+                          index_interval=100)
+        for n in range(1, 201):
+            history.append(('coin', '2'), body(n), now=n)
+        # The next read starts past since, from next_seq.
+        records, next_seq, more = history.read(
+            ('coin', '1'), since=20, max_scan=1000)
+        self.assertTrue(more)
+        records, later_seq, more = history.read(
+            ('coin', '1'), first_seq=next_seq, since=20, max_scan=1000)
+        self.assertGreater(later_seq, next_seq)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import unittest
+
+# Prepend the parent directory to the sys path.
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+if CLIENT_DIR not in sys.path:
+    sys.path.insert(0, CLIENT_DIR)
+
+import metrics
+from lanes import PriorityLanes
+from tracing import MessageTrace, Tracer
+
+
+class MessageTraceTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_stages(self):
+        trace = MessageTrace(received=100.5)
+        trace.mark_verified(100.0, now=100.6)
+        trace.mark_fanout('coin', 2, now=100.625)
+        trace.mark_written(now=100.65)
+        trace.mark_written(now=101.125)
+        self.assertEqual(metrics.histogram('latency.coin.broker').total, 0.5)
+        self.assertAlmostEqual(metrics.histogram('latency.coin.verify').total,
+                               0.1)
+        self.assertAlmostEqual(metrics.histogram('latency.coin.fanout').total,
+                               0.025)
+        write = metrics.histogram('latency.coin.write')
+        self.assertEqual(write.count, 2)
+        self.assertAlmostEqual(write.max, 0.5)
+        total = metrics.histogram('latency.coin.total')
+        self.assertEqual(total.count, 2)
+        self.assertAlmostEqual(total.max, 1.125)
+        self.assertIn('sessions=2 written=2', trace.describe())
+
+    def test_verified_upstream(self):
+        trace = MessageTrace(received=10.0)
+        trace.mark_fanout('coin', 0, now=10.5)
+        self.assertEqual(metrics.histogram('latency.coin.verify').total, 0)
+        self.assertIsNone(metrics.histogram('latency.coin.broker'))
+
+    def test_written_before_fanout(self):
+        MessageTrace().mark_written()
+        self.assertEqual(metrics.snapshot(), {})
+
+    def test_sampling(self):
+        self.assertFalse(Tracer(0).start().sampled)
+        self.assertTrue(Tracer(1).start().sampled)
+
+    def test_lanes_mark_written(self):
+        lanes = PriorityLanes()
+        trace = MessageTrace()
+        trace.mark_fanout('coin', 1)
+        lanes.push('msg', trace=trace)
+        lanes.push('other')
+        written = []
+        lanes.drain(written.append, lambda: True)
+        self.assertEqual(written, ['msg', 'other'])
+        self.assertEqual(trace.written, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
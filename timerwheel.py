@@ -0,0 +1,140 @@
+"""
+Hashed timer wheel for per-session timers.
+
+With one IOLoop timeout per session, 100k sessions mean 100k entries in
+the IOLoop's heap, each schedule and cancel costing O(log n). A timer
+wheel instead hashes every timer into one of a fixed number of slots by
+its deadline, so scheduling and cancelling are O(1), and a single
+periodic callback advances the wheel one slot per tick, firing the
+timers due in that slot. Timers due more than a full turn ahead stay in
+their slot and count the turns left.
+
+Deadlines are counted from the time of the current slot and rounded up
+to the next tick, so timers fire up to one tick late, never early. This is fine for idle reaping, subscription TTLs and
+heartbeats, which only need to be approximate.
+"""
+import math
+import time
+
+from tornado import ioloop
+from tornado.log import app_log
+
+import metrics
+
+
+class Timer(object):
+    """A timer scheduled on a TimerWheel. Call cancel() to cancel it."""
+    __slots__ = ('wheel', 'slot', 'rounds', 'callback', 'args')
+
+    def __init__(self, wheel, slot, rounds, callback, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+
+    @property
+    def active(self):
+        return self.wheel is not None
+
+    def cancel(self):
+        """Cancel the timer. Cancelling a fired timer does nothing."""
+        if self.wheel is not None:
+            self.wheel._slots[self.slot].discard(self)
+            self.wheel._count -= 1
+            self.wheel = None
+
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel.
+
+    :param float tick: seconds per slot
+    :param int slots: number of slots, a full turn being tick * slots
+        seconds
+    :param tornado.ioloop.IOLoop io_loop: the loop ticking the wheel, the
+        current one by default
+    """
+
+    def __init__(self, tick=1.0, slots=512, io_loop=None):
+        self.tick = float(tick)
+        self._slots = [set() for _ in range(slots)]
+        self._cursor = 0
+        self._count = 0
+        self._io_loop = io_loop
+        self._periodic = None
+        self._last_tick = None
+
+    def __len__(self):
+        return self._count
+
+    def start(self):
+        """Start ticking the wheel on the IOLoop."""
+        self._last_tick = time.monotonic()
+        self._periodic = ioloop.PeriodicCallback(self._on_tick,
+                                                 self.tick * 1000)
+        if self._io_loop is not None:
+            self._io_loop.add_callback(self._periodic.start)
+        else:
+            self._periodic.start()
+
+    def stop(self):
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+
+    def schedule(self, delay, callback, *args):
+        """
+        Call callback(*args) in delay seconds.
+
+        :rtype: Timer
+        """
+        # The cursor slot was reached at _last_tick: count from there, so
+        # that a timer scheduled late in a tick doesn't fire early.
+        elapsed = 0.0
+        if self._last_tick is not None:
+            elapsed = max(0.0, time.monotonic() - self._last_tick)
+        ticks = max(1, int(math.ceil((delay + elapsed) / self.tick)))
+        slots = len(self._slots)
+        slot = (self._cursor + ticks) % slots
+        timer = Timer(self, slot, (ticks - 1) // slots, callback, args)
+        self._slots[slot].add(timer)
+        self._count += 1
+        return timer
+
+    def _on_tick(self):
+        # Catch up on the ticks missed while the IOLoop was busy.
+        now = time.monotonic()
+        ticks = int((now - self._last_tick) / self.tick)
+        self._last_tick += ticks * self.tick
+        for _ in range(ticks):
+            self.advance()
+
+    def advance(self):
+        """
+        Move the wheel forward one slot and fire the timers due.
+
+        :rtype: int
+        :returns: the number of timers fired
+        """
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        slot = self._slots[self._cursor]
+        due = []
+        for timer in slot:
+            if timer.rounds:
+                timer.rounds -= 1
+            else:
+                due.append(timer)
+        for timer in due:
+            slot.discard(timer)
+            self._count -= 1
+            timer.wheel = None
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                metrics.incr('timers.errors')
+                app_log.exception('Timer callback %r failed' % (
+                    timer.callback, ))
+        metrics.incr('timers.fired', len(due))
+        return len(due)
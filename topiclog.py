@@ -0,0 +1,414 @@
+"""
+Append-only on-disk log of the verified messages of each model, for
+historical replay.
+
+Every model has its own directory under HISTORY_DIR holding segment
+files named after the sequence number of their first message:
+
+    coin/00000000000000000001.log    records
+    coin/00000000000000000001.idx    sparse index of the records
+
+A record is a RECORD_HEADER (body length, sequence number, time
+received, item id length) followed by the item id and the body, as
+received. A new segment is started once the current one holds
+HISTORY_SEGMENT_BYTES. The index gets an INDEX_ENTRY (sequence number,
+time, offset) every HISTORY_INDEX_INTERVAL bytes of records, so a read
+seeks to the closest entry and scans at most that many bytes to reach
+the first record asked for.
+
+Records are appended with unbuffered writes, so they are in the page
+cache right away, and read through a read-only mmap of each segment.
+Whole segments are deleted, oldest first, once they are older than
+HISTORY_MAX_AGE or the model's log is larger than HISTORY_MAX_BYTES.
+
+Each process needs its own HISTORY_DIR: the log of a model is only
+written by the process that opened it.
+"""
+import os
+import re
+import mmap
+import time
+import bisect
+import struct
+
+import metrics
+
+RECORD_HEADER = struct.Struct('!IQdH')
+INDEX_ENTRY = struct.Struct('!QdQ')
+
+_MODEL_NAME = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]*$')
+
+
+class Segment(object):
+    """
+    One log file and its sparse index.
+
+    :param str path: path of the log file, the index is next to it
+    :param int base_seq: sequence number of the first record
+    """
+    __slots__ = ('path', 'index_path', 'base_seq', 'size', 'last_seq',
+                 'last_time', 'seqs', 'times', 'offsets', '_map',
+                 '_mapped_size', '_file', '_index_file')
+
+    def __init__(self, path, base_seq):
+        self.path = path
+        self.index_path = path[:-len('.log')] + '.idx'
+        self.base_seq = base_seq
+        self.size = 0
+        self.last_seq = base_seq - 1
+        self.last_time = 0.0
+        self.seqs = []
+        self.times = []
+        self.offsets = []
+        self._map = None
+        self._mapped_size = 0
+        self._file = None
+        self._index_file = None
+
+    def load(self):
+        """
+        Read the index and scan the records past its last entry, to find
+        the last record. A partly written last record is cut off.
+        """
+        self.size = os.path.getsize(self.path)
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = b''
+        for start in range(0, len(data) - INDEX_ENTRY.size + 1,
+                           INDEX_ENTRY.size):
+            seq, at, offset = INDEX_ENTRY.unpack_from(data, start)
+            if offset >= self.size:
+                break
+            self.seqs.append(seq)
+            self.times.append(at)
+            self.offsets.append(offset)
+        end = self.offsets[-1] if self.offsets else 0
+        for seq, at, item_id, start, stop in self._scan(end):
+            self.last_seq = seq
+            self.last_time = at
+            end = stop
+        if end < self.size:
+            metrics.incr('history.truncated')
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+            self.size = end
+        # Rewrite the index if it had entries past the end of the log.
+        if len(data) != len(self.seqs) * INDEX_ENTRY.size:
+            with open(self.index_path, 'wb') as f:
+                for entry in zip(self.seqs, self.times, self.offsets):
+                    f.write(INDEX_ENTRY.pack(*entry))
+
+    def append(self, seq, at, item_id, body, index_interval):
+        """Append a record, and an index entry if one is due."""
+        if self._file is None:
+            self._file = open(self.path, 'ab', buffering=0)
+            self._index_file = open(self.index_path, 'ab', buffering=0)
+        if not self.offsets or self.size - self.offsets[-1] >= index_interval:
+            self._index_file.write(INDEX_ENTRY.pack(seq, at, self.size))
+            self.seqs.append(seq)
+            self.times.append(at)
+            self.offsets.append(self.size)
+        self._file.write(b''.join((
+            RECORD_HEADER.pack(len(body), seq, at, len(item_id)), item_id,
+            body)))
+        self.size += RECORD_HEADER.size + len(item_id) + len(body)
+        self.last_seq = seq
+        self.last_time = at
+
+    def _view(self):
+        if self._mapped_size != self.size:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self.size:
+                with open(self.path, 'rb') as f:
+                    self._map = mmap.mmap(f.fileno(), self.size,
+                                          access=mmap.ACCESS_READ)
+            self._mapped_size = self.size
+        return self._map
+
+    def _scan(self, offset):
+        """
+        Yield (seq, time, item id, body offset, end offset) for the
+        complete records from offset on.
+        """
+        view = self._view()
+        if view is None:
+            return
+        size = len(view)
+        header_size = RECORD_HEADER.size
+        while offset + header_size <= size:
+            length, seq, at, id_length = RECORD_HEADER.unpack_from(view, offset)
+            start = offset + header_size + id_length
+            stop = start + length
+            if stop > size:
+                return
+            yield (seq, at, view[offset + header_size:start], start, stop)
+            offset = stop
+
+    def read(self, first_seq, since, until, item_id, limit, records,
+             max_scan=None):
+        """
+        Add to records the (seq, time, body) of the records from
+        first_seq or since, up to until, about item_id if given, until
+        there are limit of them or max_scan bytes of records were scanned.
+
+        :rtype: tuple
+        :returns: False once the read is over, or True to go on with the
+            next segment, the sequence number of the last record scanned
+            or None, and the bytes scanned
+        """
+        if not self.offsets:
+            return True, None, 0
+        # Seek to whichever of first_seq and since comes last.
+        position = bisect.bisect_right(self.seqs, first_seq) - 1
+        if since is not None:
+            position = max(position,
+                           bisect.bisect_right(self.times, since) - 1)
+        offset = self.offsets[max(position, 0)]
+        view = self._view()
+        last_seq = None
+        for seq, at, record_id, start, stop in self._scan(offset):
+            if until is not None and at > until:
+                return False, last_seq, start - offset
+            last_seq = seq
+            if (seq >= first_seq and (since is None or at >= since) and
+                    (item_id is None or record_id == item_id)):
+                # Slicing the mmap copies the body out of it.
+                records.append((seq, at, view[start:stop]))
+                if len(records) >= limit:
+                    return False, seq, stop - offset
+            if max_scan is not None and stop - offset >= max_scan:
+                return False, seq, stop - offset
+        return True, last_seq, self.size - offset
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._mapped_size = 0
+        for f in (self._file, self._index_file):
+            if f is not None:
+                f.close()
+        self._file = self._index_file = None
+
+    def delete(self):
+        self.close()
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class TopicLog(object):
+    """
+    The segmented log of one model.
+
+    :param str directory: the directory of the model's segments
+    :param int segment_bytes: size at which a new segment is started
+    :param int index_interval: bytes of records between index entries
+    :param int max_bytes: size of the log past which old segments are
+        deleted, or None
+    :param float max_age: seconds after which old segments are deleted,
+        or None
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024,
+                 index_interval=4096, max_bytes=None, max_age=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segments = []
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.log') and name[:-4].isdigit():
+                segment = Segment(os.path.join(directory, name),
+                                  int(name[:-4]))
+                segment.load()
+                self.segments.append(segment)
+
+    @property
+    def last_seq(self):
+        """The sequence number of the last record, 0 if there is none."""
+        return self.segments[-1].last_seq if self.segments else 0
+
+    @property
+    def size(self):
+        return sum(segment.size for segment in self.segments)
+
+    def append(self, item_id, body, now=None):
+        """
+        Append a message.
+
+        :param bytes item_id: the item the message is about, b'' for none
+        :param bytes body: the message as received
+        :rtype: int
+        :returns: the sequence number of the message
+        """
+        if now is None:
+            now = time.time()
+        seq = self.last_seq + 1
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.size >= self.segment_bytes:
+            if segment is not None:
+                segment.close()
+            segment = Segment(os.path.join(self.directory, '%020d.log' % seq),
+                              seq)
+            self.segments.append(segment)
+            self.enforce_retention(now)
+        # Times are kept in order for the index, even if the clock isn't.
+        segment.append(seq, max(now, segment.last_time), item_id, body,
+                       self.index_interval)
+        return seq
+
+    def read(self, first_seq=None, since=None, until=None, item_id=None,
+             limit=100):
+        """
+        Return up to limit records, from sequence number first_seq or
+        from time since, up to time until.
+
+        :param bytes item_id: only return the records about this item
+        :rtype: list
+        :returns: (seq, time, body) tuples, body being a bytes copy
+        """
+        return self.scan(first_seq, since, until, item_id, limit)[0]
+
+    def scan(self, first_seq=None, since=None, until=None, item_id=None,
+             limit=100, max_scan=None):
+        """
+        Read like read(), scanning at most about max_scan bytes of
+        records, so that reading a rare item doesn't go through the
+        whole log at once.
+
+        :rtype: tuple
+        :returns: the records, and the sequence number to read from next
+            to get the records that follow
+        """
+        first_seq = first_seq or 0
+        position = 0
+        for i, segment in enumerate(self.segments):
+            if segment.base_seq <= first_seq:
+                position = max(position, i)
+            if since is not None and segment.last_time < since:
+                position = i + 1
+        records = []
+        scanned = 0
+        scanned_seq = first_seq - 1
+        for segment in self.segments[position:]:
+            more, last_seq, size = segment.read(
+                first_seq, since, until, item_id, limit, records,
+                None if max_scan is None else max_scan - scanned)
+            scanned += size
+            if last_seq is not None:
+                scanned_seq = max(scanned_seq, last_seq)
+            if len(records) >= limit:
+                return records, records[-1][0] + 1
+            if max_scan is not None and scanned >= max_scan:
+                metrics.incr('history.scan_limited')
+                return records, scanned_seq + 1
+            if not more:
+                break
+        # Everything up to the end of the log, or to until, was read.
+        return records, self.last_seq + 1
+
+    def enforce_retention(self, now=None):
+        """Delete the oldest segments past max_age or max_bytes."""
+        if now is None:
+            now = time.time()
+        size = self.size
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            expired = (self.max_age is not None and
+                       oldest.last_time < now - self.max_age)
+            if not expired and (self.max_bytes is None or
+                                size <= self.max_bytes):
+                break
+            size -= oldest.size
+            oldest.delete()
+            del self.segments[0]
+            metrics.incr('history.segments_deleted')
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+class History(object):
+    """
+    The logs of the models kept, opened on first use.
+
+    :param str directory: HISTORY_DIR
+    :param iterable models: the models to keep, or None for all
+    :param dict options: TopicLog parameters
+    """
+
+    def __init__(self, directory, models=None, **options):
+        self.directory = directory
+        self.models = frozenset(models) if models is not None else None
+        self.options = options
+        self._logs = {}
+
+    def wants(self, model):
+        """Tell if the messages of model are kept."""
+        return (isinstance(model, str) and
+                (self.models is None or model in self.models) and
+                bool(_MODEL_NAME.match(model)))
+
+    def log(self, model):
+        """Return the log of model, opening it if needed."""
+        log = self._logs.get(model)
+        if log is None:
+            log = self._logs[model] = TopicLog(
+                os.path.join(self.directory, model), **self.options)
+        return log
+
+    def append(self, topic, body, now=None):
+        """
+        Append a verified message to the log of its model, if kept.
+
+        :param str|tuple topic: the topic key of the message
+        :param bytes body: the message as received
+        """
+        if isinstance(topic, tuple):
+            model, item_id = topic[0], topic[1].encode('utf-8')
+        else:
+            model, item_id = topic, b''
+        if not self.wants(model):
+            return
+        self.log(model).append(item_id, body, now)
+        metrics.incr('history.appended')
+
+    def read(self, topic, first_seq=None, since=None, until=None,
+             limit=100, max_scan=None):
+        """
+        Return records of a model, or of an item if topic is a (model, id)
+        tuple. See TopicLog.read.
+
+        :param int max_scan: bytes of records scanned at most, see
+            TopicLog.scan
+        :rtype: tuple
+        :returns: the (seq, time, body) records, the sequence number to
+            read from next to get the records that follow, and whether
+            the log holds records from there on
+        """
+        if isinstance(topic, tuple):
+            model, item_id = topic[0], topic[1].encode('utf-8')
+        else:
+            model, item_id = topic, None
+        log = self.log(model)
+        records, next_seq = log.scan(first_seq, since, until, item_id, limit,
+                                     max_scan)
+        return records, next_seq, next_seq <= log.last_seq
+
+    def enforce_retention(self, now=None):
+        for log in list(self._logs.values()):
+            log.enforce_retention(now)
+
+    def close(self):
+        for log in self._logs.values():
+            log.close()
@@ -0,0 +1,126 @@
+"""
+End-to-end latency tracing of published messages.
+
+Every message received by a consumer gets a MessageTrace recording the
+time of each stage it goes through:
+
+    iat        signed by the publisher
+    received   delivered by RabbitMQ, or read from the ingest socket
+    verified   signature checked
+    fanout     handed to the subscribers of its topic
+    written    written to the transport of a session, once per session
+
+The time between consecutive stages is recorded in per model histograms
+called 'latency.<model>.broker', '.verify', '.fanout' and '.write', and
+the time from iat to each write in 'latency.<model>.total'. The broker
+and total latencies are measured against the publisher's clock, so they
+include any clock skew between the hosts.
+
+A share of the traces, LATENCY_TRACE_SAMPLE, is also logged once its
+fan-out is over, to look at individual slow messages.
+"""
+import time
+import random
+
+import metrics
+
+STAGES = ('broker', 'verify', 'fanout', 'write', 'total')
+
+
+def histogram_names(model):
+    """Return the histogram names of a model, by stage."""
+    return dict((stage, 'latency.%s.%s' % (model, stage)) for stage in STAGES)
+
+
+# Histogram names by model, so that they are not formatted per message.
+_names = {}
+
+
+class MessageTrace(object):
+    """
+    Stage timestamps of one message, in seconds since the epoch.
+
+    :param float received: the time the message was received, now by
+        default
+    :param bool sampled: log the trace once its fan-out is over
+    """
+    __slots__ = ('received', 'verified', 'fanout', 'iat', 'model', 'names',
+                 'sampled', 'sessions', 'written', 'slowest')
+
+    def __init__(self, received=None, sampled=False):
+        self.received = time.time() if received is None else received
+        self.verified = None
+        self.fanout = None
+        self.iat = None
+        self.model = None
+        self.names = None
+        self.sampled = sampled
+        self.sessions = 0
+        self.written = 0
+        self.slowest = 0.0
+
+    def mark_verified(self, iat, now=None):
+        """Record the end of the signature check, and the signed iat."""
+        self.verified = time.time() if now is None else now
+        self.iat = iat
+
+    def mark_fanout(self, model, sessions, now=None):
+        """Record the start of the fan-out of the message to sessions."""
+        self.fanout = now = time.time() if now is None else now
+        if self.verified is None:
+            self.verified = self.received
+        self.model = model
+        self.sessions = sessions
+        names = self.names = _names.get(model)
+        if names is None:
+            names = self.names = _names[model] = histogram_names(model)
+        if self.iat is not None:
+            metrics.observe(names['broker'], max(self.received - self.iat, 0))
+        metrics.observe(names['verify'], self.verified - self.received)
+        metrics.observe(names['fanout'], now - self.verified)
+
+    def mark_written(self, now=None):
+        """Record the message being written to the transport of a session."""
+        if self.names is None:
+            return
+        if now is None:
+            now = time.time()
+        write = now - self.fanout
+        metrics.observe(self.names['write'], write)
+        if self.iat is not None:
+            metrics.observe(self.names['total'], max(now - self.iat, 0))
+        self.written += 1
+        if write > self.slowest:
+            self.slowest = write
+
+    def describe(self):
+        """Return a one line summary of the trace, for the logs."""
+        iat = self.iat if self.iat is not None else self.received
+        return ('trace model=%s broker=%.6f verify=%.6f fanout=%.6f '
+                'sessions=%d written=%d slowest_write=%.6f' % (
+                    self.model, self.received - iat,
+                    self.verified - self.received, self.fanout - self.verified,
+                    self.sessions, self.written, self.slowest))
+
+
+class Tracer(object):
+    """
+    Create the traces of the messages received by a consumer.
+
+    :param float sample: share of the traces to log, between 0 and 1
+    :param logging.Logger logger: the logger sampled traces are written to
+    """
+
+    def __init__(self, sample=0.0, logger=None):
+        self.sample = sample
+        self.logger = logger
+
+    def start(self, received=None):
+        """Return the trace of a message received now."""
+        sampled = bool(self.sample) and random.random() < self.sample
+        return MessageTrace(received, sampled)
+
+    def finish(self, trace):
+        """Log the trace if it was sampled, once its fan-out is over."""
+        if trace.sampled and self.logger is not None:
+            self.logger.info(trace.describe())
@@ -1,5 +1,7 @@
 import os
+import asyncio
 import logging
+import importlib
 import warnings
 import pikaconfig
 
@@ -49,3 +51,29 @@ def setupLogHandlers(fname, formatter=None, **kwargs):
 
     return handlers
 
+
+def import_object(path):
+    """
+    Import an object from its dotted path, like 'module.name'.
+
+    :param str path: dotted path of the object
+    :rtype: object
+    """
+    module_name, _, name = path.rpartition('.')
+    return getattr(importlib.import_module(module_name), name)
+
+
+def install_event_loop_policy(policy=None):
+    """
+    Install an alternative asyncio event loop policy, e.g. uvloop.
+
+    This must run before the first event loop is created, i.e. before
+    the Tornado IOLoop or the pika connection are set up.
+
+    :param str policy: dotted path to an asyncio event loop policy class,
+        like 'uvloop.EventLoopPolicy'. If None, the default policy is kept.
+    :rtype: asyncio.AbstractEventLoopPolicy
+    """
+    if policy:
+        asyncio.set_event_loop_policy(import_object(policy)())
+    return asyncio.get_event_loop_policy()